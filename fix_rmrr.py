@@ -3,13 +3,31 @@
 # vim: softtabstop=4 shiftwidth=4 expandtab fenc=utf-8 cc=80 nu
 # ==============================================================================
 import argparse
+import collections
+import atexit
+import contextlib
 import multiprocessing
 import os
 import sys
 import subprocess
 import ipaddress
-import inspect
-from shlex import split
+import tarfile
+import tempfile
+import shutil
+import time
+import threading
+import fcntl
+import tracemalloc
+import hashlib
+import json
+import mmap
+import glob
+import gzip
+import queue
+import re
+import sqlite3
+import urllib.parse
+from shlex import split, quote
 from distutils.version import LooseVersion
 
 root_path = os.path.dirname(os.path.realpath(__file__))
@@ -21,6 +39,22 @@ __TEMPLATE_NAME = "rmrr-" + str(__TEMPLATE_VERSION) + "-{tname}"
 
 
 class prettyprint:
+    # Console (and optional JSON-lines file) logger. Messages below the
+    # level are dropped before any formatting; extra arguments are only
+    # formatted into msg when the message is emitted. Records go through
+    # a queue to a writer thread that writes them in batches, so a
+    # caller feeding build output never waits on the terminal. Raw
+    # build output is dropped, and counted, rather than block when the
+    # queue is full. A failed write never stops the writer; should the
+    # thread be gone anyway, records are written by the caller.
+    DEBUG = 10
+    INFO = 20
+    WARN = 30
+    ERROR = 40
+    LEVELS = {DEBUG: 'DEBUG', INFO: 'INFO', WARN: 'WARN', ERROR: 'ERROR'}
+    QUEUE = 10000           # records waiting for the writer
+    BATCH = 512             # records written per write call
+    POLL = 0.1              # seconds between checks that the writer lives
     RC = ""
     GC = ""
     BC = ""
@@ -40,33 +74,174 @@ class prettyprint:
         is_a_tty = hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()
         return supported_platform and is_a_tty
 
-    def p(self, msg, color=None, title=" Info"):
+    def log(self, level: int, msg, *args, color=None, title=None):
+        """Queue msg (formatted with args) if level is enabled."""
+        if level < self.level:
+            return
+        if args:
+            msg = str(msg).format(*args)
+        if title is None:
+            title = self.LEVELS[level].rjust(5)
         if color is None:
-            color = self.GC
-        print(self.message.format(c=color, t=title, m=msg, e=self.EC))
+            color = {self.DEBUG: self.BC, self.WARN: self.YC,
+                     self.ERROR: self.RC}.get(level, self.GC)
+        self._put((time.time(), level, title, color, str(msg), False), True)
+        return
+
+    def p(self, msg, *args, color=None, title=" Info"):
+        self.log(self.INFO, msg, *args, color=color, title=title)
+        return
+
+    def info(self, msg, *args):
+        self.p(msg, *args)
+        return
+
+    def dp(self, msg, *args):
+        self.log(self.DEBUG, msg, *args, color=self.BC, title='DEBUG')
+        return
+
+    def err(self, msg, *args):
+        self.log(self.ERROR, msg, *args, color=self.RC, title='ERROR')
+        return
+
+    def warn(self, msg, *args):
+        self.log(self.WARN, msg, *args, color=self.YC, title=' WARN')
+        return
+
+    def raw(self, line: str):
+        """Unformatted build output, shown at debug level. Never blocks."""
+        if self.level > self.DEBUG:
+            return
+        self._put((time.time(), self.DEBUG, "", "", line.rstrip("\n"), True),
+                  False)
+        return
+
+    @property
+    def debug(self) -> bool:
+        return self.level <= self.DEBUG
+
+    @debug.setter
+    def debug(self, debug: bool):
+        self.level = self.DEBUG if debug else self.INFO
+
+    def _put(self, record: tuple, block: bool):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._writer,
+                                                    daemon=True)
+                    self._thread.start()
+        while True:
+            if not self._thread.is_alive():
+                # after whatever the writer left behind
+                self._join()
+                self._write([record])
+                return
+            try:
+                self._queue.put(record, block, self.POLL)
+                return
+            except queue.Full:
+                if not block:
+                    self.dropped += 1
+                    return
         return
 
-    def info(self, msg):
-        self.p(msg)
+    def _format(self, record: tuple) -> str:
+        ts, level, title, color, msg, raw = record
+        if raw:
+            return msg + "\n"
+        return self.message.format(c=color, t=title, m=msg, e=self.EC) + "\n"
+
+    def _write(self, records: list):
+        # a closed stdout (BrokenPipeError) or a full disk under the log
+        # file loses the records, never the caller or the writer
+        try:
+            sys.stdout.write("".join(self._format(x) for x in records))
+            sys.stdout.flush()
+        except (OSError, ValueError):
+            pass
+        if self._file is None:
+            return
+        try:
+            self._file.write("".join(json.dumps(
+                {'ts': round(x[0], 3), 'level': self.LEVELS[x[1]],
+                 'msg': x[4], 'raw': x[5]}) + "\n" for x in records))
+            self._file.flush()
+        except (OSError, ValueError) as e:
+            f = self._file
+            self._file = None
+            try:
+                f.close()
+            except (OSError, ValueError):
+                pass
+            try:
+                sys.stderr.write("log file: {}, no longer writing it\n"
+                                 .format(e))
+            except (OSError, ValueError):
+                pass
         return
 
-    def dp(self, msg):
-        if self.debug:
-            #print("{} * DEBUG{}: {}".format(self.BC, self.EC, msg))
-            #print(self.message.format(c=self.BC, t='DEBUG', e=self.EC, m=msg))
-            self.p(msg=msg, color=self.BC, title='DEBUG')
+    def _writer(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.BATCH:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                records = [x for x in batch if not x is None]
+                if len(records) > 0:
+                    self._write(records)
+            except Exception:
+                pass
+            finally:
+                for x in batch:
+                    self._queue.task_done()
         return
 
-    def err(self, msg):
-        self.p(msg=msg, color=self.RC, title='ERROR')
+    def _join(self):
+        # Queue.join() that gives up on a dead writer; what it left in
+        # the queue is written here
+        q = self._queue
+        with q.all_tasks_done:
+            while q.unfinished_tasks > 0 and self._thread.is_alive():
+                q.all_tasks_done.wait(self.POLL)
+        if self._thread.is_alive():
+            return
+        records = []
+        while True:
+            try:
+                records.append(q.get_nowait())
+            except queue.Empty:
+                break
+        records = [x for x in records if not x is None]
+        if len(records) > 0:
+            self._write(records)
         return
 
-    def warn(self, msg):
-        self.p(msg=msg, color=self.YC, title=' WARN')
+    def flush(self):
+        """Wait until every queued record has been written."""
+        if not self._thread is None:
+            self._join()
+        if self.dropped > 0:
+            dropped = self.dropped
+            self.dropped = 0
+            self.warn("{} lines of build output were not shown", dropped)
+            self._join()
         return
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, logfile: str = None):
+        self.level = self.INFO
         self.debug = debug
+        self.dropped = 0
+        self._queue = queue.Queue(self.QUEUE)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._file = None
+        if not logfile is None:
+            self._file = open(logfile, "a")
+        atexit.register(self.flush)
         if self.supports_color():
             self.RC = '\033[1;31m'
             self.GC = '\033[1;32m'
@@ -77,6 +252,7 @@ class prettyprint:
     def __repr__(self):
         ret = {}
         ret['debug'] = self.debug
+        ret['level'] = self.LEVELS[self.level]
         ret['supports_color'] = self.supports_color()
         return str(ret)
 
@@ -87,54 +263,331 @@ class prettyprint:
         return ret
 
 
+class phaseprofiler:
+    # Nested phase timings for --profile. Each phase records wall time,
+    # CPU time (this process and its waited-for children) and the number
+    # of subprocesses started, keyed by its path of enclosing phases.
+    # Disabled, phase() costs one attribute check.
+
+    def __repr__(self):
+        return str({'enabled': self.enabled, 'phases': len(self._stats)})
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._stack = []
+        self._stats = {}
+        self._procs = 0
+        self._thread = threading.local()
+        if enabled:
+            self._count_procs()
+        return
+
+    def _count_procs(self):
+        prof = self
+
+        class _popen(subprocess.Popen):
+            def __init__(self, *args, **kwargs):
+                prof._procs += 1
+                prof._thread.procs = prof.thread_procs() + 1
+                super().__init__(*args, **kwargs)
+
+        subprocess.Popen = _popen
+        return
+
+    @staticmethod
+    def _cpu() -> float:
+        t = os.times()
+        return t.user + t.system + t.children_user + t.children_system
+
+    def begin(self, name: str):
+        """Open a phase nested in the current one; see also phase()."""
+        if not self.enabled:
+            return
+        self._stack.append((name, time.perf_counter(), self._cpu(),
+                            self._procs))
+        return
+
+    def end(self):
+        """Close the innermost open phase."""
+        if not self.enabled or len(self._stack) == 0:
+            return
+        path = tuple(x[0] for x in self._stack)
+        name, wall, cpu, procs = self._stack.pop()
+        s = self._stats.setdefault(path, [0, 0.0, 0.0, 0])
+        s[0] += 1
+        s[1] += time.perf_counter() - wall
+        s[2] += self._cpu() - cpu
+        s[3] += self._procs - procs
+        return
+
+    def thread_procs(self) -> int:
+        """Subprocesses started by the calling thread so far."""
+        return getattr(self._thread, 'procs', 0)
+
+    def record(self, name: str, wall: float, cpu: float = 0.0,
+               procs: int = 0):
+        """Add a phase timed elsewhere (a taskgraph task run on another
+        thread) as a child of the current phase."""
+        if not self.enabled:
+            return
+        path = tuple(x[0] for x in self._stack) + (name,)
+        s = self._stats.setdefault(path, [0, 0.0, 0.0, 0])
+        s[0] += 1
+        s[1] += wall
+        s[2] += cpu
+        s[3] += procs
+        return
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end()
+        return
+
+    def finish(self, folded: str = None):
+        """Close open phases (sys.exit inside a phase), print the report
+        and write the folded stacks to folded if given."""
+        while len(self._stack) > 0:
+            self.end()
+        pprint.p("Profile:\n{}".format(self.report()))
+        if not folded is None:
+            write_atomic(folded, self.folded())
+            pprint.p("Wrote {}".format(folded))
+        return
+
+    def report(self) -> str:
+        """Phases indented under their parents, siblings sorted by wall
+        time."""
+        rows = [("phase", "calls", "wall s", "cpu s", "procs")]
+
+        def children(parent: tuple) -> list:
+            n = len(parent)
+            ret = {p[:n + 1] for p in self._stats
+                   if len(p) > n and p[:n] == parent}
+            return sorted(ret, key=lambda p: (-self._stats.get(p, [0, 0])[1],
+                                              p))
+
+        def walk(parent: tuple):
+            for path in children(parent):
+                s = self._stats.get(path)
+                if not s is None:
+                    rows.append(("  " * (len(path) - 1) + path[-1],
+                                 str(s[0]), "{:.3f}".format(s[1]),
+                                 "{:.3f}".format(s[2]), str(s[3])))
+                walk(path)
+            return
+
+        walk(())
+        widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+        ret = ""
+        for r in rows:
+            ret = ret + r[0].ljust(widths[0]) + "  " + "  ".join(
+                x.rjust(w) for x, w in zip(r[1:], widths[1:])) + "\n"
+        return ret
+
+    def folded(self) -> str:
+        """Folded stacks (phase;phase self-microseconds) for
+        flamegraph.pl, speedscope and similar tools."""
+        ret = ""
+        for path, s in sorted(self._stats.items()):
+            child = sum(c[1] for p, c in self._stats.items()
+                        if len(p) == len(path) + 1 and p[:-1] == path)
+            ret = ret + "{} {}\n".format(";".join(path),
+                                         max(0, int((s[1] - child) * 1e6)))
+        return ret
+
+
+profiler = phaseprofiler()
+
+
+class taskgraph:
+    # Steps as a dependency graph. Each task names the values it takes
+    # as arguments and the values its return provides; a task starts as
+    # soon as all of its inputs exist, with at most jobs tasks running at
+    # once, so the whole graph takes about as long as its longest chain
+    # of dependent tasks. An exception (sys.exit included) stops new
+    # tasks from starting, lets running ones finish and is raised again
+    # from run(). Speculative tasks (a download a later step may turn out
+    # not to need) are not waited for then; they are left to die with
+    # the process.
+
+    def __repr__(self):
+        return str({'jobs': self.jobs, 'tasks': list(self._tasks),
+                    'values': list(self.values)})
+
+    def __init__(self, jobs: int = 4):
+        self.jobs = max(1, jobs)
+        self.values = {}
+        self.times = {}
+        self._tasks = {}
+        self._producer = {}
+        self._running = set()
+        self._speculative = set()
+        self._error = None
+        return
+
+    def add(self, name: str, fn, inputs: tuple = (), outputs: tuple = (),
+            speculative: bool = False):
+        """fn(*inputs) returns the single output, a tuple of outputs or,
+        without outputs, anything (ignored)."""
+        if name in self._tasks:
+            raise ValueError("task {} added twice".format(name))
+        for x in outputs:
+            if x in self._producer:
+                raise ValueError("{} is produced by {} and {}".format(
+                    x, self._producer[x], name))
+            self._producer[x] = name
+        self._tasks[name] = (fn, tuple(inputs), tuple(outputs))
+        if speculative:
+            self._speculative.add(name)
+        return self
+
+    def _run(self, name: str, fn, args: list, outputs: tuple,
+             cond: threading.Condition):
+        start = time.perf_counter()
+        cpu = time.thread_time()
+        procs = profiler.thread_procs()
+        values = {}
+        error = None
+        try:
+            ret = fn(*args)
+            if len(outputs) == 1:
+                ret = (ret,)
+            if len(outputs) > 0:
+                if len(ret) != len(outputs):
+                    raise ValueError("task {} returned {} values for {}"
+                                     .format(name, len(ret), outputs))
+                values = dict(zip(outputs, ret))
+        except BaseException as e:
+            error = e
+        with cond:
+            self.values.update(values)
+            self.times[name] = (start, time.perf_counter(),
+                                time.thread_time() - cpu,
+                                profiler.thread_procs() - procs)
+            self._running.discard(name)
+            if not error is None and self._error is None:
+                self._error = error
+            cond.notify()
+        return
+
+    def run(self) -> dict:
+        """Run every task; returns the dict of produced values."""
+        for name, (fn, inputs, outputs) in self._tasks.items():
+            for x in inputs:
+                if not x in self._producer and not x in self.values:
+                    raise ValueError("task {} needs {}, which no task "
+                                     "produces".format(name, x))
+        pending = dict(self._tasks)
+        cond = threading.Condition()
+        with cond:
+            while True:
+                if self._error is None:
+                    for name in list(pending):
+                        if len(self._running) >= self.jobs:
+                            break
+                        fn, inputs, outputs = pending[name]
+                        if not all(x in self.values for x in inputs):
+                            continue
+                        del pending[name]
+                        self._running.add(name)
+                        pprint.dp("task {} started", name)
+                        threading.Thread(
+                            target=self._run, daemon=True,
+                            args=(name, fn, [self.values[x] for x in inputs],
+                                  outputs, cond)).start()
+                if len(self._running) == 0:
+                    break
+                if not self._error is None and \
+                   self._running <= self._speculative:
+                    break
+                cond.wait()
+        if not self._error is None:
+            raise self._error
+        if len(pending) > 0:
+            raise ValueError("tasks {} wait on each other".format(
+                ", ".join(pending)))
+        for name in self._tasks:
+            start, end, cpu, procs = self.times[name]
+            profiler.record(name, end - start, cpu, procs)
+        return self.values
+
+    @property
+    def critical_path(self) -> list:
+        """Names of the chain of tasks that finished last, each waiting
+        on the input that arrived last."""
+        ret = []
+        name = max(self.times, key=lambda x: self.times[x][1], default=None)
+        while not name is None:
+            ret.insert(0, name)
+            deps = [self._producer[x] for x in self._tasks[name][1]
+                    if x in self._producer]
+            name = max(deps, key=lambda x: self.times[x][1], default=None)
+        return ret
+
+    @property
+    def summary(self) -> str:
+        """Per task start and duration relative to the first start."""
+        if len(self.times) == 0:
+            return ""
+        t0 = min(x[0] for x in self.times.values())
+        ret = ""
+        for name in sorted(self.times, key=lambda x: self.times[x][0]):
+            start, end, cpu, procs = self.times[name]
+            ret = ret + "{:>8.3f}s {:>8.3f}s  {}\n".format(
+                start - t0, end - start, name)
+        ret = ret + "critical path: {}\n".format(
+            " -> ".join(self.critical_path))
+        return ret
+
+
 class kernel:
     # store information about a kernel
+    # Every property is resolved lazily with apt/dpkg calls, so printing
+    # and snapshot() only show values already resolved; refresh() is the
+    # explicit way to resolve them all.
+    FIELDS = ('pkg', 'hdr', 'exists', 'versions', 'available', 'selected',
+              'source', 'installed', 'active', 'upgradable', 'customized',
+              'git_url', 'git_hash', 'policy')
+
     def __repr__(self):
-        ret = {}
-        ret['pkg'] = self.pkg
-        ret['hdr'] = self.hdr
-        ret['versions'] = self.versions
-        ret['installed'] = self.installed
-        ret['active'] = self.active
-        ret['source'] = self.source
-        ret['selected'] = self.selected
-        ret['available'] = self.available
-        ret['policy'] = self.policy
-        ret['exists'] = self.exists
-        ret['upgradable'] = self.upgradable
-        ret['customized'] = self.customized
-        ret['git_url'] = self.git_url
-        ret['git_hash'] = self.git_hash
-        return str(ret)
+        return str(self.snapshot())
 
     def __str__(self):
+        snap = self.snapshot()
         ret = "{}\n".format(self.pkg)
-        ret = ret + "pkg:".rjust(15, " ") + " {}\n".format(self.pkg)
-        ret = ret + "hdr:".rjust(15, " ") + " {}\n".format(self.hdr)
-        ret = ret + "exists:".rjust(15, " ") + " {}\n".format(self.exists)
-        ret = ret + "versions:".rjust(15, " ") + " {}\n".format(self.versions)
-        ret = ret + "available:".rjust(15, " ")
-        ret = ret + " {}\n".format(self.available)
-        ret = ret + "selected:".rjust(15, " ") + " {}\n".format(self.selected)
-        ret = ret + "source:".rjust(15, " ") + " {}\n".format(self.source)
-        ret = ret + "installed:".rjust(15, " ")
-        ret = ret + " {}\n".format(self.installed)
-        ret = ret + "active:".rjust(15, " ") + " {}\n".format(self.active)
-        ret = ret + "upgradable:".rjust(15, " ")
-        ret = ret + " {}\n".format(self.upgradable)
-        ret = ret + "customized:".rjust(15, " ")
-        ret = ret + " {}\n".format(self.customized)
-        ret = ret + "git_url:".rjust(15, " ") + " {}\n".format(self.git_url)
-        ret = ret + "git_hash:".rjust(15, " ") + " {}\n".format(self.git_hash)
-        if not self.policy is None:
-            ret = ret + "policy:".rjust(15, " ")
-            # ret = ret + " {}\n".format(self.policy.splitlines()[0])
-            for l in self.policy.splitlines():
-                ret = ret + "\n{}{}".format(" " * 16, l)
-        else:
-            ret = ret + "policy:".rjust(15, " ") + " {}\n".format(self.policy)
+        for x in self.FIELDS:
+            val = snap.get(x, "(not resolved)")
+            if x == 'policy' and x in snap:
+                val = "".join("\n{}{}".format(" " * 16, l)
+                              for l in val.splitlines())
+            ret = ret + "{}: {}\n".format(x.rjust(14, " "), val)
+        return ret
+
+    def snapshot(self) -> dict:
+        """Already resolved fields, without running any command."""
+        ret = {}
+        for x in self.FIELDS:
+            val = getattr(self, f"_{x}")
+            if not val is None:
+                ret[x] = val
         return ret
 
+    def tojson(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def refresh(self):
+        """Drop cached state and resolve every field again."""
+        for x in self.FIELDS:
+            if not x in ('pkg', 'hdr', 'selected'):
+                setattr(self, f"_{x}", None)
+        for x in self.FIELDS:
+            getattr(self, x)
+        return self
+
     def __init__(self, pkg=None, hdr=None):
         self._pkg = pkg
         self._hdr = hdr
@@ -407,6 +860,39 @@ class kernel:
             self._upgradable = True
         return self._upgradable
 
+    def fetch_candidate_source(self) -> bool:
+        """Point git_url and git_hash at the candidate version by reading
+        the SOURCE file out of the candidate .deb, without installing it.
+        Returns True on success."""
+        if not self.exists or self.available is None:
+            return False
+        with tempfile.TemporaryDirectory() as tmp:
+            res = sp_run(["apt-get", "download",
+                          "{}={}".format(self.pkg, self.available)], cwd=tmp)
+            debs = glob.glob(f"{tmp}/*.deb")
+            if res.returncode != 0 or len(debs) == 0:
+                return False
+            proc = subprocess.Popen(["dpkg-deb", "--fsys-tarfile", debs[0]],
+                                    stdout=subprocess.PIPE)
+            text = None
+            with tarfile.open(fileobj=proc.stdout, mode="r|*") as tar:
+                for member in tar:
+                    if member.isfile() and member.name.endswith("/SOURCE"):
+                        text = tar.extractfile(member).read().decode()
+                        break
+            proc.stdout.close()
+            proc.wait()
+        if text is None:
+            return False
+        for x in text.splitlines():
+            x = x.strip()
+            if x.startswith("git clone"):
+                self._git_url = x.split()[2]
+            if x.startswith("git checkout"):
+                self._git_hash = x.split()[2]
+                self._source = x
+        return not self._git_hash is None
+
     @property
     def customized(self):
         """Returns True if this package is not sourced from Proxmox or
@@ -451,6 +937,605 @@ class kernels(dict):
         return list(self.keys())
 
 
+class kernelmatrix:
+    # Set of kernels to build in one run: every installed pve-kernel and,
+    # optionally, the candidate of every upgradable one. Targets are
+    # deduplicated by pve-kernel git hash, since two packages built from
+    # the same commit produce the same patched kernel.
+
+    def __repr__(self):
+        return str([(t['pkg'], t['version'], t['reason'])
+                    for t in self.targets])
+
+    def __init__(self, k: kernels, upgradable: bool = True,
+                 search: str = None):
+        # search limits the matrix to package names containing it
+        self._kernels = k
+        self._upgradable = upgradable
+        self._search = search
+        self._targets = None
+        return
+
+    @property
+    def targets(self) -> list:
+        """[{'kernel', 'pkg', 'version', 'git_hash', 'reason'}], newest
+        package first."""
+        if not self._targets is None:
+            return self._targets
+        self._targets = []
+        seen = set()
+        names = self._kernels.list
+        names.sort(key=LooseVersion, reverse=True)
+        for name in names:
+            if self._search and not self._search in name:
+                continue
+            k = self._kernels[name]
+            if not k.installed:
+                continue
+            found = [(k, k.installed, "installed")]
+            if self._upgradable and k.upgradable:
+                c = kernel(pkg=name)
+                if c.fetch_candidate_source():
+                    found.append((c, k.available, "upgradable"))
+            for obj, version, reason in found:
+                if obj.git_hash is None or obj.git_hash in seen:
+                    continue
+                seen.add(obj.git_hash)
+                self._targets.append({'kernel': obj, 'pkg': name,
+                                      'version': version,
+                                      'git_hash': obj.git_hash,
+                                      'reason': reason})
+        return self._targets
+
+    @staticmethod
+    def summary(results: list) -> str:
+        """Table of matrix results, one line per target."""
+        head = ("package", "version", "git hash", "reason", "result",
+                "time", "debs")
+        rows = [head]
+        total = 0
+        for r in results:
+            total += r.get('seconds') or 0
+            rows.append((r['pkg'], r['version'], r['git_hash'][:12],
+                         r['reason'], r['result'],
+                         "{}s".format(r.get('seconds') or 0),
+                         str(len(r.get('debs') or []))))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(head))]
+        ret = ""
+        for row in rows:
+            ret = ret + "  ".join(x.ljust(w) for x, w in
+                                  zip(row, widths)).rstrip() + "\n"
+        ret = ret + "total build time: {}s\n".format(total)
+        return ret
+
+
+class aptwatch:
+    # Cheap detection of apt index updates: stat the files in the apt lists
+    # directory instead of asking apt-cache. Only once the lists have been
+    # quiet for the debounce period is a change reported, so an apt-get
+    # update that rewrites many files in a row counts as one event.
+    LISTS = "/var/lib/apt/lists"
+
+    def __repr__(self):
+        return "{}(lists={}, interval={}, debounce={})".format(
+            type(self).__name__, self.lists, self.interval, self.debounce)
+
+    def __init__(self, lists: str = None, interval: int = 60,
+                 debounce: int = 300):
+        self.lists = self.LISTS if lists is None else lists
+        self.interval = interval
+        self.debounce = debounce
+        self._last = self.snapshot()
+        return
+
+    def snapshot(self) -> dict:
+        """{file name: mtime in ns} for the index files in lists."""
+        ret = {}
+        try:
+            entries = os.scandir(self.lists)
+        except OSError:
+            return ret
+        with entries:
+            for x in entries:
+                if x.name == "lock" or not x.is_file():
+                    continue
+                ret[x.name] = x.stat().st_mtime_ns
+        return ret
+
+    @property
+    def changed(self) -> bool:
+        """True if lists differ from the last snapshot taken."""
+        now = self.snapshot()
+        if now == self._last:
+            return False
+        self._last = now
+        return True
+
+    def wait(self) -> bool:
+        """Block until the lists changed and then stayed unchanged for
+        debounce seconds. Returns True."""
+        while not self.changed:
+            time.sleep(self.interval)
+        quiet = 0
+        while quiet < self.debounce:
+            time.sleep(min(self.interval, self.debounce))
+            if self.changed:
+                quiet = 0
+            else:
+                quiet += min(self.interval, self.debounce)
+        return True
+
+    @staticmethod
+    def candidates(search: str = None) -> dict:
+        """{package: candidate version} for every pve-kernel apt knows."""
+        k = kernels()
+        ret = {}
+        for name in k.list:
+            if search and not search in name:
+                continue
+            ret[name] = k[name].available
+        return ret
+
+
+class debversion:
+    # Debian version string with dpkg ordering, see deb-version(7).
+    # Comparison happens in-process so resolving a few hundred relations
+    # does not cost a dpkg --compare-versions call each.
+
+    def __init__(self, version: str):
+        version = version.strip()
+        self.version = version
+        epoch, sep, rest = version.partition(":")
+        if sep and epoch.isdigit():
+            self.epoch = int(epoch)
+        else:
+            self.epoch = 0
+            rest = version
+        upstream, sep, revision = rest.rpartition("-")
+        if not sep:
+            upstream, revision = rest, "0"
+        self.upstream = upstream
+        self.revision = revision
+        return
+
+    def __repr__(self):
+        return f"debversion('{self.version}')"
+
+    def __str__(self):
+        return self.version
+
+    @staticmethod
+    def _order(c: str) -> int:
+        if c == "~":
+            return -1
+        if c.isdigit():
+            return 0
+        if c.isalpha():
+            return ord(c)
+        return ord(c) + 256
+
+    @classmethod
+    def _cmp_part(cls, a: str, b: str) -> int:
+        ia = ib = 0
+        while ia < len(a) or ib < len(b):
+            # non-digit prefix, compared with the dpkg character order
+            while (ia < len(a) and not a[ia].isdigit()) or \
+                  (ib < len(b) and not b[ib].isdigit()):
+                ca = cls._order(a[ia]) if ia < len(a) and \
+                    not a[ia].isdigit() else 0
+                cb = cls._order(b[ib]) if ib < len(b) and \
+                    not b[ib].isdigit() else 0
+                if ca != cb:
+                    return -1 if ca < cb else 1
+                ia += 1
+                ib += 1
+            # digit run, compared numerically
+            sa = ia
+            while ia < len(a) and a[ia].isdigit():
+                ia += 1
+            sb = ib
+            while ib < len(b) and b[ib].isdigit():
+                ib += 1
+            na = int(a[sa:ia] or 0)
+            nb = int(b[sb:ib] or 0)
+            if na != nb:
+                return -1 if na < nb else 1
+        return 0
+
+    def compare(self, other) -> int:
+        """Return -1, 0 or 1 like dpkg --compare-versions."""
+        if not isinstance(other, debversion):
+            other = debversion(str(other))
+        if self.epoch != other.epoch:
+            return -1 if self.epoch < other.epoch else 1
+        ret = self._cmp_part(self.upstream, other.upstream)
+        if ret != 0:
+            return ret
+        return self._cmp_part(self.revision, other.revision)
+
+    def satisfies(self, op: str, other) -> bool:
+        """True if 'self op other' holds for a relation operator."""
+        c = self.compare(other)
+        if op in ("<<", "<"):
+            return c < 0
+        if op == "<=":
+            return c <= 0
+        if op == "=":
+            return c == 0
+        if op == ">=":
+            return c >= 0
+        if op in (">>", ">"):
+            return c > 0
+        raise ValueError(f"unknown version relation '{op}'")
+
+
+def parse_deb822(text: str) -> list:
+    """Parse deb822 text (debian/control, dpkg status, Packages) into a list
+    of paragraphs, one dict per paragraph. Field names keep their case,
+    continuation lines are joined with newlines."""
+    paragraphs = []
+    para = {}
+    field = None
+    for line in text.splitlines():
+        if line.startswith("#"):
+            continue
+        if not line.strip():
+            if para:
+                paragraphs.append(para)
+            para = {}
+            field = None
+            continue
+        if line[0] in " \t":
+            if not field is None:
+                para[field] = f"{para[field]}\n{line.strip()}"
+            continue
+        field, _, value = line.partition(":")
+        field = field.strip()
+        para[field] = value.strip()
+    if para:
+        paragraphs.append(para)
+    return paragraphs
+
+
+def parse_relations(field: str, arch: str = "amd64",
+                    profiles: set = None) -> list:
+    """Parse a relationship field (Build-Depends, Depends, ...).
+    Returns a list of AND-ed entries, each a list of OR-ed alternatives of
+    the form {'name': str, 'op': str or None, 'version': str or None}.
+    Alternatives restricted away by [arch] or <profile> are dropped, as
+    are entries left without any alternative."""
+    if profiles is None:
+        profiles = set()
+    ret = []
+    for entry in field.replace("\n", " ").split(","):
+        alts = []
+        for alt in entry.split("|"):
+            alt = alt.strip()
+            if not alt:
+                continue
+            name = re.match(r"[^\s(\[<]*", alt).group(0).partition(":")[0]
+            op = None
+            version = None
+            m = re.search(r"\(\s*(<<|<=|>=|>>|=|<|>)\s*([^)\s]+)\s*\)", alt)
+            if m:
+                op, version = m.group(1), m.group(2)
+                alt = alt[:m.start()] + alt[m.end():]
+            m = re.search(r"\[([^\]]*)\]", alt)
+            if m:
+                archs = m.group(1).split()
+                neg = [a[1:] for a in archs if a.startswith("!")]
+                pos = [a for a in archs if not a.startswith("!")]
+                if arch in neg or (pos and not arch in pos and
+                                   not "any" in pos):
+                    continue
+            # build profile formula: <a b> <c> means (a and b) or c,
+            # a leading ! negates a term
+            lists = [x.split() for x in re.findall(r"<([^>]*)>", alt)]
+            if lists and not any(all((t[1:] not in profiles)
+                                     if t.startswith("!")
+                                     else (t in profiles) for t in l)
+                                 for l in lists):
+                continue
+            alts.append({'name': name, 'op': op, 'version': version})
+        if alts:
+            ret.append(alts)
+    return ret
+
+
+class dpkgstate:
+    # Installed package set parsed from a dpkg status file.
+    # name -> version for installed packages, plus virtual packages
+    # name -> set of (provider, provided version or None).
+
+    def __init__(self, status: str = None):
+        # status is the text of /var/lib/dpkg/status; None means empty
+        self.installed = {}
+        self.provides = {}
+        if status:
+            self.load(status)
+        return
+
+    def __repr__(self):
+        return "dpkgstate({} installed)".format(len(self.installed))
+
+    def load(self, status: str):
+        for p in parse_deb822(status):
+            if not p.get("Status", "").endswith(" installed"):
+                continue
+            name = p.get("Package")
+            if not name:
+                continue
+            self.installed[name] = p.get("Version", "")
+            for alts in parse_relations(p.get("Provides", "")):
+                for prov in alts:
+                    s = self.provides.setdefault(prov['name'], set())
+                    s.add((name, prov['version']))
+        return self
+
+    def satisfied(self, rel: dict) -> bool:
+        """True if one relation alternative is met by installed state."""
+        name = rel['name']
+        if name in self.installed:
+            if rel['op'] is None:
+                return True
+            v = debversion(self.installed[name])
+            if v.satisfies(rel['op'], rel['version']):
+                return True
+        for _, version in self.provides.get(name, ()):
+            if rel['op'] is None:
+                return True
+            if not version is None and \
+               debversion(version).satisfies(rel['op'], rel['version']):
+                return True
+        return False
+
+
+class builddeps:
+    # Build dependencies of a source package checked against the
+    # installed set of a container. 'missing' only lists what apt still
+    # has to install, so a warm container resolves to an empty list.
+
+    def __repr__(self):
+        return str(self.missing)
+
+    def __str__(self):
+        return " ".join(self.missing)
+
+    def __init__(self, control: str = None, extra: str = None,
+                 state: dpkgstate = None, arch: str = "amd64",
+                 profiles: set = None, indep: bool = True):
+        # control: path to debian/control(.in); extra: additional
+        # relations in Build-Depends syntax; indep: False skips the
+        # -Indep fields, as dpkg-buildpackage -B does
+        self._control = control
+        self._extra = extra
+        self._arch = arch
+        self._profiles = profiles
+        self._indep = indep
+        self._relations = None
+        self._conflicts = None
+        self._missing = None
+        self.state = state if not state is None else dpkgstate()
+        return
+
+    def _parse(self):
+        self._relations = []
+        self._conflicts = []
+        fields = []
+        cfields = []
+        if self._control and os.path.isfile(self._control):
+            with open(self._control, "r") as f:
+                paragraphs = parse_deb822(f.read())
+            if paragraphs:
+                src = paragraphs[0]
+                suffixes = ("", "-Arch", "-Indep") if self._indep else \
+                    ("", "-Arch")
+                for key in suffixes:
+                    if "Build-Depends" + key in src:
+                        fields.append(src["Build-Depends" + key])
+                    if "Build-Conflicts" + key in src:
+                        cfields.append(src["Build-Conflicts" + key])
+        if self._extra:
+            fields.append(self._extra)
+        for f in fields:
+            self._relations.extend(parse_relations(f, self._arch,
+                                                   self._profiles))
+        for f in cfields:
+            self._conflicts.extend(parse_relations(f, self._arch,
+                                                   self._profiles))
+        return
+
+    @property
+    def relations(self) -> list:
+        """All parsed build dependency relations."""
+        if self._relations is None:
+            self._parse()
+        return self._relations
+
+    @property
+    def conflicts(self) -> list:
+        """Installed packages named by Build-Conflicts."""
+        if self._conflicts is None:
+            self._parse()
+        ret = []
+        for alts in self._conflicts:
+            for rel in alts:
+                if rel['name'] in self.state.installed and \
+                   self.state.satisfied(rel):
+                    ret.append(rel['name'])
+        return ret
+
+    @property
+    def missing(self) -> list:
+        """Packages to install: the first alternative of every relation
+        not already satisfied, without duplicates, in control order."""
+        if not self._missing is None:
+            return self._missing
+        self._missing = []
+        for alts in self.relations:
+            if any(self.state.satisfied(rel) for rel in alts):
+                continue
+            name = alts[0]['name']
+            if not name in self._missing:
+                self._missing.append(name)
+        return self._missing
+
+
+class macallocator:
+    # Hands out MAC addresses under a vendor prefix without colliding with
+    # any interface already configured in the cluster. Every pct and qemu
+    # config under /etc/pve/nodes is read once and the device part (low 24
+    # bits) of each MAC with our prefix is marked in a bitmap. A container
+    # first gets the address derived from its id, as before
+    # (<vendor><net id><id % 1048575>); only on a collision is the next
+    # free bit taken, scanning forward from a cursor that never moves back.
+    #
+    # An address is handed out before its container config exists, so
+    # allocate() holds a lock against other threads and, with a
+    # reservations file, an flock against other runs: every address given
+    # out in the last RESERVE seconds is listed there as
+    #   <mac> <container id> <epoch>
+    # and treated as used, except the address derived from the id of the
+    # container it was reserved for when that container asks again.
+    CONFIGS = ("/etc/pve/nodes/*/lxc/*.conf",
+               "/etc/pve/nodes/*/qemu-server/*.conf")
+    MAC = re.compile(r"\b([0-9A-Fa-f]{2}(?::[0-9A-Fa-f]{2}){5})\b")
+    DEVICES = 1 << 24
+    RESERVE = 3600
+
+    def __repr__(self):
+        ret = {}
+        ret['vendor'] = "{:06X}".format(self.vendor)
+        ret['configs'] = self.configs
+        ret['used'] = self.used
+        return str(ret)
+
+    def __init__(self, vendor: str = "FA4D70", skip: int = None,
+                 configs: tuple = None, reservations: str = None):
+        # skip: container id whose own config is ignored, so recreating
+        # it keeps its addresses
+        # reservations: file shared by concurrent runs, or None
+        self.vendor = int(vendor.replace(":", "").replace("-", ""), 16)
+        self.skip = skip
+        self.reservations = reservations
+        self.configs = 0
+        self.used = 0
+        self._bits = bytearray(self.DEVICES >> 3)
+        self._cursor = 0
+        self._mutex = threading.Lock()
+        self.index(self.CONFIGS if configs is None else configs)
+        return
+
+    def index(self, patterns: tuple):
+        """Mark every MAC found in the config files matching patterns."""
+        for pattern in patterns:
+            for path in glob.glob(pattern):
+                if not self.skip is None and \
+                   os.path.basename(path) == f"{self.skip}.conf":
+                    continue
+                try:
+                    with open(path, "r") as f:
+                        text = f.read()
+                except OSError:
+                    continue
+                self.configs += 1
+                for line in text.splitlines():
+                    if line.startswith("net"):
+                        for mac in self.MAC.findall(line):
+                            self.reserve(mac)
+        return
+
+    def _isfree(self, device: int) -> bool:
+        return not self._bits[device >> 3] & (1 << (device & 7))
+
+    def _take(self, device: int):
+        self._bits[device >> 3] |= 1 << (device & 7)
+        self.used += 1
+        return
+
+    def reserve(self, mac: str) -> bool:
+        """Mark mac as used. False if it is outside our vendor prefix or
+        already taken."""
+        value = int(mac.replace(":", "").replace("-", ""), 16)
+        if value >> 24 != self.vendor:
+            return False
+        device = value & (self.DEVICES - 1)
+        if not self._isfree(device):
+            return False
+        self._take(device)
+        return True
+
+    def allocate(self, containerid: int = None, netid: int = 0) -> str:
+        """A free MAC as AA:BB:CC:DD:EE:FF, or None when the prefix is
+        exhausted."""
+        with self._mutex:
+            if self.reservations is None:
+                return self._allocate(containerid, netid)
+            os.makedirs(os.path.dirname(self.reservations) or ".",
+                        exist_ok=True)
+            with open(self.reservations, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    return self._reserved(f, containerid, netid)
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        return None
+
+    def _reserved(self, f, containerid: int, netid: int) -> str:
+        # allocate with f, the locked reservations file, read and updated
+        now = int(time.time())
+        own = None
+        if not containerid is None:
+            own = self._mac(self._derived(containerid, netid))
+        keep = []
+        f.seek(0)
+        for line in f.read().splitlines():
+            x = line.split()
+            if len(x) != 3 or not x[2].isdigit() or \
+               now - int(x[2]) > self.RESERVE:
+                continue
+            keep.append(line)
+            if x[1] != str(containerid) or x[0].upper() != own:
+                self.reserve(x[0])
+        mac = self._allocate(containerid, netid)
+        if not mac is None:
+            keep = [x for x in keep if x.split()[0] != mac]
+            keep.append(f"{mac} {containerid} {now}")
+        f.seek(0)
+        f.truncate()
+        f.write("".join(x + "\n" for x in keep))
+        f.flush()
+        return mac
+
+    @staticmethod
+    def _derived(containerid: int, netid: int) -> int:
+        return ((netid & 0xf) << 20) | (containerid % 1048575)
+
+    def _mac(self, device: int) -> str:
+        hh = "{:012X}".format((self.vendor << 24) | device)
+        return ":".join(hh[i:i + 2] for i in range(0, 12, 2))
+
+    def _allocate(self, containerid: int, netid: int) -> str:
+        device = None
+        if not containerid is None:
+            device = self._derived(containerid, netid)
+            if not self._isfree(device):
+                device = None
+        if device is None:
+            while self._cursor < len(self._bits) and \
+                  self._bits[self._cursor] == 0xff:
+                self._cursor += 1
+            if self._cursor == len(self._bits):
+                return None
+            byte = self._bits[self._cursor]
+            bit = 0
+            while byte & (1 << bit):
+                bit += 1
+            device = (self._cursor << 3) | bit
+        self._take(device)
+        return self._mac(device)
+
+
 class pvenetwork:
 
     # Class variables: shared by all instances
@@ -459,18 +1544,33 @@ class pvenetwork:
     # https://pve.proxmox.com/pve-docs/pct-plain.html
     # https://pve.proxmox.com/pve-docs/pve-admin-guide.html#pct_container_network
 
+    # Slotted: no per-instance __dict__, mass-generated configs stay small
+    __slots__ = ('_id', '_name', '_bridge', '_firewall', '_gateway',
+                 '_gateway6', '_hwaddr', '_ip', '_ip6', '_mtu', '_ratelimit',
+                 '_tagid', '_trunks', '_nettype', '_extra')
+
+    # pct.conf key of each typed attribute
+    KEYS = {'bridge': 'bridge', 'firewall': 'firewall', 'gw': 'gateway',
+            'gw6': 'gateway6', 'hwaddr': 'hwaddr', 'ip': 'ip', 'ip6': 'ip6',
+            'mtu': 'mtu', 'rate': 'ratelimit', 'tag': 'tagid',
+            'trunks': 'trunks', 'type': 'nettype'}
+
     def __init__(self, id: int = 0, name: str = 'eth', bridge: int = None,
                  firewall: str = None, gateway: ipaddress.IPv4Address = None,
                  hwaddr: str = None, ip: ipaddress.IPv4Address = 'dhcp',
                  ip6: ipaddress.IPv6Address = None, mtu: int = None,
                  ratelimit: int = None, tagid: int = None, trunks: int = None,
-                 nettype: str = 'veth'):
+                 nettype: str = 'veth',
+                 gateway6: ipaddress.IPv6Address = None):
         # Instance variables
         self._id = None
         self._name = None
         self._bridge = None
         self._firewall = None
         self._gateway = None
+        self._gateway6 = None
+        # pct.conf keys this class does not model, kept as written
+        self._extra = {}
         self._ip = None
         self._ip6 = None
         self._mtu = None
@@ -478,11 +1578,13 @@ class pvenetwork:
         self._tagid = None
         self._trunks = None
         self._nettype = None
+        self._hwaddr = None
         self.id = id
         self.name = name
         self.bridge = bridge
         self.firewall = firewall
         self.gateway = gateway
+        self.gateway6 = gateway6
         self.hwaddr = hwaddr
         self.ip = ip
         self.ip6 = ip6
@@ -496,49 +1598,113 @@ class pvenetwork:
     def __repr__(self):
         return self.__str__()
 
+    def __eq__(self, other):
+        return type(other) is type(self) and str(self) == str(other)
+
     def __str__(self):
         # target:
         # -net0 "name=eth0,bridge=vmbr0,hwaddr=FA:4D:70:91:B8:6F,ip=dhcp,type=veth"
-        ret = "-net{} \"name={}".format(self.id, self.name)
+        return "-net{} \"{}\"".format(self.id, self.options)
+
+    def _values(self) -> dict:
+        """Typed attributes as {pct.conf key: value}."""
+        ret = {}
         if not self.bridge is None:
-            ret = ret + ",bridge=vmbr{}".format(self.bridge)
+            ret['bridge'] = "vmbr{}".format(self.bridge)
         if not self.firewall is None:
-            if self.firewall:
-                ret = ret + ",firewall=1"
-            else:
-                ret = ret + ",firewall=0"
+            ret['firewall'] = pve.pvebool(self.firewall)
         if not self.gateway is None:
-            ret = ret + ",gateway{}={}"
-            if self.gateway.version == 4:
-                ret = ret.format('', self.gateway.exploded)
-            else:
-                ret = ret.format('6', self.gateway.exploded)
+            ret['gw'] = str(self.gateway)
+        if not self.gateway6 is None:
+            ret['gw6'] = str(self.gateway6)
         if not self.hwaddr is None:
-            ret = ret + ",hwaddr={}".format(self.hwaddr)
+            ret['hwaddr'] = self.hwaddr
         if not self.ip is None:
-            if type(self.ip) is str:
-                ret = ret + ",ip={}".format(self.ip)
-            else:
-                ret = ret + ",ip={}".format(self.ip.exploded)
+            ret['ip'] = str(self.ip)
         if not self.ip6 is None:
-            if type(self.ip6) is str:
-                ret = ret + ",ip6={}".format(self.ip6)
-            else:
-                ret = ret + ",ip6={}".format(self.ip6.exploded)
+            ret['ip6'] = str(self.ip6)
         if not self.mtu is None:
-            ret = ret + ",mtu={}".format(self.mtu)
+            ret['mtu'] = str(self.mtu)
         if not self.ratelimit is None:
-            ret = ret + ",rate={}".format(self.ratelimit)
+            ret['rate'] = str(self.ratelimit)
         if not self.tagid is None:
-            ret = ret + ",tagid={}".format(self.tagid)
+            ret['tag'] = str(self.tagid)
         if not self.trunks is None:
-            ret = ret + ",trunks={}".format(self.trunks)
+            ret['trunks'] = self.trunks
         if not self.nettype is None:
-            ret = ret + ",type={}".format(self.nettype)
-        ret = ret + "\""
+            ret['type'] = self.nettype
+        return ret
+
+    @property
+    def options(self) -> str:
+        """Option value as pct writes it to pct.conf, without -net<id>:
+        name first, then the other keys sorted."""
+        values = self._values()
+        values.update(self._extra)
+        ret = ["name={}".format(self.name)]
+        for key in sorted(values):
+            ret.append("{}={}".format(key, values[key]))
+        return ",".join(ret)
+
+    @classmethod
+    def parse(cls, text: str):
+        """Inverse of str()/options: build a pvenetwork from a pct option
+        string in command line or pct.conf form. A value the typed
+        attributes cannot reproduce exactly, and any key they do not
+        know, is kept as written."""
+        index, text = pve.option(text, "net")
+        fields = dict(x.partition("=")[::2] for x in text.split(",") if x)
+        ret = cls(id=index, name=fields.get('name', 'eth'), ip=None)
+        for key, val in fields.items():
+            attr = cls.KEYS.get(key)
+            if attr is None:
+                continue
+            if key == 'bridge':
+                if val.startswith("vmbr") and val[4:].isdigit():
+                    val = int(val[4:])
+            elif key == 'firewall':
+                val = pve.bool(val)
+            elif key in ('mtu', 'rate', 'tag') and val.isdigit():
+                val = int(val)
+            setattr(ret, attr, val)
+        values = ret._values()
+        for key, val in fields.items():
+            if key == 'name':
+                if ret.name != val:
+                    ret._name = val
+            elif not key in cls.KEYS:
+                ret._extra[key] = val
+            elif values.get(key) != val:
+                if key != 'type':
+                    setattr(ret, cls.KEYS[key], None)
+                ret._extra[key] = val
+        return ret
+
+    def merged(self, live):
+        """live with every attribute set on self applied on top. Keys
+        self does not set and the live hwaddr are kept; a new ip or ip6
+        takes self's gateway with it."""
+        ret = type(self).parse(str(live))
+        values = live._values()
+        values.update(live._extra)
+        for key, attr in self.KEYS.items():
+            val = getattr(self, attr)
+            if val is None or (key == 'hwaddr' and key in values):
+                continue
+            setattr(ret, attr, val)
+            ret._extra.pop(key, None)
+        for ip, gw, attr in (('ip', 'gw', 'gateway'),
+                             ('ip6', 'gw6', 'gateway6')):
+            if ret._values().get(ip) != values.get(ip):
+                setattr(ret, attr, getattr(self, attr))
+                ret._extra.pop(gw, None)
         return ret
 
-    def gethwaddr(self, containerid: int) -> str:
+    def gethwaddr(self, containerid: int,
+                  macs: macallocator = None) -> str:
+        if not macs is None:
+            self.hwaddr = macs.allocate(containerid, self.id)
+            return self.hwaddr
         vendor = 'fa4d70'
         device = hex(containerid % 1048575).partition('x')[2].rjust(5, '0')
         self.hwaddr = "{}{}{}".format(vendor, self.id, device)
@@ -551,15 +1717,15 @@ class pvenetwork:
         # hwaddr default should be fa4d70TUUUUU
         # where T is the net<id> and UUUUU is the modulus of
         # containerid and 1048575 in hex
-        print("type(self.hwaddr){}, type(containerid): {}".format(self.hwaddr,
-                                                                  containerid))
+        pprint.dp("type(self.hwaddr){}, type(containerid): {}", self.hwaddr,
+                  containerid)
         if type(self.hwaddr) is None and type(containerid) is int:
             vendor = 'fa4d70'
-            print("vendor: {}".format(vendor))
+            pprint.dp("vendor: {}", vendor)
             device = hex(containerid % 1048575).partition('x')[2].rjust(5, '0')
-            print("device: {}".format(device))
+            pprint.dp("device: {}", device)
             self.hwaddr = "{}{}{}".format(vendor, self.id, device)
-            print("{}{}{}".format(vendor, self.id, device))
+            pprint.dp("{}{}{}", vendor, self.id, device)
         if type(self.ip) is None and type(self.ip6) is None:
             self.ip = "dhcp"
         if self.name[0:3] == "eth" and int(self.name[3:]) != self.id:
@@ -637,9 +1803,10 @@ class pvenetwork:
     def ip6(self, ip6):
         if type(ip6) is str:
             try:
-                self._ip6 = ipaddress.ip_address(ip6)
+                # an interface keeps the prefix, e.g. 2001:db8::5/64
+                self._ip6 = ipaddress.ip_interface(ip6)
                 if self._ip6.version == 4:
-                    self._ip4 = self._ip6
+                    self.ip = ip6
                     self._ip6 = None
                 return
             except:
@@ -660,7 +1827,8 @@ class pvenetwork:
     @ip.setter
     def ip(self, ip):
         try:
-            self._ip = ipaddress.IPv4Network(ip)
+            # an interface keeps the host address, e.g. 10.0.0.5/24
+            self._ip = ipaddress.IPv4Interface(ip)
         except:
             valid = ['dhcp', 'manual']
             if ip in valid:
@@ -708,9 +1876,26 @@ class pvenetwork:
     @gateway.setter
     def gateway(self, gateway):
         try:
-            self._gateway = ipaddress.ip_address(gateway)
+            gateway = ipaddress.ip_address(gateway)
         except:
             self._gateway = None
+            return
+        if gateway.version == 6:
+            self._gateway = None
+            self.gateway6 = gateway
+        else:
+            self._gateway = gateway
+
+    @property
+    def gateway6(self):
+        return self._gateway6
+
+    @gateway6.setter
+    def gateway6(self, gateway6):
+        try:
+            self._gateway6 = ipaddress.IPv6Address(gateway6)
+        except:
+            self._gateway6 = None
 
     @property
     def firewall(self):
@@ -770,37 +1955,109 @@ class pvenetwork:
 class pvemountpoint:
     # https://pve.proxmox.com/pve-docs/pve-admin-guide.html#pct_mount_points
 
+    # Also models the rootfs: line, which has the same format without mp.
+
+    __slots__ = ('_id', '_acl', '_backup', '_mp', '_quota', '_replicate',
+                 '_ro', '_shared', '_size', '_volume', '_mountoptions',
+                 '_rootfs', '_extra')
+
+    # boolean options, in the order they are written
+    FLAGS = ('acl', 'backup', 'quota', 'replicate', 'ro', 'shared')
+
     def __repr__(self) -> str:
         return self.__str__()
 
+    def __eq__(self, other):
+        return type(other) is type(self) and str(self) == str(other)
+
     def __str__(self) -> str:
         # mp[n]: [volume=]<volume> ,mp=<Path> [,acl=<1|0>] [,backup=<1|0>]
         # [,mountoptions=<opt[;opt...]>] [,quota=<1|0>] [,replicate=<1|0>]
         # [,ro=<1|0>] [,shared=<1|0>] [,size=<DiskSize>]
         # "-mp0 \"{share},mp=/root/shared,ro=0\""
-        ret: str = "-mp{} \"volume={}".format(self.id, self.volume)
-        ret = "{},mp={}".format(ret, self.mp)
-        if not self.acl is None:
-            ret = "{},acl={}".format(ret, pve().pvebool(self.acl))
-        if not self.backup is None:
-            ret = "{},backup={}".format(ret, pve().pvebool(self.backup))
-        if not self.quota is None:
-            ret = "{},quota={}".format(ret, pve().pvebool(self.quota))
-        if not self.replicate is None:
-            ret = "{},replicate={}".format(ret, pve().pvebool(self.replicate))
-        if not self.ro is None:
-            ret = "{},ro={}".format(ret, pve().pvebool(self.ro))
-        if not self.shared is None:
-            ret = "{},shared={}".format(ret, pve().pvebool(self.shared))
+        if self.rootfs:
+            return "-rootfs \"{}\"".format(self.options)
+        return "-mp{} \"{}\"".format(self.id, self.options)
+
+    def _values(self) -> dict:
+        """Typed optional attributes as {pct.conf key: value}."""
+        ret = {}
+        for x in self.FLAGS:
+            val = getattr(self, x)
+            if not val is None:
+                ret[x] = pve.pvebool(val)
+        if not self.mountoptions is None:
+            ret['mountoptions'] = self.mountoptions
         if not self.size is None:
-            ret = "{},size={}".format(ret, self.size)
-        ret = ret + "\""
+            ret['size'] = str(self.size)
+        return ret
+
+    @property
+    def options(self) -> str:
+        """Option value as pct writes it to pct.conf, without -mp<id>:
+        the volume, mp, then the other keys sorted."""
+        values = self._values()
+        values.update(self._extra)
+        ret = [str(self.volume)]
+        if not self.rootfs:
+            ret.append("mp={}".format(self.mp))
+        for key in sorted(values):
+            ret.append("{}={}".format(key, values[key]))
+        return ",".join(ret)
+
+    @classmethod
+    def parse(cls, text: str):
+        """Inverse of str()/options: build a pvemountpoint from a pct option
+        string in command line or pct.conf form, mp<n> or rootfs. Values
+        the typed attributes cannot reproduce exactly, and unknown keys,
+        are kept as written."""
+        rootfs = text.strip().lstrip("-").startswith("rootfs")
+        if rootfs:
+            text = text.strip().lstrip("-")[len("rootfs"):].lstrip(": ")
+            if len(text) > 1 and text[0] == text[-1] == "\"":
+                text = text[1:-1]
+            index = None
+        else:
+            index, text = pve.option(text, "mp")
+        ret = cls(id=0 if index is None else index)
+        ret.rootfs = rootfs
+        fields = {}
+        for x in text.split(","):
+            key, sep, val = x.partition("=")
+            if not sep:
+                # the volume may be given without its key, first only
+                ret.volume = key
+            elif key == "volume" or key == "mp":
+                setattr(ret, key, val)
+            else:
+                fields[key] = val
+        for key, val in fields.items():
+            if key in cls.FLAGS or key in ("mountoptions", "size"):
+                setattr(ret, key, val)
+        values = ret._values()
+        for key, val in fields.items():
+            if values.get(key) != val:
+                if key in cls.FLAGS or key in ("mountoptions", "size"):
+                    setattr(ret, key, None)
+                ret._extra[key] = val
+        return ret
+
+    def merged(self, live):
+        """live with every attribute set on self applied on top; keys
+        self does not set are kept."""
+        ret = type(self).parse(str(live))
+        for key in ("volume", "mp", "mountoptions", "size") + self.FLAGS:
+            val = getattr(self, key)
+            if not val is None:
+                setattr(ret, key, val)
+                ret._extra.pop(key, None)
         return ret
 
     def __init__(self, id: int = 0, acl: bool = None, backup: bool = None,
                  mp: str = None, quota: bool = None, replicate: bool = None,
                  ro: bool = None, shared: bool = None, size: int = None,
-                 volume: str = None):
+                 volume: str = None, mountoptions: str = None,
+                 rootfs: bool = False):
         self._id = None
         self._acl = None
         self._backup = None
@@ -811,6 +2068,10 @@ class pvemountpoint:
         self._shared = None
         self._size = None
         self._volume = None
+        self._mountoptions = None
+        self._rootfs = False
+        # pct.conf keys this class does not model, kept as written
+        self._extra = {}
         self.id = id
         self.acl = acl
         self.backup = backup
@@ -821,6 +2082,28 @@ class pvemountpoint:
         self.shared = shared
         self.size = size
         self.volume = volume
+        self.mountoptions = mountoptions
+        self.rootfs = rootfs
+        return
+
+    @property
+    def rootfs(self) -> bool:
+        """True for the rootfs: line instead of an mp<n>: line."""
+        return self._rootfs
+
+    @rootfs.setter
+    def rootfs(self, rootfs: bool):
+        self._rootfs = bool(rootfs)
+        return
+
+    @property
+    def mountoptions(self) -> str:
+        """Mount options separated by ;, e.g. noatime;nodev."""
+        return self._mountoptions
+
+    @mountoptions.setter
+    def mountoptions(self, mountoptions: str):
+        self._mountoptions = mountoptions or None
         return
 
     @property
@@ -847,7 +2130,7 @@ class pvemountpoint:
 
     @shared.setter
     def shared(self, shared: bool):
-        self._shared = pve().bool(shared)
+        self._shared = pve.bool(shared)
         return
 
     @property
@@ -856,7 +2139,7 @@ class pvemountpoint:
 
     @ro.setter
     def ro(self, ro: bool):
-        self._ro = pve().bool(ro)
+        self._ro = pve.bool(ro)
         return
 
     @property
@@ -865,7 +2148,7 @@ class pvemountpoint:
 
     @replicate.setter
     def replicate(self, replicate: bool):
-        self._replicate = pve().bool(replicate)
+        self._replicate = pve.bool(replicate)
         return
 
     @property
@@ -874,7 +2157,7 @@ class pvemountpoint:
 
     @quota.setter
     def quota(self, quota: bool):
-        self._quota = pve().bool(quota)
+        self._quota = pve.bool(quota)
         return
 
     @property
@@ -892,7 +2175,7 @@ class pvemountpoint:
 
     @backup.setter
     def backup(self, backup: bool):
-        self._backup = pve().bool(backup)
+        self._backup = pve.bool(backup)
         return
 
     @property
@@ -901,7 +2184,7 @@ class pvemountpoint:
 
     @acl.setter
     def acl(self, acl: bool):
-        self._acl = pve().bool(acl)
+        self._acl = pve.bool(acl)
         return
 
     @property
@@ -926,25 +2209,50 @@ class pvemountpoint:
 
 
 class pve:
+    # Stateless helpers; callable as pve().x() or pve.x()
+    __slots__ = ()
 
     def __init__(self):
         pass
 
-    def bool(self, var) -> bool:
-        var = self.pvebool(var)
+    @staticmethod
+    def bool(var) -> bool:
+        var = pve.pvebool(var)
         if var == "1": return True
         elif var == "0": return False
         return None
 
-    def isbool(self, var) -> bool:
-        var = self.pvebool(var)
+    @staticmethod
+    def isbool(var) -> bool:
+        var = pve.pvebool(var)
         if var == "1" or var == "0":
             return True
         else:
             return False
         return None # this will never happen. IDE sugar only.
 
-    def pvebool(self, var) -> str:
+    @staticmethod
+    def option(text: str, prefix: str) -> tuple:
+        """Split an indexed pct option into (index, value). Accepts the
+        command line form (-net0 "name=eth0,...") and the pct.conf form
+        (net0: name=eth0,...); a bare value gets index None."""
+        text = text.strip()
+        if text.startswith("-"):
+            text = text[1:]
+        index = None
+        if text.startswith(prefix) and text[len(prefix):len(prefix) + 1] \
+           .isdigit():
+            head, sep, value = text.partition(":")
+            if not sep or " " in head:
+                head, _, value = text.partition(" ")
+            index = int(head[len(prefix):])
+            text = value.strip()
+        if len(text) > 1 and text[0] == text[-1] == "\"":
+            text = text[1:-1]
+        return index, text
+
+    @staticmethod
+    def pvebool(var) -> str:
         v = var
         t = type(v)  # t for Type
         if t is str or t is bool or t is int:
@@ -955,37 +2263,1636 @@ class pve:
         return None
 
 
-class lxc:
-    # "pct create {id} \"{tmpl}\" -storage {storage} -memory {ram} "
-    #      "-net0 \"name=eth0,bridge=vmbr{bridge},hwaddr=FA:4D:70:91:B8:6F,"
-    #      "ip=dhcp,type=veth\" -hostname buildr -cores {cores} -rootfs 80 "
-    #      "-mp0 \"{share},mp=/root/shared,ro=0\""
+class aptcache:
+    # Host side apt archive shared by all build containers.
+    # The directory is bind mounted over /var/cache/apt/archives in each
+    # container, so a package downloaded once is reused by every later
+    # provisioning run. apt's own archive lock does not wait for other
+    # containers, so the bootstrap scripts wrap apt-get in flock(1) on a
+    # lock file inside the shared directory.
+    TARGET = "/var/cache/apt/archives"
+    LOCKFILE = ".rmrr-lock"
 
-    # documenting new lxc design
-    # prop: net = pvenetwork or List[of pvenetwork] or None
-    # prop: mp = pvemountpoint or List[of pvemountpoint] or None
-    # prop: rootfs = pvemountpoint or None out=reqd
-    # prop: hostname = str or None
-    # prop: id = int; valid from 0 - 4094 or None out=reqd
-    # prop: sshkey = str or None or List[of str]?
-    # prop: privileged = bool or None
-    # prop: cores = int or None
-    # prop: cpulimit = decimal or None
-    # prop: cpuunits = int; pve default is 1024
-    # prop: onboot = bool or None(inherit); start at boot?; default False
-    # prop: bootorder = int > 0; default None
-    # prop: bootdelay = int > 0 or None; seconds
-    # prop: deadtimeout = int > 0 or None; pve default is 60; seconds to wait
-    #       after shutting down container before the shutdown action is
-    #       reported as 'failed'
-    # prop: description = str or None
-    # prop: nesting = bool or None (nesting VM)
-    # prop: keyctl = bool or None
-    # prop: fuse = bool or None
-    # prop: force = bool, default false. may not implement
-    # prop: memory = int or None (use PVE default). ram in MB
-    # prop: ostype = str [alpine|archlinux|centos|debian|fedora|gentoo|
-    # prop:               opensuse|ubuntu|unmanaged] or None(inherit)
+    def __repr__(self):
+        ret = {}
+        ret['volume'] = self.volume
+        ret['packages'] = self.packages
+        ret['size'] = self.size
+        return str(ret)
+
+    def __init__(self, volume: str = None, id: int = 1):
+        self._volume = None
+        self._id = id
+        self.volume = volume
+        return
+
+    @property
+    def volume(self) -> str:
+        """Host directory holding the shared .deb files."""
+        return self._volume
+
+    @volume.setter
+    def volume(self, volume: str):
+        if volume is None:
+            volume = f"{root_path}/aptcache"
+        self._volume = os.path.realpath(volume)
+        return
+
+    @property
+    def lockfile(self) -> str:
+        """Lock file path as seen from inside the container."""
+        return f"{self.TARGET}/{self.LOCKFILE}"
+
+    @property
+    def mountpoint(self) -> pvemountpoint:
+        """Bind mount of the cache for lxc.mp."""
+        return pvemountpoint(id=self._id, volume=self.volume, mp=self.TARGET,
+                             backup=0, ro=0)
+
+    @property
+    def packages(self) -> int:
+        """Number of cached .deb files."""
+        if not os.path.isdir(self.volume):
+            return 0
+        return sum(1 for x in os.scandir(self.volume)
+                   if x.name.endswith(".deb"))
+
+    @property
+    def size(self) -> int:
+        """Size of the cached .deb files in MB."""
+        if not os.path.isdir(self.volume):
+            return 0
+        return sum(x.stat().st_size for x in os.scandir(self.volume)
+                   if x.name.endswith(".deb")) // (1024 * 1024)
+
+    def prepare(self) -> bool:
+        """Create the cache layout apt expects. Returns False if the path
+        exists but is not a directory."""
+        if os.path.exists(self.volume) and not os.path.isdir(self.volume):
+            return False
+        os.makedirs(f"{self.volume}/partial", exist_ok=True)
+        # _apt inside the container downloads into partial/
+        os.chmod(f"{self.volume}/partial", 0o777)
+        lock = f"{self.volume}/{self.LOCKFILE}"
+        if not os.path.exists(lock):
+            open(lock, "a").close()
+            os.chmod(lock, 0o666)
+        return True
+
+    @property
+    def aptconf(self) -> str:
+        """apt.conf snippet that stops apt from cleaning the shared
+        archive after installing."""
+        return ("APT::Keep-Downloaded-Packages \"true\";\n"
+                "Binary::apt::APT::Keep-Downloaded-Packages \"true\";\n")
+
+
+class resourceplan:
+    # Size the build container from what the host can actually spare.
+    # Reads /proc/meminfo, /proc/loadavg, the cgroup (v2 or v1) limits of
+    # the process running this script and the free space of the target
+    # storage, then derives cores, ram, rootfs size and the make -j level
+    # from a per compile job memory model.
+    #
+    # Memory model (MB):
+    #   ram = MEM_BASE + jobs * MEM_PER_JOB
+    # Disk model (GB):
+    #   fssize = DISK_BASE + jobs * DISK_PER_JOB, capped by free space
+    MEM_PER_JOB = 512       # resident size of a heavy cc1 job, MB
+    MEM_BASE = 1024         # container os, make, ld and page cache, MB
+    MEM_RESERVE = 2048      # always left to the host, MB
+    DISK_BASE = 40          # sources, objects and packages, GB
+    DISK_PER_JOB = 0.25     # temp files per parallel job, GB
+    DISK_RESERVE = 5        # always left free on the storage, GB
+    DISK_MAX = 80           # historical fixed rootfs size, GB
+    STORAGE_CFG = "/etc/pve/storage.cfg"
+
+    def __repr__(self):
+        ret = {}
+        ret['host_cpus'] = self.host_cpus
+        ret['loadavg'] = self.loadavg
+        ret['mem_available'] = self.mem_available
+        ret['storage_free'] = self.storage_free
+        ret['cores'] = self.cores
+        ret['ram'] = self.ram
+        ret['fssize'] = self.fssize
+        ret['jobs'] = self.jobs
+        return str(ret)
+
+    def __str__(self):
+        ret = "Resource plan\n"
+        ret = ret + "host_cpus:".rjust(15, " ")
+        ret = ret + " {}\n".format(self.host_cpus)
+        ret = ret + "loadavg:".rjust(15, " ") + " {}\n".format(self.loadavg)
+        ret = ret + "mem_available:".rjust(15, " ")
+        ret = ret + " {} MB\n".format(self.mem_available)
+        ret = ret + "storage_free:".rjust(15, " ")
+        free = self.storage_free
+        ret = ret + " {}\n".format("unknown" if free is None else
+                                   "{} GB".format(free))
+        ret = ret + "cores:".rjust(15, " ") + " {}\n".format(self.cores)
+        ret = ret + "ram:".rjust(15, " ") + " {} MB\n".format(self.ram)
+        ret = ret + "fssize:".rjust(15, " ") + " {} GB\n".format(self.fssize)
+        ret = ret + "jobs:".rjust(15, " ") + " {}\n".format(self.jobs)
+        return ret
+
+    def __init__(self, storage: str = "local-lvm", cores: int = None,
+                 ram: int = None, fssize: int = None, jobs: int = None):
+        # cores, ram (GB), fssize (GB) and jobs override the planned value
+        # when given; everything else is derived from the host.
+        self._storage = storage
+        self._want_cores = cores
+        self._want_ram = ram
+        self._want_fssize = fssize
+        self._want_jobs = jobs
+        self._host_cpus = None
+        self._loadavg = None
+        self._mem_available = None
+        self._storage_free = None
+        self._cores = None
+        self._ram = None
+        self._fssize = None
+        self._jobs = None
+        self.plan()
+        return
+
+    @staticmethod
+    def _readfile(path: str) -> str:
+        try:
+            with open(path, 'r') as f:
+                return f.read().strip()
+        except (OSError, ValueError):
+            return None
+
+    def _cgroup_cpus(self) -> float:
+        # cpu quota of our cgroup in cpus, or None if unlimited
+        val = self._readfile("/sys/fs/cgroup/cpu.max")
+        if val:
+            quota, _, period = val.partition(" ")
+            if quota != "max" and period:
+                return int(quota) / int(period)
+            return None
+        quota = self._readfile("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+        period = self._readfile("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+        if quota and period and int(quota) > 0:
+            return int(quota) / int(period)
+        return None
+
+    def _cgroup_mem(self) -> int:
+        # memory left under our cgroup limit in MB, or None if unlimited
+        limit = self._readfile("/sys/fs/cgroup/memory.max")
+        used = self._readfile("/sys/fs/cgroup/memory.current")
+        if limit is None:
+            v1 = "/sys/fs/cgroup/memory"
+            limit = self._readfile(f"{v1}/memory.limit_in_bytes")
+            used = self._readfile(f"{v1}/memory.usage_in_bytes")
+        if limit is None or limit == "max":
+            return None
+        limit = int(limit)
+        # v1 reports "unlimited" as a huge page aligned number
+        if limit >= 1 << 60:
+            return None
+        used = int(used) if used else 0
+        return max(limit - used, 0) // (1024 * 1024)
+
+    @property
+    def host_cpus(self) -> int:
+        """Cpus this process may run on, limited by affinity and cgroup."""
+        if not self._host_cpus is None:
+            return self._host_cpus
+        try:
+            c = len(os.sched_getaffinity(0))
+        except AttributeError:
+            c = multiprocessing.cpu_count()
+        quota = self._cgroup_cpus()
+        if not quota is None:
+            c = min(c, max(int(quota), 1))
+        self._host_cpus = c
+        return self._host_cpus
+
+    @property
+    def loadavg(self) -> float:
+        """1 minute load average of the host."""
+        if not self._loadavg is None:
+            return self._loadavg
+        val = self._readfile("/proc/loadavg")
+        self._loadavg = float(val.split()[0]) if val else 0.0
+        return self._loadavg
+
+    @property
+    def mem_available(self) -> int:
+        """Memory available for new work in MB, MemAvailable or the cgroup
+        headroom, whichever is lower."""
+        if not self._mem_available is None:
+            return self._mem_available
+        avail = None
+        val = self._readfile("/proc/meminfo")
+        if val:
+            for x in val.splitlines():
+                if x.startswith("MemAvailable:"):
+                    avail = int(x.split()[1]) // 1024
+                    break
+        if avail is None:
+            avail = 4 * 1024
+        cg = self._cgroup_mem()
+        if not cg is None:
+            avail = min(avail, cg)
+        self._mem_available = avail
+        return self._mem_available
+
+    @property
+    def storage(self) -> str:
+        return self._storage
+
+    def _storage_cfg(self) -> tuple:
+        # (type, {option: value}) of our storage in storage.cfg, or None
+        val = self._readfile(self.STORAGE_CFG)
+        if val is None:
+            return None
+        ret = None
+        inside = False
+        for x in val.splitlines():
+            if not x.strip() or x.lstrip().startswith("#"):
+                continue
+            if not x[0].isspace():
+                kind, _, name = x.partition(":")
+                inside = name.strip() == self._storage
+                if inside:
+                    ret = (kind.strip(), {})
+            elif inside:
+                key, _, value = x.strip().partition(" ")
+                ret[1][key] = value.strip()
+        return ret
+
+    def _storage_bytes(self) -> int:
+        # free bytes of our storage from its definition, or None
+        cfg = self._storage_cfg()
+        if cfg is None:
+            return None
+        kind, opts = cfg
+        if 'path' in opts and os.path.isdir(opts['path']):
+            st = os.statvfs(opts['path'])
+            return st.f_bavail * st.f_frsize
+        if kind == "lvmthin" and 'vgname' in opts and 'thinpool' in opts:
+            res = sp_run(["lvs", "--noheadings", "--units", "b",
+                          "--nosuffix", "-o", "lv_size,data_percent",
+                          f"{opts['vgname']}/{opts['thinpool']}"])
+            cols = res.stdout.split() if res.returncode == 0 else []
+            if len(cols) == 2:
+                return int(float(cols[0]) * (1 - float(cols[1]) / 100))
+        elif kind == "lvm" and 'vgname' in opts:
+            res = sp_run(["vgs", "--noheadings", "--units", "b",
+                          "--nosuffix", "-o", "vg_free", opts['vgname']])
+            if res.returncode == 0 and res.stdout.strip().isdigit():
+                return int(res.stdout.strip())
+        return None
+
+    @property
+    def storage_free(self) -> int:
+        """Free space on the container storage in GB, or None if it
+        cannot be determined."""
+        if not self._storage_free is None:
+            return self._storage_free
+        free = None
+        res = sp_run(f"pvesm status -storage {self._storage}")
+        if res.returncode == 0:
+            lines = res.stdout.splitlines()
+            if len(lines) > 1:
+                # Name Type Status Total Used Available %
+                cols = lines[1].split()
+                if len(cols) > 5 and cols[5].isdigit():
+                    free = int(cols[5]) // (1024 * 1024)
+        if free is None:
+            # no pvesm; ask the storage behind the definition itself
+            free = self._storage_bytes()
+            if not free is None:
+                free = free // (1024 ** 3)
+        self._storage_free = free
+        return self._storage_free
+
+    def plan(self):
+        """(Re)compute cores, ram, fssize and jobs from host state."""
+        self._host_cpus = None
+        self._loadavg = None
+        self._mem_available = None
+        self._storage_free = None
+        # cpus nobody else is using right now
+        idle = max(self.host_cpus - int(self.loadavg + 0.5), 1)
+        if not self._want_cores is None and self._want_cores > 0:
+            cores = min(self._want_cores, self.host_cpus)
+        else:
+            cores = idle
+        # jobs that fit in memory without swapping
+        budget = self.mem_available - self.MEM_RESERVE
+        if not self._want_ram is None and self._want_ram > 0:
+            budget = int(self._want_ram * 1024)
+        fit = max((budget - self.MEM_BASE) // self.MEM_PER_JOB, 1)
+        planned = max(min(cores, fit), 1)
+        if not self._want_jobs is None and self._want_jobs > 0:
+            jobs = self._want_jobs
+        else:
+            jobs = planned
+        # do not hand out cores that would only sit idle waiting for
+        # memory; an explicit job count does not change what the host
+        # can spare
+        if self._want_cores is None:
+            cores = planned
+        if not self._want_ram is None and self._want_ram > 0:
+            ram = int(self._want_ram * 1024)
+        else:
+            ram = self.MEM_BASE + jobs * self.MEM_PER_JOB
+        if not self._want_fssize is None and self._want_fssize > 0:
+            fssize = int(self._want_fssize)
+        else:
+            fssize = int(self.DISK_BASE + jobs * self.DISK_PER_JOB + 0.5)
+            fssize = min(fssize, self.DISK_MAX)
+            free = self.storage_free
+            if not free is None:
+                fssize = min(fssize, max(free - self.DISK_RESERVE, 0))
+        self._cores = cores
+        self._ram = ram
+        self._fssize = fssize
+        self._jobs = jobs
+        return self
+
+    @property
+    def cores(self) -> int:
+        """Cores for the build container."""
+        return self._cores
+
+    @property
+    def ram(self) -> int:
+        """Memory for the build container in MB."""
+        return self._ram
+
+    @property
+    def fssize(self) -> int:
+        """Rootfs size for the build container in GB."""
+        return self._fssize
+
+    @property
+    def jobs(self) -> int:
+        """Parallel jobs for make -j."""
+        return self._jobs
+
+    @property
+    def fits(self) -> bool:
+        """False if the rootfs is too small for even a minimal build."""
+        return self.fssize >= self.DISK_BASE
+
+
+class buildprofile:
+    # Which binary packages a build produces. 'full' is the stock
+    # pve-kernel make (dpkg-buildpackage with dpkg_opts). 'image' builds
+    # only the pve-kernel-<ver> package: the .install_mark target of
+    # debian/rules, then the debhelper steps of its binary target limited
+    # to that package with -p. Headers, tools and the architecture
+    # independent packages are not built, so Build-Depends-Indep and the
+    # documentation and tool extras are not installed. pve-kernel's
+    # debian/control has no build profiles, its Build-Depends all stay.
+    PROFILES = {
+        'full': {
+            'dpkg_opts': "-b",
+            'extra': ("build-essential, patch, debhelper, "
+                      "libpve-common-perl, pve-kernel-5.3, "
+                      "pve-doc-generator, git"),
+        },
+        'image': {
+            'dpkg_opts': "",
+            'extra': ("build-essential, patch, debhelper, "
+                      "pve-kernel-5.3, git"),
+        },
+    }
+
+    def __repr__(self):
+        return f"buildprofile('{self.name}')"
+
+    def __str__(self):
+        return self.name
+
+    def __init__(self, name: str = "full"):
+        if not name in self.PROFILES:
+            raise ValueError("unknown build profile '{}', expected one of "
+                             "{}".format(name, ", ".join(self.PROFILES)))
+        self._name = name
+        self._p = self.PROFILES[name]
+        return
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def full(self) -> bool:
+        """True for the stock pve-kernel build."""
+        return self._name == "full"
+
+    @property
+    def dpkg_opts(self) -> str:
+        """dpkg-buildpackage options; empty for the image-only build,
+        which does not run dpkg-buildpackage."""
+        return self._p['dpkg_opts']
+
+    @property
+    def indep(self) -> bool:
+        """True if the architecture independent packages are built, so
+        Build-Depends-Indep is needed."""
+        return self.full
+
+    @property
+    def extra(self) -> str:
+        """Build dependencies missing from debian/control.in."""
+        return self._p['extra']
+
+
+class buildtree:
+    # Prepared pve-kernel build tree kept on the shared volume between
+    # runs. build.sh records the kernel.git_hash and patch checksum the
+    # tree was last built from in buildtree.conf and appends each build's
+    # duration to build-times.log, so full and incremental builds can be
+    # compared.
+
+    def __repr__(self):
+        ret = {}
+        ret['path'] = self.path
+        ret['ksrc'] = self.ksrc
+        ret['prepared'] = self.prepared
+        ret['tree_git_hash'] = self.tree_git_hash
+        ret['mode'] = self.mode
+        return str(ret)
+
+    def __init__(self, shared_dir: str, target_kernel: kernel = None,
+                 mode: str = None):
+        # mode: 'full', 'incremental' or None to pick from the tree state
+        self._shared_dir = shared_dir
+        self._kernel = target_kernel
+        self._mode = mode
+        self._state = None
+        return
+
+    @property
+    def path(self) -> str:
+        """pve-kernel checkout on the host side of the shared volume."""
+        return f"{self._shared_dir}/git/pve-kernel"
+
+    @property
+    def statefile(self) -> str:
+        return f"{self._shared_dir}/git/buildtree.conf"
+
+    @property
+    def timesfile(self) -> str:
+        return f"{self._shared_dir}/build-times.log"
+
+    @property
+    def objectsfile(self) -> str:
+        return f"{self._shared_dir}/build-objects.log"
+
+    def objects(self, mode: str = None) -> int:
+        """Expected number of compiled objects for a mode build: the
+        count recorded for the last such build (of the same commit if
+        there is one), else for a full build the objects a previous
+        build left in the tree. None if unknown."""
+        mode = self.mode if mode is None else mode
+        git_hash = None if self._kernel is None else self._kernel.git_hash
+        last = None
+        same = None
+        if os.path.isfile(self.objectsfile):
+            with open(self.objectsfile, "r") as f:
+                for x in f:
+                    x = x.split()
+                    if len(x) == 4 and x[1] == mode and x[3].isdigit():
+                        last = int(x[3])
+                        if x[2] == git_hash:
+                            same = last
+        if not same is None:
+            return same
+        if not last is None:
+            return last
+        if mode != "full" or self.ksrc is None:
+            return None
+        count = 0
+        for root, dirs, files in os.walk(f"{self.path}/build/{self.ksrc}"):
+            count += sum(1 for x in files if x.endswith(".o"))
+        return count or None
+
+    def record_objects(self, mode: str, git_hash: str, count: int):
+        """Append the object count of a finished build."""
+        with open(self.objectsfile, "a") as f:
+            f.write("{} {} {} {}\n".format(int(time.time()), mode, git_hash,
+                                           count))
+        return
+
+    @property
+    def ksrc(self) -> str:
+        """KERNEL_SRC from the pve-kernel Makefile, e.g. ubuntu-eoan."""
+        return makefile_var(f"{self.path}/Makefile", "KERNEL_SRC")
+
+    @property
+    def prepared(self) -> bool:
+        """True if a previous build left a patched kernel tree behind."""
+        ksrc = self.ksrc
+        if ksrc is None:
+            return False
+        return os.path.isfile(f"{self.path}/build/{ksrc}/Makefile")
+
+    @property
+    def state(self) -> dict:
+        """Contents of buildtree.conf as a dict."""
+        if not self._state is None:
+            return self._state
+        self._state = {}
+        if os.path.isfile(self.statefile):
+            with open(self.statefile, "r") as f:
+                for x in f:
+                    key, sep, val = x.strip().partition("=")
+                    if sep:
+                        self._state[key] = val.strip("\"")
+        return self._state
+
+    @property
+    def tree_git_hash(self) -> str:
+        """pve-kernel commit the prepared tree was built from."""
+        return self.state.get("tree_git_hash") or None
+
+    @property
+    def current(self) -> bool:
+        """True if the prepared tree already matches the target kernel."""
+        if self._kernel is None or not self.prepared:
+            return False
+        return self.tree_git_hash == self._kernel.git_hash
+
+    @property
+    def mode(self) -> str:
+        """'incremental' only for a prepared tree of the target commit;
+        another commit brings its own debian/ and module sources, which
+        only a full build prepares."""
+        if not self._mode is None:
+            return self._mode
+        if self.current:
+            return "incremental"
+        return "full"
+
+    @mode.setter
+    def mode(self, mode: str):
+        if not mode in (None, "full", "incremental"):
+            raise ValueError("buildtree.mode must be 'full' or 'incremental'")
+        self._mode = mode
+        return
+
+    @property
+    def history(self) -> list:
+        """Past builds as a list of (epoch, mode, git_hash, seconds)."""
+        ret = []
+        if not os.path.isfile(self.timesfile):
+            return ret
+        with open(self.timesfile, "r") as f:
+            for x in f:
+                x = x.split()
+                if len(x) == 4 and x[0].isdigit() and x[3].isdigit():
+                    ret.append((int(x[0]), x[1], x[2], int(x[3])))
+        return ret
+
+    @property
+    def comparison(self) -> str:
+        """Last full versus last incremental build time, or None."""
+        last = {}
+        for epoch, mode, git_hash, seconds in self.history:
+            last[mode] = seconds
+        if not "full" in last or not "incremental" in last:
+            return None
+        full = last["full"]
+        inc = last["incremental"]
+        ret = "full build {}s, incremental build {}s".format(full, inc)
+        if inc > 0:
+            ret = "{} ({:.1f}x faster)".format(ret, full / inc)
+        return ret
+
+
+class buildprogress:
+    # Progress of a running kernel build from its make output. Kbuild
+    # prints one line per object ("  CC [M]  drivers/foo.o"), which is
+    # counted against the expected total. Only counters and a short tail
+    # of lines are kept, so memory stays bounded however long the log.
+    OBJECT = re.compile(r"^\s+(CC|AS)(\s\[M\])?\s+\S+\.o$")
+    TAIL = 50
+
+    def __repr__(self):
+        return str(self.status)
+
+    def __init__(self, expected: int = None, interval: int = 30):
+        # interval: seconds between progress messages
+        self.expected = expected
+        self.interval = interval
+        self.objects = 0
+        self.lines = 0
+        self.tail = collections.deque(maxlen=self.TAIL)
+        # the clock starts with the first line of output
+        self._start = None
+        self._last = None
+        return
+
+    def feed(self, line: str):
+        if self._start is None:
+            self._start = self._last = time.time()
+        self.lines += 1
+        self.tail.append(line.rstrip("\n"))
+        pprint.raw(line)
+        if self.OBJECT.match(line):
+            self.objects += 1
+        now = time.time()
+        if now - self._last >= self.interval:
+            self._last = now
+            pprint.p(self.message)
+        return
+
+    @property
+    def status(self) -> dict:
+        ret = {}
+        elapsed = 0
+        if not self._start is None:
+            elapsed = time.time() - self._start
+        ret['objects'] = self.objects
+        ret['expected'] = self.expected
+        ret['rate'] = self.objects / elapsed if elapsed > 0 else 0.0
+        ret['percent'] = None
+        ret['eta'] = None
+        if self.expected:
+            done = min(self.objects, self.expected)
+            ret['percent'] = 100.0 * done / self.expected
+            if ret['rate'] > 0:
+                ret['eta'] = int((self.expected - done) / ret['rate'])
+        return ret
+
+    @property
+    def message(self) -> str:
+        s = self.status
+        if s['percent'] is None:
+            return "build: {} objects, {:.1f}/s".format(s['objects'],
+                                                        s['rate'])
+        eta = "unknown"
+        if not s['eta'] is None:
+            eta = "{}m{:02d}s".format(s['eta'] // 60, s['eta'] % 60)
+        return "build: {}/{} objects ({:.0f}%), {:.1f}/s, ETA {}".format(
+            s['objects'], s['expected'], s['percent'], s['rate'], eta)
+
+    @staticmethod
+    def _stat(path: str) -> os.stat_result:
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            return None
+
+    def _reset(self):
+        self.objects = 0
+        self.lines = 0
+        self.tail.clear()
+        self._start = None
+        self._last = None
+        return
+
+    def follow(self, path: str, done: str, poll: float = 1.0):
+        """Feed the lines appended to path until a new done file exists.
+        A done file left by an earlier build means that build finished;
+        the build being followed replaces it, so only a done file that is
+        not the one seen at the start ends the loop. The log is reopened
+        when the next build truncates or replaces it."""
+        st = self._stat(done)
+        old = None if st is None else (st.st_ino, st.st_mtime_ns)
+        def finished() -> bool:
+            st = self._stat(done)
+            return not st is None and (st.st_ino, st.st_mtime_ns) != old
+        # a log not written since the old done file is the finished
+        # build's; skip it unless it changed by the time it is opened
+        skip = None
+        st = self._stat(path)
+        if not old is None and not st is None and \
+           st.st_mtime_ns <= old[1] + 2 * 10 ** 9:
+            skip = (st.st_ino, st.st_mtime_ns, st.st_size)
+        f = None
+        partial = ""
+        try:
+            while True:
+                if f is None:
+                    try:
+                        f = open(path, "r", errors="replace")
+                    except FileNotFoundError:
+                        if finished():
+                            return
+                        time.sleep(poll)
+                        continue
+                    st = os.fstat(f.fileno())
+                    if skip == (st.st_ino, st.st_mtime_ns, st.st_size):
+                        f.seek(0, os.SEEK_END)
+                    skip = None
+                chunk = f.readline()
+                if chunk:
+                    partial = partial + chunk
+                    if partial.endswith("\n"):
+                        self.feed(partial)
+                        partial = ""
+                    continue
+                if finished():
+                    return
+                st = self._stat(path)
+                if st is None or st.st_ino != os.fstat(f.fileno()).st_ino \
+                   or st.st_size < f.tell():
+                    # tee truncated the log for a new build, or it was
+                    # replaced: start over at its beginning
+                    f.close()
+                    f = None
+                    partial = ""
+                    self._reset()
+                    continue
+                time.sleep(poll)
+        finally:
+            if not f is None:
+                f.close()
+        return
+
+
+class cgroupsampler:
+    # Samples the cgroup v2 counters of a running container at a fixed
+    # interval in a background thread, writing one line per sample:
+    #   t cpu_usec throttled_usec mem_bytes mem_some_usec mem_full_usec
+    #   io_rbytes io_wbytes cpu_some_usec io_some_usec io_full_usec
+    # All but t and mem_bytes are cumulative, as the kernel reports them.
+    # Use as a context manager around the stages to watch; summary() and
+    # the message printed on exit compare the first and last samples.
+    ROOTS = ("/sys/fs/cgroup/lxc/{id}", "/sys/fs/cgroup/lxc.payload.{id}",
+             "/sys/fs/cgroup/unified/lxc/{id}")
+    # seconds between samples, 0 disables sampling; set from --sample
+    INTERVAL = 5.0
+    COLUMNS = ("t", "cpu_usec", "throttled_usec", "mem_bytes",
+               "mem_some_usec", "mem_full_usec", "io_rbytes", "io_wbytes",
+               "cpu_some_usec", "io_some_usec", "io_full_usec")
+
+    def __repr__(self):
+        return str({'path': self.path, 'series': self.series,
+                    'samples': self.samples})
+
+    def __init__(self, id: int, series: str, interval: float = None):
+        self.id = id
+        self.series = series
+        self.interval = self.INTERVAL if interval is None else interval
+        self.path = None
+        for x in self.ROOTS:
+            if os.path.isfile(x.format(id=id) + "/cpu.stat"):
+                self.path = x.format(id=id)
+                break
+        self.samples = 0
+        self._first = None
+        self._lastsample = None
+        self._peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._start = None
+        return
+
+    def _read(self, name: str) -> str:
+        try:
+            with open(f"{self.path}/{name}", "r") as f:
+                return f.read()
+        except OSError:
+            return ""
+
+    @staticmethod
+    def _keyed(text: str) -> dict:
+        # "key value" lines, e.g. cpu.stat
+        ret = {}
+        for x in text.splitlines():
+            x = x.split()
+            if len(x) == 2 and x[1].isdigit():
+                ret[x[0]] = int(x[1])
+        return ret
+
+    @staticmethod
+    def _pressure(text: str) -> tuple:
+        # "some avg10=0.00 avg60=0.00 avg300=0.00 total=123" and "full ..."
+        ret = {'some': 0, 'full': 0}
+        for x in text.splitlines():
+            kind, _, rest = x.partition(" ")
+            for y in rest.split():
+                if y.startswith("total="):
+                    ret[kind] = int(y[6:])
+        return ret['some'], ret['full']
+
+    def sample(self) -> tuple:
+        """One row of COLUMNS."""
+        cpu = self._keyed(self._read("cpu.stat"))
+        mem = self._read("memory.current").strip()
+        mem = int(mem) if mem.isdigit() else 0
+        msome, mfull = self._pressure(self._read("memory.pressure"))
+        csome = self._pressure(self._read("cpu.pressure"))[0]
+        isome, ifull = self._pressure(self._read("io.pressure"))
+        rbytes = 0
+        wbytes = 0
+        for x in self._read("io.stat").splitlines():
+            for y in x.split()[1:]:
+                key, _, val = y.partition("=")
+                if key == "rbytes":
+                    rbytes += int(val)
+                elif key == "wbytes":
+                    wbytes += int(val)
+        return (round(time.time() - self._start, 1),
+                cpu.get('usage_usec', 0), cpu.get('throttled_usec', 0),
+                mem, msome, mfull, rbytes, wbytes, csome, isome, ifull)
+
+    def _run(self):
+        # one series per build; t restarts at 0 with each sampler
+        with open(self.series, "w") as f:
+            f.write("# " + " ".join(self.COLUMNS) + "\n")
+            while True:
+                row = self.sample()
+                if self._first is None:
+                    self._first = row
+                self._lastsample = row
+                self._peak = max(self._peak, row[3])
+                self.samples += 1
+                f.write(" ".join(str(x) for x in row) + "\n")
+                f.flush()
+                if self._stop.wait(self.interval):
+                    break
+        return
+
+    def __enter__(self):
+        if self.interval <= 0:
+            return self
+        if self.path is None:
+            pprint.dp("no cgroup v2 found for container {}, not "
+                      "sampling".format(self.id))
+            return self
+        self._start = time.time()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is None:
+            return False
+        self._stop.set()
+        self._thread.join()
+        pprint.p("Resources: {}".format(self.message))
+        return False
+
+    def summary(self) -> dict:
+        """Utilization and pressure stalls between the first and last
+        sample; empty before the second sample."""
+        a = self._first
+        b = self._lastsample
+        if a is None or b is None or b[0] <= a[0]:
+            return {}
+        wall = (b[0] - a[0]) * 1e6
+        ret = {}
+        ret['seconds'] = int(b[0] - a[0])
+        ret['cpus_busy'] = round((b[1] - a[1]) / wall, 2)
+        ret['throttled_pct'] = round(100 * (b[2] - a[2]) / wall, 1)
+        ret['mem_peak_mb'] = self._peak >> 20
+        mmax = self._read("memory.max").strip()
+        ret['mem_max_mb'] = int(mmax) >> 20 if mmax.isdigit() else "max"
+        ret['cpu_some_pct'] = round(100 * (b[8] - a[8]) / wall, 1)
+        ret['mem_some_pct'] = round(100 * (b[4] - a[4]) / wall, 1)
+        ret['mem_full_pct'] = round(100 * (b[5] - a[5]) / wall, 1)
+        ret['io_some_pct'] = round(100 * (b[9] - a[9]) / wall, 1)
+        ret['io_full_pct'] = round(100 * (b[10] - a[10]) / wall, 1)
+        ret['io_read_mb'] = (b[6] - a[6]) >> 20
+        ret['io_write_mb'] = (b[7] - a[7]) >> 20
+        return ret
+
+    @property
+    def message(self) -> str:
+        s = self.summary()
+        if len(s) == 0:
+            return "not enough samples"
+        return ("{seconds}s, {cpus_busy} CPUs busy, throttled "
+                "{throttled_pct}%, memory peak {mem_peak_mb} MB of "
+                "{mem_max_mb} MB, stalls: cpu {cpu_some_pct}% memory "
+                "{mem_some_pct}%/{mem_full_pct}% io {io_some_pct}%/"
+                "{io_full_pct}% (some/full), io {io_read_mb} MB read "
+                "{io_write_mb} MB written").format(**s)
+
+
+class buildhistory:
+    # SQLite record of every build: what was built, with which container
+    # resources, how long each stage took, cache hits and the result.
+    # Durations are compared as core-seconds (seconds * cores), which
+    # lets builds on differently sized containers predict each other.
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS runs ("
+              "id INTEGER PRIMARY KEY, started INTEGER, pkg TEXT, "
+              "version TEXT, series TEXT, git_hash TEXT, mode TEXT, "
+              "profile TEXT, cores INTEGER, ram_mb INTEGER, "
+              "fssize INTEGER, storage TEXT, jobs INTEGER, "
+              "seconds INTEGER, result TEXT, artifact_hit INTEGER, "
+              "patch_hit INTEGER, ccache_hit REAL)",
+              "CREATE TABLE IF NOT EXISTS stages ("
+              "run INTEGER REFERENCES runs(id), name TEXT, seconds REAL)",
+              "CREATE INDEX IF NOT EXISTS runs_series "
+              "ON runs(series, mode, profile)")
+    REGRESSION = 1.2        # slower than this times the median is flagged
+
+    def __repr__(self):
+        return str({'path': self.path})
+
+    def __init__(self, path: str = None):
+        if path is None:
+            path = f"{root_path}/history.sqlite"
+        self.path = path
+        self._db = None
+        return
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            # opened by a setup task, used by the main thread after it
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            for x in self.SCHEMA:
+                self._db.execute(x)
+        return self._db
+
+    @staticmethod
+    def series(pkg: str) -> str:
+        """Kernel series of a package, e.g. 5.3 for pve-kernel-5.3.13-1-pve."""
+        m = re.search(r"(\d+\.\d+)", pkg or "")
+        return m.group(1) if m else pkg
+
+    def record(self, run: dict, stages: dict = None) -> int:
+        """Add a run; keys of run are the runs columns. Returns its id."""
+        run = dict(run)
+        run.setdefault('started', int(time.time()))
+        run.setdefault('series', self.series(run.get('pkg')))
+        cols = [x for x in run if not x == 'id']
+        with self.db:
+            cur = self.db.execute(
+                "INSERT INTO runs ({}) VALUES ({})".format(
+                    ", ".join(cols), ", ".join("?" * len(cols))),
+                [run[x] for x in cols])
+            for name, seconds in (stages or {}).items():
+                self.db.execute("INSERT INTO stages VALUES (?, ?, ?)",
+                                (cur.lastrowid, name, seconds))
+        return cur.lastrowid
+
+    def _similar(self, series: str, mode: str, profile: str) -> list:
+        rows = self.db.execute(
+            "SELECT * FROM runs WHERE result = 'built' AND mode = ? AND "
+            "profile = ? AND series = ? ORDER BY started",
+            (mode, profile, series)).fetchall()
+        if len(rows) == 0:
+            rows = self.db.execute(
+                "SELECT * FROM runs WHERE result = 'built' AND mode = ? AND "
+                "profile = ? ORDER BY started", (mode, profile)).fetchall()
+        return rows
+
+    def predict(self, pkg: str, mode: str, profile: str, cores: int,
+                storage: str = None) -> dict:
+        """Expected seconds for a planned build, or None without history.
+        Runs on the same storage are preferred."""
+        rows = self._similar(self.series(pkg), mode, profile)
+        if not storage is None and \
+           any(x['storage'] == storage for x in rows):
+            rows = [x for x in rows if x['storage'] == storage]
+        cost = sorted(x['seconds'] * max(x['cores'] or 1, 1) for x in rows)
+        if len(cost) == 0:
+            return None
+        ret = {}
+        ret['runs'] = len(cost)
+        ret['seconds'] = int(cost[len(cost) // 2] / max(cores or 1, 1))
+        ret['low'] = int(cost[0] / max(cores or 1, 1))
+        ret['high'] = int(cost[-1] / max(cores or 1, 1))
+        return ret
+
+    def regressions(self, pkg: str, mode: str, profile: str,
+                    last: int = 10) -> list:
+        """The last builds of the series as (row, core-seconds, ratio to
+        the median of the builds before it, flagged)."""
+        rows = self._similar(self.series(pkg), mode, profile)
+        ret = []
+        for i, row in enumerate(rows):
+            cost = row['seconds'] * max(row['cores'] or 1, 1)
+            before = sorted(x['seconds'] * max(x['cores'] or 1, 1)
+                            for x in rows[:i])
+            ratio = None
+            if len(before) > 0 and before[len(before) // 2] > 0:
+                ratio = cost / before[len(before) // 2]
+            ret.append((row, cost, ratio,
+                        not ratio is None and ratio > self.REGRESSION))
+        return ret[-last:]
+
+    def stages(self, run: int) -> dict:
+        return {x['name']: x['seconds'] for x in self.db.execute(
+            "SELECT name, seconds FROM stages WHERE run = ?", (run,))}
+
+    def report(self, pkg: str, mode: str, profile: str, cores: int,
+               storage: str = None) -> str:
+        ret = ""
+        p = self.predict(pkg, mode, profile, cores, storage)
+        if p is None:
+            ret = "No {} {} builds of {} recorded yet\n".format(
+                mode, profile, self.series(pkg))
+        else:
+            ret = ("Predicted {} {} build of {} on {} cores: {}s "
+                   "(range {}s-{}s, from {} runs)\n").format(
+                       mode, profile, pkg, cores, p['seconds'], p['low'],
+                       p['high'], p['runs'])
+        for row, cost, ratio, flagged in self.regressions(pkg, mode,
+                                                          profile):
+            stages = " ".join("{}={:.0f}s".format(k, v) for k, v in
+                              self.stages(row['id']).items())
+            ret = ret + "{} {} {} {}s on {} cores{}{} {}\n".format(
+                time.strftime("%Y-%m-%d", time.localtime(row['started'])),
+                row['version'], (row['git_hash'] or "")[:12],
+                row['seconds'], row['cores'],
+                "" if ratio is None else " ({:.2f}x median)".format(ratio),
+                " REGRESSION" if flagged else "", stages).rstrip() + "\n"
+        return ret
+
+
+class patchrule:
+    # One declarative edit: every line matching pattern in the files
+    # matched by glob (relative to the kernel source root) is deleted or
+    # rewritten. expect is the number of matches the rule must find; None
+    # accepts any number above zero.
+
+    def __repr__(self):
+        return f"patchrule('{self.name}')"
+
+    def __init__(self, name: str, glob, pattern: str,
+                 action: str = "delete", replace: str = None,
+                 expect: int = None):
+        if not action in ("delete", "replace"):
+            raise ValueError("patchrule.action must be 'delete' or "
+                             "'replace'")
+        if action == "replace" and replace is None:
+            raise ValueError("patchrule.replace is required for 'replace'")
+        self.name = name
+        self.glob = (glob,) if type(glob) is str else tuple(glob)
+        self.pattern = re.compile(pattern)
+        self.action = action
+        self.replace = replace
+        self.expect = expect
+        return
+
+    def apply(self, line: str) -> list:
+        """None if the line does not match, else its replacement lines.
+        The pattern only sees the line without its terminator, so a
+        trailing \\s* cannot take the newline (and join the next line)."""
+        body = line.rstrip("\r\n")
+        if not self.pattern.search(body):
+            return None
+        if self.action == "delete":
+            return []
+        return [self.pattern.sub(self.replace, body) + line[len(body):]]
+
+
+class patchengine:
+    # Applies a set of patchrules to the ubuntu kernel submodule of a
+    # pve-kernel checkout and produces one patch for patches/kernel.
+    # Each file is read once no matter how many rules target it.
+    RULES = [
+        patchrule("rmrr-eperm",
+                  ("drivers/iommu/intel-iommu.c",
+                   "drivers/iommu/intel/iommu.c"),
+                  r"^\s*return -EPERM;\s*$"),
+    ]
+    # bump when RULES change so cached patches are regenerated
+    VERSION = 1
+
+    def __init__(self, kdir: str, rules: list = None):
+        # kdir: pve-kernel checkout
+        self.kdir = kdir
+        self.rules = rules if not rules is None else self.RULES
+        self._submodule = None
+        self.report = []
+        return
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of the rule definitions and VERSION. Together with the
+        source files it determines the generated patch."""
+        h = hashlib.sha1()
+        h.update("version {}\n".format(self.VERSION).encode())
+        for rule in self.rules:
+            h.update("rule {} {} {} {} {} {}\n".format(
+                rule.name, rule.glob, rule.pattern.pattern, rule.action,
+                rule.replace, rule.expect).encode())
+        return h.hexdigest()
+
+    @property
+    def submodule(self) -> str:
+        """Ubuntu kernel submodule path relative to kdir, or None."""
+        if self._submodule is None:
+            self._submodule = find_kernel_submodule(self.kdir)
+        return self._submodule
+
+    @property
+    def srcdir(self) -> str:
+        if self.submodule is None:
+            return None
+        return f"{self.kdir}/{self.submodule}"
+
+    @property
+    def files(self) -> dict:
+        """relpath -> rules targeting it, for files that exist."""
+        ret = {}
+        if self.srcdir is None:
+            return ret
+        for rule in self.rules:
+            for g in rule.glob:
+                for path in sorted(glob.glob(f"{self.srcdir}/{g}")):
+                    rel = os.path.relpath(path, self.srcdir)
+                    rules = ret.setdefault(rel, [])
+                    if not rule in rules:
+                        rules.append(rule)
+        return ret
+
+    def run(self) -> str:
+        """Apply all rules and return the combined patch text. Matches are
+        recorded in self.report as (rule, relpath, lineno, line)."""
+        self.report = []
+        patch = ""
+        for rel, rules in self.files.items():
+            hits = []
+            lineno = 0
+            def action(line):
+                nonlocal lineno
+                lineno += 1
+                for rule in rules:
+                    new = rule.apply(line)
+                    if not new is None:
+                        hits.append((rule, rel, lineno, line.rstrip("\n")))
+                        return new
+                return None
+            with open(f"{self.srcdir}/{rel}", "r",
+                      errors="surrogateescape") as f:
+                text, _ = diff_lines(f, rel, action)
+            self.report.extend(hits)
+            patch = patch + text
+        return patch
+
+    @property
+    def problems(self) -> list:
+        """Rules whose match count after run() is not what they expect."""
+        ret = []
+        for rule in self.rules:
+            n = sum(1 for r in self.report if r[0] is rule)
+            if (rule.expect is None and n == 0) or \
+               (not rule.expect is None and n != rule.expect):
+                want = "at least 1" if rule.expect is None else rule.expect
+                ret.append("{}: expected {} match(es), found {}".format(
+                    rule.name, want, n))
+        return ret
+
+
+class patchcache:
+    # Generated patches stored by content address. The key covers the git
+    # blob hash of every file the rules target plus the rule definitions
+    # and patchengine.VERSION, so a kernel revision whose iommu source did
+    # not change reuses the patch without scanning it again. Files that
+    # produce no patch are cached as empty entries. The match report and
+    # rule problems of the run that made a patch are kept beside it in
+    # <key>.json and shown again on a hit.
+
+    def __repr__(self):
+        ret = {}
+        ret['path'] = self.path
+        ret['entries'] = self.entries
+        return str(ret)
+
+    def __init__(self, path: str = None):
+        if path is None:
+            path = f"{root_path}/patchcache"
+        self.path = os.path.realpath(path)
+        self.hits = 0
+        self.misses = 0
+        return
+
+    @staticmethod
+    def blobhashes(srcdir: str, files: list) -> dict:
+        """relpath -> git blob id of the files in srcdir. The ids come
+        from the index; only files changed in the work tree (or outside
+        a repository) are hashed, by git hash-object."""
+        ret = {}
+        files = sorted(files)
+        if len(files) == 0:
+            return ret
+        res = _git(srcdir, "ls-files", "-s", "--", *files)
+        if res.returncode == 0:
+            for line in res.stdout.splitlines():
+                info, _, rel = line.partition("\t")
+                ret[rel] = info.split()[1]
+            res = _git(srcdir, "diff", "--name-only", "--", *files)
+            if res.returncode == 0:
+                for rel in res.stdout.splitlines():
+                    ret.pop(rel, None)
+            else:
+                ret = {}
+        todo = [x for x in files if not x in ret]
+        if len(todo) > 0:
+            res = _git(srcdir, "hash-object", "--no-filters", "--", *todo)
+            if res.returncode != 0:
+                raise RuntimeError("git hash-object failed in {}: {}".format(
+                    srcdir, res.stderr.strip()))
+            ret.update(zip(todo, res.stdout.split()))
+        return ret
+
+    def key(self, engine: patchengine) -> str:
+        """Cache key for the current sources of engine, or None if the
+        kernel submodule cannot be found."""
+        if engine.srcdir is None:
+            return None
+        h = hashlib.sha1()
+        h.update("rules {}\n".format(engine.fingerprint).encode())
+        blobs = self.blobhashes(engine.srcdir, list(engine.files))
+        for rel in sorted(blobs):
+            h.update("file {} {}\n".format(rel, blobs[rel]).encode())
+        return h.hexdigest()
+
+    @property
+    def entries(self) -> int:
+        if not os.path.isdir(self.path):
+            return 0
+        return sum(1 for x in os.scandir(self.path)
+                   if x.name.endswith(".patch"))
+
+    def get(self, key: str) -> str:
+        """Cached patch text ('' for a cached no-op), None on a miss."""
+        path = f"{self.path}/{key}.patch"
+        if not os.path.isfile(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        with open(path, "r", errors="surrogateescape") as f:
+            return f.read()
+
+    def notes(self, key: str) -> dict:
+        """{'report': [...], 'problems': [...]} stored with the patch."""
+        path = f"{self.path}/{key}.json"
+        if not os.path.isfile(path):
+            return {'report': [], 'problems': []}
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def put(self, key: str, patch: str, report: list = None,
+            problems: list = None):
+        os.makedirs(self.path, exist_ok=True)
+        # notes first, the .patch makes the entry a hit
+        write_atomic(f"{self.path}/{key}.json", json.dumps(
+            {'report': report or [], 'problems': problems or []}, indent=1))
+        write_atomic(f"{self.path}/{key}.patch", patch)
+        return
+
+
+class artifactcache:
+    # Local store of built .deb files. Each entry is a directory named by
+    # a key over the pve-kernel commit, the patch rules fingerprint (the
+    # patch is a function of both), the build profile and the toolchain
+    # (the gcc, binutils and dpkg-dev versions installed in the build
+    # container), holding the packages and a manifest.json. A run whose
+    # key is present returns the stored packages without building.
+    #
+    # The build itself runs later inside the container, so write time
+    # leaves artifact.json on the shared volume and the next run harvests
+    # the finished packages into the store, keyed by the toolchain
+    # build.sh recorded after building; bootstrap.sh dist-upgrades the
+    # container, so that may differ from the one seen at write time.
+    TOOLCHAIN = ("gcc", "binutils", "dpkg-dev")
+
+    def __repr__(self):
+        ret = {}
+        ret['path'] = self.path
+        ret['entries'] = self.entries
+        return str(ret)
+
+    def __init__(self, path: str = None):
+        if path is None:
+            path = f"{root_path}/artifacts"
+        self.path = os.path.realpath(path)
+        return
+
+    @property
+    def entries(self) -> int:
+        if not os.path.isdir(self.path):
+            return 0
+        return sum(1 for x in os.scandir(self.path)
+                   if x.is_dir() and not x.name.startswith("."))
+
+    @staticmethod
+    def meta(target_kernel: kernel, profile: buildprofile,
+             toolchain: str) -> dict:
+        """Build inputs identifying an artifact."""
+        ret = {}
+        ret['pkg'] = target_kernel.pkg
+        ret['git_hash'] = target_kernel.git_hash
+        ret['patch'] = patchengine(None).fingerprint
+        ret['profile'] = profile.name
+        ret['toolchain'] = toolchain
+        return ret
+
+    @classmethod
+    def _toolchain(cls, text: str) -> str:
+        # 'package=version' lines, as dpkg-query -W -f writes them
+        versions = {}
+        for x in (text or "").splitlines():
+            pkg, sep, ver = x.strip().partition("=")
+            if sep and ver:
+                versions[pkg] = ver
+        if not all(x in versions for x in cls.TOOLCHAIN):
+            return None
+        return " ".join(f"{x}={versions[x]}" for x in cls.TOOLCHAIN)
+
+    @classmethod
+    def toolchain(cls, id: int) -> str:
+        """Toolchain versions installed in container id, or None if it is
+        not running or lacks one of them."""
+        res = sp_run(["pct", "exec", str(id), "--", "dpkg-query", "-W",
+                      "-f=${Package}=${Version}\\n"] + list(cls.TOOLCHAIN))
+        return cls._toolchain(res.stdout)
+
+    @staticmethod
+    def key(meta: dict) -> str:
+        h = hashlib.sha256()
+        for x in ("git_hash", "patch", "profile", "toolchain"):
+            h.update("{} {}\n".format(x, meta[x]).encode())
+        return h.hexdigest()[:32]
+
+    @staticmethod
+    def _sha256(path: str) -> str:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def lookup(self, key: str) -> list:
+        """Paths of the stored packages for key, or None on a miss or an
+        incomplete entry."""
+        entry = f"{self.path}/{key}"
+        manifest = f"{entry}/manifest.json"
+        if not os.path.isfile(manifest):
+            return None
+        with open(manifest, "r") as f:
+            m = json.load(f)
+        ret = []
+        for deb in m.get('debs', []):
+            path = f"{entry}/{deb['name']}"
+            if not os.path.isfile(path) or \
+               os.path.getsize(path) != deb['size']:
+                return None
+            ret.append(path)
+        if len(ret) == 0:
+            return None
+        return ret
+
+    def store(self, key: str, debs: list, meta: dict) -> list:
+        """Add debs under key; files are hardlinked when possible."""
+        entry = f"{self.path}/{key}"
+        if not self.lookup(key) is None:
+            return self.lookup(key)
+        tmp = f"{self.path}/.{key}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        m = dict(meta)
+        m['key'] = key
+        m['stored'] = int(time.time())
+        m['debs'] = []
+        for deb in debs:
+            name = os.path.basename(deb)
+            try:
+                os.link(deb, f"{tmp}/{name}")
+            except OSError:
+                shutil.copy2(deb, f"{tmp}/{name}")
+            m['debs'].append({'name': name, 'size': os.path.getsize(deb),
+                              'sha256': self._sha256(deb)})
+        with open(f"{tmp}/manifest.json", "w") as f:
+            json.dump(m, f, indent=2)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.rename(tmp, entry)
+        return self.lookup(key)
+
+    def expect(self, shared_dir: str, meta: dict):
+        """Record the build the written scripts will produce."""
+        m = dict(meta)
+        m['key'] = self.key(meta)
+        m['written'] = int(time.time())
+        write_atomic(f"{shared_dir}/artifact.json",
+                     json.dumps(m, indent=2) + "\n")
+        return
+
+    def harvest(self, shared_dir: str) -> str:
+        """Store the packages of a build finished since expect(). Returns
+        the key stored, or None."""
+        pending = f"{shared_dir}/artifact.json"
+        if not os.path.isfile(pending):
+            return None
+        with open(pending, "r") as f:
+            m = json.load(f)
+        done = None
+        for epoch, mode, git_hash, seconds in buildtree(shared_dir).history:
+            if git_hash == m['git_hash'] and epoch >= m['written']:
+                done = (epoch, seconds)
+        if done is None:
+            return None
+        debs = []
+        for deb in glob.glob(f"{shared_dir}/git/pve-kernel/*.deb"):
+            mtime = os.path.getmtime(deb)
+            if done[0] - done[1] - 60 <= mtime <= done[0] + 60:
+                debs.append(deb)
+        if len(debs) == 0:
+            return None
+        tfile = f"{shared_dir}/toolchain"
+        if os.path.isfile(tfile) and os.path.getmtime(tfile) >= m['written']:
+            with open(tfile, "r") as f:
+                toolchain = self._toolchain(f.read())
+            if not toolchain is None and toolchain != m.get('toolchain'):
+                m['toolchain'] = toolchain
+                m['key'] = self.key(m)
+        m['build_seconds'] = done[1]
+        self.store(m['key'], sorted(debs), m)
+        series = f"{shared_dir}/resources.log"
+        if os.path.isfile(series):
+            # keep the resource samples of the build with its packages
+            shutil.copy2(series, f"{self.path}/{m['key']}/resources.log")
+        os.remove(pending)
+        return m['key']
+
+
+class aptrepo:
+    # Flat apt repository of published kernel packages:
+    #   <path>/pool/<package>/<file>.deb
+    #   <path>/Packages, Packages.gz, Release
+    # The stanza of every published file is kept in .index.json, so a
+    # publish only inspects the new packages. When nothing is replaced the
+    # new stanzas are appended to Packages; the pool is never rescanned.
+    # Hosts use it with:
+    #   deb [trusted=yes] file:<path> ./
+
+    def __repr__(self):
+        ret = {}
+        ret['path'] = self.path
+        ret['packages'] = len(self.index)
+        return str(ret)
+
+    def __init__(self, path: str):
+        self.path = os.path.realpath(path)
+        self._index = None
+        return
+
+    @property
+    def indexfile(self) -> str:
+        return f"{self.path}/.index.json"
+
+    @property
+    def index(self) -> dict:
+        """{pool file name: {field: value}} of the published packages."""
+        if not self._index is None:
+            return self._index
+        self._index = {}
+        if os.path.isfile(self.indexfile):
+            with open(self.indexfile, "r") as f:
+                self._index = json.load(f)
+        return self._index
+
+    @property
+    def sources_line(self) -> str:
+        return f"deb [trusted=yes] file:{self.path} ./"
+
+    @staticmethod
+    def _digests(path: str) -> tuple:
+        md5 = hashlib.md5()
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                md5.update(chunk)
+                sha.update(chunk)
+        return md5.hexdigest(), sha.hexdigest()
+
+    @staticmethod
+    def _stanza(fields: dict) -> str:
+        # continuation lines were joined with newlines by parse_deb822
+        return "".join("{}: {}\n".format(k, v.replace("\n", "\n "))
+                       for k, v in fields.items())
+
+    def _fields(self, deb: str, filename: str) -> dict:
+        res = sp_run(["dpkg-deb", "-f", deb])
+        if res.returncode != 0:
+            return None
+        fields = parse_deb822(res.stdout)
+        if len(fields) == 0:
+            return None
+        ret = fields[0]
+        md5, sha = self._digests(deb)
+        ret['Filename'] = filename
+        ret['Size'] = str(os.path.getsize(deb))
+        ret['MD5sum'] = md5
+        ret['SHA256'] = sha
+        return ret
+
+    def publish(self, debs: list) -> list:
+        """Add debs to the pool and update the indexes. Returns the pool
+        file names that were added or replaced."""
+        added = []
+        replaced = False
+        for deb in debs:
+            name = os.path.basename(deb)
+            pkg = name.partition("_")[0]
+            filename = f"pool/{pkg}/{name}"
+            dest = f"{self.path}/{filename}"
+            if filename in self.index and os.path.isfile(dest):
+                if os.path.samefile(deb, dest):
+                    continue
+                if os.path.getsize(deb) == int(self.index[filename]['Size']) \
+                   and self._digests(deb)[1] == \
+                   self.index[filename]['SHA256']:
+                    continue
+            fields = self._fields(deb, filename)
+            if fields is None:
+                pprint.warn("Not a package, not published: {}".format(deb))
+                continue
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            tmp = f"{dest}.rmrr-new"
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            try:
+                os.link(deb, tmp)
+            except OSError:
+                shutil.copy2(deb, tmp)
+            os.replace(tmp, dest)
+            replaced = replaced or filename in self.index
+            self.index[filename] = fields
+            added.append(filename)
+        if len(added) == 0:
+            return added
+        packages = f"{self.path}/Packages"
+        if replaced or not os.path.isfile(packages):
+            text = "\n".join(self._stanza(self.index[x])
+                             for x in sorted(self.index))
+            write_atomic(packages, text)
+        else:
+            with open(packages, "a") as f:
+                for x in added:
+                    if f.tell() > 0:
+                        f.write("\n")
+                    f.write(self._stanza(self.index[x]))
+        write_atomic(self.indexfile, json.dumps(self.index, indent=1) + "\n")
+        self._release()
+        return added
+
+    def _release(self):
+        with open(f"{self.path}/Packages", "rb") as f:
+            data = f.read()
+        with gzip.open(f"{self.path}/Packages.gz.rmrr-new", "wb") as f:
+            f.write(data)
+        os.replace(f"{self.path}/Packages.gz.rmrr-new",
+                   f"{self.path}/Packages.gz")
+        md5 = ""
+        sha = ""
+        for name in ("Packages", "Packages.gz"):
+            path = f"{self.path}/{name}"
+            m, s = self._digests(path)
+            size = os.path.getsize(path)
+            md5 = md5 + " {} {} {}\n".format(m, size, name)
+            sha = sha + " {} {} {}\n".format(s, size, name)
+        text = ("Origin: fix_rmrr\n"
+                "Label: pve-kernel RMRR patched\n"
+                "Date: {}\n"
+                "MD5Sum:\n{}"
+                "SHA256:\n{}").format(
+                    time.strftime("%a, %d %b %Y %H:%M:%S UTC",
+                                  time.gmtime()), md5, sha)
+        write_atomic(f"{self.path}/Release", text)
+        return
+
+
+class lxc:
+    # "pct create {id} \"{tmpl}\" -storage {storage} -memory {ram} "
+    #      "-net0 \"name=eth0,bridge=vmbr{bridge},hwaddr=FA:4D:70:91:B8:6F,"
+    #      "ip=dhcp,type=veth\" -hostname buildr -cores {cores} -rootfs 80 "
+    #      "-mp0 \"{share},mp=/root/shared,ro=0\""
+
+    # documenting new lxc design
+    # prop: net = pvenetwork or List[of pvenetwork] or None
+    # prop: mp = pvemountpoint or List[of pvemountpoint] or None
+    # prop: rootfs = pvemountpoint or None out=reqd
+    # prop: hostname = str or None
+    # prop: id = int; valid from 0 - 4094 or None out=reqd
+    # prop: sshkey = str or None or List[of str]?
+    # prop: privileged = bool or None
+    # prop: cores = int or None
+    # prop: cpulimit = decimal or None
+    # prop: cpuunits = int; pve default is 1024
+    # prop: onboot = bool or None(inherit); start at boot?; default False
+    # prop: bootorder = int > 0; default None
+    # prop: bootdelay = int > 0 or None; seconds
+    # prop: deadtimeout = int > 0 or None; pve default is 60; seconds to wait
+    #       after shutting down container before the shutdown action is
+    #       reported as 'failed'
+    # prop: description = str or None
+    # prop: nesting = bool or None (nesting VM)
+    # prop: keyctl = bool or None
+    # prop: fuse = bool or None
+    # prop: force = bool, default false. may not implement
+    # prop: memory = int or None (use PVE default). ram in MB
+    # prop: ostype = str [alpine|archlinux|centos|debian|fedora|gentoo|
+    # prop:               opensuse|ubuntu|unmanaged] or None(inherit)
     # prop: password = str or None (root password)
     # prop: template = str or None out=reqd
     # prop: searchdomain = str or None
@@ -1002,29 +3909,62 @@ class lxc:
 
 
 
+    # MAC allocator shared by all containers, set up from --mac
+    macs = None
+    TEMPLATE_MARK = "rmrr-template="
+
+    __slots__ = ('_returnlist', '_id', '_cores', '_ram', '_tmpl', '_storage',
+                 '_mp', '_net', '_fssize', '_hostname', '_description',
+                 '_status')
+
     #def __repr__(self):
     #    return self.create(test=True)
 
+    def __repr__(self):
+        return str(self.snapshot())
+
     def __str__(self):
-        #ret = ""
-        #d = self.__dict__
-        #maxl = len(max(d.keys())) + 4
-        #for x in d:
-        #    ret = ret + "{}: {}\n".format(str(x).rjust(maxl), str(d[x]))
-        var = inspect.classify_class_attrs(lxc)
+        # only stored state: the status and config properties would run
+        # pct, see refresh()
         ret = ""
-        for item in var:
-            if item.kind == 'property':
-                val = getattr(self, item.name)
-                ret = f"{ret}{item.name}: {val}\n"
+        for x, val in self.snapshot().items():
+            ret = f"{ret}{x}: {val}\n"
         return ret.strip()
 
+    def snapshot(self) -> dict:
+        """Stored settings and the status seen by the last refresh(), as
+        plain values. Runs no commands."""
+        ret = {}
+        ret['id'] = self._id
+        ret['status'] = self._status
+        for x in ('cores', 'ram', 'tmpl', 'storage', 'fssize', 'hostname',
+                  'description'):
+            ret[x] = getattr(self, f"_{x}")
+        for x, cls in (('mp', pvemountpoint), ('net', pvenetwork)):
+            val = getattr(self, f"_{x}")
+            if isinstance(val, cls):
+                val = [val]
+            for v in val or []:
+                ret[f"{x}{v.id}"] = v.options
+        return ret
+
+    def tojson(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def refresh(self):
+        """Read the status and, if the container exists, its config."""
+        self._status = self.status
+        if self._status:
+            self.loadconfig()
+        return self
+
     def __init__(self, id: int = 500, cores: int = None, ram: int = None,
                  tmpl: str = "debian-10", storage: str = "local-lvm",
                  mp: pvemountpoint = None, net: pvenetwork = None,
                  fssize: int = 80, hostname: str = None,
                  description: str = None):
         self._returnlist = []
+        self._status = None
         self._id = None
         self._cores = None
         self._ram = None
@@ -1054,6 +3994,38 @@ class lxc:
         self._returnlist.insert(0, sp_run(cmd))
         return self._returnlist[0]
 
+    def exec(self, cmd: str, env: dict = None) -> subprocess.CompletedProcess:
+        """Run a shell command inside the running container."""
+        pre = ""
+        if env:
+            pre = "env {} ".format(" ".join(
+                "{}={}".format(k, quote(v)) for k, v in env.items()))
+        return self.runcmd(f"pct exec {self.id} -- {pre}sh -c {quote(cmd)}")
+
+    def stream(self, cmd: str, env: dict = None, feed=None) -> int:
+        """Like exec, but pass each output line (stdout and stderr) to
+        feed as it arrives. Returns the exit status."""
+        pre = ""
+        if env:
+            pre = "env {} ".format(" ".join(
+                "{}={}".format(k, quote(v)) for k, v in env.items()))
+        cmd = split(f"pct exec {self.id} -- {pre}sh -c {quote(cmd)}")
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, text=True,
+                                errors="replace")
+        for line in proc.stdout:
+            if not feed is None:
+                feed(line)
+        proc.stdout.close()
+        return proc.wait()
+
+    def readfile(self, path: str) -> str:
+        """Contents of a file inside the running container, or None."""
+        res = self.runcmd(f"pct exec {self.id} -- cat {path}")
+        if res.returncode != 0:
+            return None
+        return res.stdout
+
     @property
     def lastcmd(self) -> list:
         if len(self._returnlist) > 0:
@@ -1174,29 +4146,36 @@ class lxc:
 
     @tmpl.setter
     def tmpl(self, tmpl: str):
+        if type(tmpl) is str and ":vztmpl/" in tmpl:
+            # already a template volume, no need to search or download
+            self._tmpl = tmpl
+            return
+        self._tmpl = self.template(tmpl)
+        return
+
+    @staticmethod
+    def template(tmpl: str) -> str:
+        """Download the newest system template matching tmpl and return
+        its volume id, or None if there is none."""
         templates = []
-        res = self.runcmd('pveam update')
-        res = self.runcmd('pveam available -section system')
+        res = sp_run('pveam update')
+        res = sp_run('pveam available -section system')
         for x in res.stdout.splitlines():
             x = x.lower()
             if tmpl in x:
                 templates.append(x.rpartition(" ")[2].strip())
         if len(templates) > 0:
             templates.sort(key=LooseVersion, reverse=True)
-            self.runcmd(f"pveam download local {templates[0]}")
-        res = self.runcmd("pveam list local").stdout.partition("\n")[2]
+            sp_run(f"pveam download local {templates[0]}")
+        res = sp_run("pveam list local").stdout.partition("\n")[2]
         templates = []
         for x in res.splitlines():
             if tmpl in x:
                 templates.append(x.split()[0])
         if len(templates) > 0:
             templates.sort(key=LooseVersion, reverse=True)
-            self._tmpl = templates[0]
-            return
-        else:
-            self._tmpl = None
-            return
-        return
+            return templates[0]
+        return None
 
     @property
     def storage(self) -> str:
@@ -1218,8 +4197,8 @@ class lxc:
             # self.mp is a list. each list object needs to be tested and any
             # duplicate values will be rejected
             validmounts = []
-            mountids = set(None)
-            mountmps = set(None)
+            mountids = set()
+            mountmps = set()
             for mount in mp:
                 # mountpoint requirements
                 # mount.id is not null and not duplicated in the list(mp)
@@ -1268,11 +4247,11 @@ class lxc:
         # validate network settings
         if t is list and len(net) > 0:
             validnets = []
-            netids = set(None)
+            netids = set()
             for n in net:
                 if type(n) is pvenetwork:
                     if n.hwaddr is None:
-                        n.hwaddr = "fa4d70000000"
+                        n.gethwaddr(self.id, self.macs)
                     n.defaults(self.id)
                     if not n.id in netids and not n.hwaddr in netids \
                        and not n.name in netids:
@@ -1288,7 +4267,7 @@ class lxc:
                 return
         elif t is pvenetwork:
             if net.hwaddr is None:
-                net.gethwaddr(self.id)
+                net.gethwaddr(self.id, self.macs)
             #net.defaults(self.id)
             self._net = net
             return
@@ -1333,6 +4312,24 @@ class lxc:
         cmd = f"pct stop {self.id}"
         return self.runcmd(cmd)
 
+    def mksnapshot(self, name: str) -> subprocess.CompletedProcess:
+        return self.runcmd(f"pct snapshot {self.id} {name}")
+
+    def rollback(self, name: str) -> subprocess.CompletedProcess:
+        return self.runcmd(f"pct rollback {self.id} {name}")
+
+    def listsnapshots(self) -> list:
+        """Snapshot names, without the 'current' pseudo snapshot."""
+        res = self.runcmd(f"pct listsnapshot {self.id}")
+        if res.returncode != 0:
+            return []
+        ret = []
+        for x in res.stdout.splitlines():
+            x = x.replace("`->", " ").split()
+            if len(x) > 0 and x[0] != "current":
+                ret.append(x[0])
+        return ret
+
     def restart(self) -> subprocess.CompletedProcess:
         self.stop()
         self.start()
@@ -1340,6 +4337,27 @@ class lxc:
         ret.reverse()
         return ret
 
+    @property
+    def ostype(self) -> str:
+        """ostype pct derives from the template, e.g. debian."""
+        if not self.tmpl:
+            return None
+        return self.tmpl.rpartition("/")[2].partition("-")[0] or None
+
+    def livetemplate(self) -> str:
+        """Template the live container was created from, as recorded in
+        its description by create(), or None."""
+        cfg = self.configfilecontents or ""
+        for line in cfg.splitlines():
+            if line.startswith("["):
+                break
+            if not line.startswith("#"):
+                continue
+            for x in urllib.parse.unquote(line[1:]).split():
+                if x.startswith(self.TEMPLATE_MARK):
+                    return x[len(self.TEMPLATE_MARK):]
+        return None
+
     def create(self, overwrite: bool = False,
                test: bool = False) -> subprocess.CompletedProcess:
         # True on success, str error otherwise
@@ -1348,6 +4366,11 @@ class lxc:
         cmd = f"pct create {self.id} \"{self.tmpl}\" -storage {self.storage} "
         cmd = f"{cmd} -memory {self.ram} -hostname {self.hostname} "
         cmd = f"{cmd} -cores {self.cores} -rootfs {self.fssize}"
+        # record the template, diffconfig() compares it
+        descr = [self.TEMPLATE_MARK + str(self.tmpl).rpartition("/")[2]]
+        if self.description:
+            descr.insert(0, self.description)
+        cmd = f"{cmd} -description {quote(' '.join(descr))}"
         if self.mp:
             if type(self.mp) is list:
                 for i in self.mp:
@@ -1389,6 +4412,114 @@ class lxc:
             self.storage = "local-lvm"
         return
 
+    def liveconfig(self) -> dict:
+        """Current section of the pct config as {option: value}, without
+        snapshot sections and description comments."""
+        ret = {}
+        cfg = self.configfilecontents
+        if cfg is None:
+            return ret
+        for line in cfg.splitlines():
+            if line.startswith("["):
+                break
+            if line.startswith("#") or not ": " in line:
+                continue
+            key, _, val = line.partition(": ")
+            ret[key.strip()] = val.strip()
+        return ret
+
+    @staticmethod
+    def _gigabytes(size: str) -> float:
+        units = {'K': 1 / 1024 ** 2, 'M': 1 / 1024, 'G': 1, 'T': 1024}
+        if size and size[-1].upper() in units:
+            return float(size[:-1]) * units[size[-1].upper()]
+        return float(size) / 1024 ** 3 if size else 0
+
+    def diffconfig(self) -> tuple:
+        """Compare the desired settings with the live config.
+        Returns (changes, resize, recreate): changes maps pct set options
+        to their new value, or None to delete them; resize is the new
+        rootfs size in GB or None; recreate lists the reasons a change
+        cannot be applied in place."""
+        live = self.liveconfig()
+        changes = {}
+        recreate = []
+        want = {'cores': self.cores, 'memory': self.ram,
+                'hostname': self.hostname}
+        for key, val in want.items():
+            if not val is None and live.get(key) != str(val):
+                changes[key] = str(val)
+        if self.tmpl:
+            tmpl = self.tmpl.rpartition("/")[2]
+            cur = self.livetemplate()
+            if not cur is None and cur != tmpl:
+                recreate.append("template {} -> {}".format(cur, tmpl))
+            elif live.get('ostype') and self.ostype and \
+                 live['ostype'] != self.ostype:
+                recreate.append("ostype {} -> {}".format(live['ostype'],
+                                                         self.ostype))
+        for prefix, cls, val in (("mp", pvemountpoint, self.mp),
+                                 ("net", pvenetwork, self.net)):
+            if isinstance(val, cls):
+                val = [val]
+            desired = {f"{prefix}{x.id}": x for x in val or []}
+            for key in live:
+                if key.startswith(prefix) and key[len(prefix):].isdigit() \
+                   and not key in desired:
+                    changes[key] = None
+            for key, obj in desired.items():
+                if not key in live:
+                    changes[key] = obj.options
+                    continue
+                cur = cls.parse(f"{key}: {live[key]}")
+                if cur.options != live[key]:
+                    # never write back what the codec cannot reproduce
+                    pprint.warn("{}: cannot round-trip \"{}\", leaving it "
+                                "unchanged".format(key, live[key]))
+                    continue
+                new = obj.merged(cur)
+                if new.options != cur.options:
+                    changes[key] = new.options
+        resize = None
+        rootfs = live.get('rootfs', "")
+        storage = rootfs.partition(":")[0]
+        if storage and self.storage and storage != self.storage:
+            recreate.append("rootfs storage {} -> {}".format(storage,
+                                                             self.storage))
+        size = 0
+        for x in rootfs.split(","):
+            if x.startswith("size="):
+                size = self._gigabytes(x[5:])
+        if self.fssize and size and self.fssize > size:
+            resize = self.fssize
+        elif self.fssize and size and self.fssize < size:
+            recreate.append("rootfs shrink {}G -> {}G".format(int(size),
+                                                              self.fssize))
+        return changes, resize, recreate
+
+    def reconcile(self, test: bool = False):
+        """Apply the differences to the live container with pct set and
+        pct resize. Returns the commands (with test) or results, or None
+        if the changes need the container to be recreated."""
+        changes, resize, recreate = self.diffconfig()
+        if len(recreate) > 0:
+            return None
+        cmds = []
+        if len(changes) > 0:
+            cmd = f"pct set {self.id}"
+            deletes = [x for x in changes if changes[x] is None]
+            for key, val in changes.items():
+                if not val is None:
+                    cmd = f"{cmd} -{key} {quote(val)}"
+            if len(deletes) > 0:
+                cmd = f"{cmd} -delete {','.join(deletes)}"
+            cmds.append(cmd)
+        if not resize is None:
+            cmds.append(f"pct resize {self.id} rootfs {resize}G")
+        if test:
+            return cmds
+        return [self.runcmd(x) for x in cmds]
+
     def loadconfig(self) -> bool:
         # only if the config file exists and LXC is created
         if not self.status:
@@ -1411,29 +4542,10 @@ class lxc:
         for c in cfg.splitlines():
             if c.startswith("mp"):
                 # is mountpoint definition
-                m = pvemountpoint()
-                m.id = int(c[2])
-                m.volume = c.partition(": ")[2].partition(",")[0]
-                m.mp = c.partition("mp=")[2].partition(",")[0]
-                if "ro=" in c:
-                    m.ro = int(c.partition("ro=")[2].partition(",")[0])
-                mounts.append(m)
+                mounts.append(pvemountpoint.parse(c))
             elif c.startswith("net"):
                 # is pvenetwork definition
-                n = pvenetwork()
-                n.id = int(c[3])
-                if "name=" in c:
-                    n.name = c.partition("name=")[2].partition(",")[0]
-                if "bridge=" in c:
-                    bridge = c.partition("bridge=vmbr")[2].partition(",")[0]
-                    n.bridge = int(bridge)
-                if "hwaddr=" in c:
-                    n.hwaddr = c.partition("hwaddr=")[2].partition(",")[0]
-                if "ip=" in c:
-                    n.ip = c.partition("ip=")[2].partition(",")[0]
-                if "type=" in c:
-                    n.type = c.partition("type=")[2].partition(",")[0]
-                nets.append(n)
+                nets.append(pvenetwork.parse(c))
         if len(mounts) > 1:
             self.mp = mounts
         elif len(mounts) == 1:
@@ -1445,12 +4557,213 @@ class lxc:
         return True
 
 
+class buildpool:
+    # Warm pool of bootstrapped build containers with ids first..first+size-1.
+    # A member is ready when it runs and has the SNAPSHOT taken right after
+    # bootstrap.sh and build-depends.sh. lease() hands out a ready member,
+    # release() rolls it back to the snapshot in a background thread (or
+    # destroys and reprovisions it if the rollback fails). Leases are
+    # flock()ed lock files, so several runs can share one pool. Members
+    # are created with the OWNER description; a guest at a member id
+    # without it is never touched.
+    SNAPSHOT = "rmrr_ready"
+    OWNER = "rmrr-buildpool"
+    POLL = 5                # seconds between lease() retries
+
+    def __repr__(self):
+        ret = {}
+        ret['first'] = self.first
+        ret['size'] = self.size
+        ret['leased'] = sorted(self._locks)
+        return str(ret)
+
+    def __init__(self, proto: lxc, size: int, first: int = None,
+                 lockdir: str = None):
+        # proto supplies the settings of every member; members follow it
+        self.proto = proto
+        self.size = size
+        self.first = proto.id + 1 if first is None else first
+        self.lockdir = f"{root_path}/pool" if lockdir is None else lockdir
+        self._locks = {}
+        self._threads = []
+        self._mutex = threading.Lock()
+        self._released = threading.Condition()
+        self._members = None
+        return
+
+    def member(self, id: int) -> lxc:
+        p = self.proto
+        return lxc(id=id, cores=p.cores, ram=p.ram / 1024, tmpl=p.tmpl,
+                   storage=p.storage, mp=p.mp,
+                   net=pvenetwork(bridge=0, ip='dhcp'), fssize=p.fssize,
+                   hostname=f"bildr{id}", description=buildpool.OWNER)
+
+    @property
+    def members(self) -> list:
+        if self._members is None:
+            self._members = [self.member(x) for x in
+                             range(self.first, self.first + self.size)]
+        return self._members
+
+    @staticmethod
+    def ready(cont: lxc) -> bool:
+        return cont.status == "running" and \
+            buildpool.SNAPSHOT in cont.listsnapshots()
+
+    @staticmethod
+    def owned(cont: lxc) -> bool:
+        """True if cont does not exist or was created by a pool."""
+        if not cont.status:
+            return True
+        cfg = cont.configfilecontents or ""
+        for line in cfg.splitlines():
+            if line.startswith("["):
+                break
+            if line.startswith("#") and buildpool.OWNER in line:
+                return True
+        return False
+
+    def _lock(self, cont: lxc) -> bool:
+        os.makedirs(self.lockdir, exist_ok=True)
+        f = open(f"{self.lockdir}/{cont.id}.lock", "w")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        with self._mutex:
+            self._locks[cont.id] = f
+        return True
+
+    def _unlock(self, cont: lxc):
+        with self._mutex:
+            f = self._locks.pop(cont.id, None)
+        if not f is None:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+        with self._released:
+            self._released.notify_all()
+        return
+
+    def provision(self, cont: lxc) -> bool:
+        """Create, start and bootstrap cont, then take the snapshot.
+        Refuses to replace a guest the pool did not create."""
+        if not self.owned(cont):
+            pprint.warn("pool: container {} was not created by the pool, "
+                        "leaving it alone".format(cont.id))
+            return False
+        if cont.status:
+            cont.destroy(test=False)
+        if cont.create().returncode != 0:
+            return False
+        cont.start()
+        for step in ("bootstrap.sh", "build-depends.sh"):
+            res = cont.exec(f"sh /root/shared/{step}")
+            if res.returncode != 0:
+                pprint.warn("pool {}: {} failed".format(cont.id, step))
+                return False
+        return cont.mksnapshot(self.SNAPSHOT).returncode == 0
+
+    def _fill_one(self, cont: lxc):
+        if not self._lock(cont):
+            return
+        try:
+            if not self.ready(cont):
+                pprint.dp("pool: provisioning {}", cont.id)
+                self.provision(cont)
+        finally:
+            self._unlock(cont)
+        return
+
+    def fill(self, wait: bool = True):
+        """Provision every member that is not ready, in parallel."""
+        threads = [threading.Thread(target=self._fill_one, args=(c,),
+                                    daemon=False) for c in self.members]
+        for t in threads:
+            t.start()
+        self._threads.extend(threads)
+        if wait:
+            for t in threads:
+                t.join()
+        return
+
+    def lease(self, timeout: float = None) -> lxc:
+        """A ready member, locked for the caller. While members are held
+        by fill or reset threads (or other runs) it waits for one to be
+        released; with none held it provisions one in the foreground.
+        None if no member can be used or timeout seconds passed."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            spare = None
+            busy = False
+            for cont in self.members:
+                if not self._lock(cont):
+                    busy = True
+                    continue
+                if self.ready(cont):
+                    if not spare is None:
+                        self._unlock(spare)
+                    return cont
+                if spare is None and self.owned(cont):
+                    spare = cont
+                else:
+                    self._unlock(cont)
+            if not busy:
+                if spare is None:
+                    return None
+                if self.provision(spare):
+                    return spare
+                self._unlock(spare)
+                return None
+            if not spare is None:
+                self._unlock(spare)
+            wait = self.POLL
+            if not deadline is None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return None
+            # woken by _unlock in this process; the timeout covers locks
+            # released by other runs
+            with self._released:
+                self._released.wait(wait)
+        return
+
+    def _reset(self, cont: lxc):
+        try:
+            cont.stop()
+            if cont.rollback(self.SNAPSHOT).returncode == 0:
+                cont.start()
+            else:
+                self.provision(cont)
+        finally:
+            self._unlock(cont)
+        return
+
+    def release(self, cont: lxc):
+        """Reset cont to its snapshot in the background."""
+        t = threading.Thread(target=self._reset, args=(cont,), daemon=False)
+        t.start()
+        self._threads.append(t)
+        return
+
+    def wait(self):
+        """Wait for background resets and fills."""
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        return
+
+
 def sp_run(cmd, capture_output=True, timeout=None,
            check=False, encoding=None, 
            text=True, **kwargs) -> subprocess.CompletedProcess:
     if type(cmd) is str:
         cmd = split(cmd)
     #pprint.dp("cmd: {}".format(cmd))
+    if not capture_output and kwargs.get('stdout') is None:
+        # the child writes straight to the terminal; let queued
+        # messages out first so the output stays in order
+        pprint.flush()
     return subprocess.run(cmd, capture_output=capture_output,
                           timeout=timeout, check=check, encoding=encoding,
                           text=text, **kwargs)
@@ -1463,9 +4776,9 @@ def header(pp):
 
 
 def get_template(name='debian-10', update=False, storage=None):
-    pprint.dp("get_template.name: {}".format(name))
-    pprint.dp("get_template.update: {}".format(update))
-    pprint.dp("get_template.storage: {}".format(storage))
+    pprint.dp("get_template.name: {}", name)
+    pprint.dp("get_template.update: {}", update)
+    pprint.dp("get_template.storage: {}", storage)
     d = {}
     d['search'] = name.lower()
     d['name'] = ""
@@ -1503,7 +4816,7 @@ def get_template(name='debian-10', update=False, storage=None):
     if update:
         subprocess.run(split('pveam update'))
         cmd = split('pveam available -section system')
-        pprint.dp("cmd: {}".format(cmd))
+        pprint.dp("cmd: {}", cmd)
         res = subprocess.run(cmd, capture_output=True,
                              text=True).stdout.splitlines()
         _AVAIL = []
@@ -1516,31 +4829,35 @@ def get_template(name='debian-10', update=False, storage=None):
             _AVAIL.sort(key=LooseVersion, reverse=True)
         pprint.p("Downloading template: {}".format(_AVAIL[0]))
         cmd = split('pveam download local {}'.format(_AVAIL[0]))
-        pprint.dp("cmd: {}".format(cmd))
+        pprint.dp("cmd: {}", cmd)
         res = subprocess.run(cmd, capture_output=True, text=True)
-        pprint.dp("res: {}".format(res))
-        pprint.dp("_AVAIL[0]: {}".format(_AVAIL[0]))
+        pprint.dp("res: {}", res)
+        pprint.dp("_AVAIL[0]: {}", _AVAIL[0])
     cmd = split('pveam list local')
-    pprint.dp("cmd: {}".format(cmd))
+    pprint.dp("cmd: {}", cmd)
     res = subprocess.run(cmd, capture_output=True,
                          text=True).stdout.splitlines()[1:]
-    pprint.dp("res: {}".format(res))
+    pprint.dp("res: {}", res)
     _AVAIL = []
     for x in res:
-        pprint.dp("x: {}".format(x))
+        pprint.dp("x: {}", x)
         if __TSEARCH in x:
             x = x.split()[0]
-            pprint.dp("x: {}".format(x))
+            pprint.dp("x: {}", x)
             #_AVAIL[x.partition("/")[2]] = x
             _AVAIL.append(x)
-            pprint.dp("_AVAIL: {}\n".format(_AVAIL))
-    pprint.dp("_AVAIL Final: {}\n".format(_AVAIL))
+            pprint.dp("_AVAIL: {}\n", _AVAIL)
+    pprint.dp("_AVAIL Final: {}\n", _AVAIL)
     _AVAIL.sort(key=LooseVersion, reverse=True)
-    pprint.dp("template: {}".format(_AVAIL[0]))
+    pprint.dp("template: {}", _AVAIL[0])
     return _AVAIL[0]
 
 
-def write_bootstrap_scripts(output_dir: str, target_kernel: kernel):
+def write_bootstrap_scripts(output_dir: str, target_kernel: kernel,
+                            plan: resourceplan = None, cont: lxc = None,
+                            cache: aptcache = None, tree: buildtree = None,
+                            profile: buildprofile = None,
+                            ccache: bool = False, fetch_jobs: int = None):
     """Creates the scripts to be run on the VM/LXC"""
     # Skeleton for new script files
     #output_file = "{}/gitinit.sh".format(output_dir)
@@ -1566,30 +4883,33 @@ def write_bootstrap_scripts(output_dir: str, target_kernel: kernel):
     git_dir = "/root/shared/git"
     conf_file = "/root/shared/bootstrap.conf"
 
-    bd = "" # build depends packages
-    if os.path.exists(f"{output_dir}/git/pve-kernel/debian/control.in"):
-        with open(f"{output_dir}/git/pve-kernel/debian/control.in", "r") as f:
-            bd = f.read()
-    if len(bd) > 10:
-        bd = bd.partition("Build-Depends: ")[2]
-        print(bd)
-        bd = bd.partition(": ")[0]
-        print(bd)
-        bd = bd.replace(",", "")
-        print(bd)
-        lines = bd.splitlines()
-        # Throw away the last line, likely 'Build-Conflicts'
-        lines = lines[0:-1]
-        print(lines)
-        bd = ""
-        for l in lines:
-            # Strip spaces
-            l = l.strip()
-            # remove any version qualifiers
-            l = l.split(" ")[0]
-            bd = f"{bd} {l}"
-        # Clean up spaces
-        bd = bd.strip()
+    # build depends packages not yet installed in the container
+    state = dpkgstate()
+    if not cont is None and cont.status == "running":
+        status = cont.readfile("/var/lib/dpkg/status")
+        if status:
+            state.load(status)
+    if profile is None:
+        profile = buildprofile()
+    extra = profile.extra
+    if ccache:
+        extra = f"{extra}, ccache"
+    deps = builddeps(control=f"{output_dir}/git/pve-kernel/debian/control.in",
+                     extra=extra, state=state, indep=profile.indep)
+    bd = str(deps)
+    pprint.dp("build-depends missing: {}", bd)
+    if len(deps.conflicts) > 0:
+        pprint.warn("Build-Conflicts installed in container: {}".format(
+            " ".join(deps.conflicts)))
+    # serialize apt between containers sharing the archive cache
+    aptlock = ""
+    cachecfg = ""
+    if not cache is None:
+        aptlock = f"flock -w 3600 {cache.lockfile}"
+        cachecfg = ("# Keep downloaded packages in the shared archive\n"
+                    "rm -f /etc/apt/apt.conf.d/docker-clean\n"
+                    "printf '" + cache.aptconf.replace("\n", "\\n") + "' "
+                    "> /etc/apt/apt.conf.d/99rmrr-cache\n")
     output_file = "{}/bootstrap.sh".format(output_dir)
     script = ("#!/bin/sh -\n"
               "if ! [ \"$(id -u)\" -eq 0 ]; then\n"
@@ -1602,7 +4922,9 @@ def write_bootstrap_scripts(output_dir: str, target_kernel: kernel):
               "\n" + "if [ -f \"${conffile}\" ]; then"
               "\n" + "    . \"${conffile}\""
               "\n" + "fi"
-              "\n# Check Locale" + "\n"
+              "\n" + "aptlock=\"" + aptlock + "\""
+              "\n" + cachecfg +
+              "# Check Locale" + "\n"
               "if (locale 2>&1 | grep \"locale: Cannot set\"); then" + "\n"
               "    echo \"Fixing Locales\"" + "\n"
               "    echo \"en_US.UTF-8 UTF-8\" >> /etc/locale.gen" + "\n"
@@ -1614,7 +4936,7 @@ def write_bootstrap_scripts(output_dir: str, target_kernel: kernel):
               "if ! (command -v \"lsb_release\" > /dev/null 2>&1); then" + "\n"
               "    apt update" + "\n"
               "    DEBIAN_FRONTEND=noninteractive "
-              "apt install lsb-release -y" + "\n"
+              "$aptlock apt-get install lsb-release -y" + "\n"
               "fi" + "\n"
               "# Check repos" + "\n"
               "gpg_key=\"proxmox-ve-release-6.x.gpg\"" + "\n"
@@ -1625,9 +4947,11 @@ def write_bootstrap_scripts(output_dir: str, target_kernel: kernel):
               "echo \"$pve_repo\" > /etc/apt/sources.list.d/pve.list" + "\n"
               "apt-get update || (echo \"Something went wrong\" && exit 1)"
               "\n" + "echo \"Installing apt updates\""
-              "\n" + "DEBIAN_FRONTEND=noninteractive apt-get dist-upgrade -y"
+              "\n" + "DEBIAN_FRONTEND=noninteractive "
+              "$aptlock apt-get dist-upgrade -y"
               "\n" + "echo \"Installing git\""
-              "\n" + "DEBIAN_FRONTEND=noninteractive apt install git -y"
+              "\n" + "DEBIAN_FRONTEND=noninteractive "
+              "$aptlock apt-get install git -y"
               "\n")
     with open(output_file, "w") as script_file:
         script_file.write(script)
@@ -1643,16 +4967,14 @@ def write_bootstrap_scripts(output_dir: str, target_kernel: kernel):
               "\n" + "if [ -f \"${conffile}\" ]; then"
               "\n" + "    . \"${conffile}\""
               "\n" + "fi"
+              "\n" + "aptlock=\"" + aptlock + "\""
               "\n" + "pkgs=\"" + bd + "\""
-              "\n" + "pkgs=\"$pkgs build-essential\""
-              "\n" + "pkgs=\"$pkgs patch\""
-              "\n" + "pkgs=\"$pkgs debhelper\""
-              "\n" + "pkgs=\"$pkgs libpve-common-perl\""
-              "\n" + "pkgs=\"$pkgs pve-kernel-5.3\""
-              "\n" + "pkgs=\"$pkgs pve-doc-generator\""
-              "\n" + "pkgs=\"$pkgs git\""
-              #"\n" + "pkgs=\"$pkgs \""
-              "\n" + "DEBIAN_FRONTEND=noninteractive apt-get install -y $pkgs"
+              "\n" + "if [ -z \"$pkgs\" ]; then"
+              "\n" + "    echo \"Build dependencies already satisfied\""
+              "\n" + "else"
+              "\n" + "    DEBIAN_FRONTEND=noninteractive "
+              "$aptlock apt-get install -y $pkgs"
+              "\n" + "fi"
               #"\n" + "if ! [ -d \"${gitdir}\" ]; then"
               #"\n" + "    mkdir -p \"${gitdir}\""
               #"\n" + "fi"
@@ -1680,9 +5002,26 @@ def write_bootstrap_scripts(output_dir: str, target_kernel: kernel):
               "\n" + "gitdir=\"" + git_dir + "\""
               "\n" + "kernel_git_url=\"" + target_kernel.git_url + "\""
               "\n" + "kernel_git_hash=\"" + target_kernel.git_hash + "\""
+              "\n" + "fetch_jobs=4"
+              "\n" + "script=$(readlink -f \"$0\")"
               "\n" + "if [ -f \"$conffile\" ]; then"
               "\n" + "    . \"$conffile\""
               "\n" + "fi"
+              "\n" + "elapsed() {"
+              "\n" + "    awk -v a=\"$1\" -v b=\"$(date +%s.%N)\" "
+              "'BEGIN { printf \"%.1f\", b - a }'"
+              "\n" + "}"
+              "\n" + "if [ -n \"$RMRR_FETCH\" ]; then"
+              "\n" + "    # one submodule, started by the xargs below"
+              "\n" + "    cd \"${gitdir}/pve-kernel\" || exit 1"
+              "\n" + "    start=$(date +%s.%N)"
+              "\n" + "    git submodule update --init --recursive -- "
+              "\"$RMRR_FETCH\""
+              "\n" + "    rc=$?"
+              "\n" + "    echo \"fetched ${RMRR_FETCH} in $(elapsed "
+              "\"$start\")s\""
+              "\n" + "    exit $rc"
+              "\n" + "fi"
               "\n" + "if ! [ -d \"${gitdir}\" ]; then"
               "\n" + "    mkdir -p \"${gitdir}\""
               "\n" + "fi"
@@ -1699,6 +5038,19 @@ def write_bootstrap_scripts(output_dir: str, target_kernel: kernel):
               "\n" + "    git pull origin master"
               "\n" + "    git checkout $kernel_git_hash"
               "\n" + "fi"
+              "\n" + "# fetch the submodules (ubuntu kernel, zfsonlinux and "
+              "the repositories"
+              "\n" + "# nested in it) fetch_jobs at a time; git puts each "
+              "in its place"
+              "\n" + "cd \"${gitdir}/pve-kernel\" || exit 1"
+              "\n" + "fetch_start=$(date +%s.%N)"
+              "\n" + "git submodule init"
+              "\n" + "git config -f .gitmodules --get-regexp "
+              "'^submodule\\..*\\.path$' | cut -d ' ' -f 2 | "
+              "xargs -r -P \"$fetch_jobs\" -I {} "
+              "env RMRR_FETCH={} sh \"$script\" || exit 1"
+              "\n" + "echo \"fetched all submodules in $(elapsed "
+              "\"$fetch_start\")s\""
               "\n" + ""
               "\n" + ""
               "\n" + ""
@@ -1708,59 +5060,1044 @@ def write_bootstrap_scripts(output_dir: str, target_kernel: kernel):
     #pprint.dp("script: {}".format(script))
     with open(output_file, "w") as script_file:
         script_file.write(script)
+    output_file = "{}/build.sh".format(output_dir)
+    script = ("#!/bin/sh -"
+              "\n" + "if ! [ \"$(id -u)\" -eq 0 ]; then"
+              "\n" + "    echo Must be root"
+              "\n" + "    exit 1"
+              "\n" + "fi"
+              "\n" + "startdir=$(pwd -P)"
+              "\n" + "# RMRR_ROOT selects another build root, e.g. a matrix "
+              "target"
+              "\n" + "rootdir=\"${RMRR_ROOT:-/root/shared}\""
+              "\n" + "conffile=\"${rootdir}/bootstrap.conf\""
+              "\n" + "gitdir=\"${rootdir}/git\""
+              "\n" + "treefile=\"${gitdir}/buildtree.conf\""
+              "\n" + "timefile=\"${rootdir}/build-times.log\""
+              "\n" + "# keep a copy of the output for --progress; build.done"
+              " holds the exit status"
+              "\n" + "logfile=\"${rootdir}/build.log\""
+              "\n" + "donefile=\"${rootdir}/build.done\""
+              "\n" + "if [ -z \"$RMRR_LOGGED\" ]; then"
+              "\n" + "    rm -f \"$donefile\""
+              "\n" + "    { RMRR_LOGGED=1 sh \"$0\" \"$@\" 2>&1; "
+              "echo $? > \"$donefile\"; } | tee \"$logfile\""
+              "\n" + "    exit \"$(cat \"$donefile\")\""
+              "\n" + "fi"
+              "\n" + "if [ -n \"$RMRR_CCACHE\" ] && "
+              "[ -d /usr/lib/ccache ]; then"
+              "\n" + "    export CCACHE_DIR=\"$RMRR_CCACHE\""
+              "\n" + "    export PATH=\"/usr/lib/ccache:$PATH\""
+              "\n" + "fi"
+              "\n" + "make_jobs=$(nproc)"
+              "\n" + "build_mode=\"full\""
+              "\n" + "build_profile=\"full\""
+              "\n" + "dpkg_opts=\"-b\""
+              "\n" + "if [ -f \"$conffile\" ]; then"
+              "\n" + "    . \"$conffile\""
+              "\n" + "fi"
+              "\n" + "if [ -n \"$1\" ]; then build_mode=\"$1\"; fi"
+              "\n" + "tree_git_hash=\"\""
+              "\n" + "if [ -f \"$treefile\" ]; then"
+              "\n" + "    . \"$treefile\""
+              "\n" + "fi"
+              "\n" + "cd \"${gitdir}/pve-kernel\" || exit 1"
+              "\n" + "if [ -n \"$tree_git_hash\" ] && [ \"$tree_git_hash\" != "
+              "\"$kernel_git_hash\" ]; then"
+              "\n" + "    echo \"Fast-forwarding to ${kernel_git_hash}\""
+              "\n" + "    git fetch origin"
+              "\n" + "    git merge --ff-only \"$kernel_git_hash\" || "
+              "git checkout \"$kernel_git_hash\" || exit 1"
+              "\n" + "    git submodule update --init"
+              "\n" + "fi"
+              "\n" + "ksrc=$(sed -n 's/^KERNEL_SRC *= *//p' Makefile "
+              "| head -n 1)"
+              "\n" + "patchfile=\"patches/kernel/9000-fix_rmrr.patch\""
+              "\n" + "patch_sum=\"\""
+              "\n" + "if [ -f \"$patchfile\" ]; then"
+              "\n" + "    patch_sum=$(sha256sum \"$patchfile\" "
+              "| cut -d ' ' -f 1)"
+              "\n" + "fi"
+              "\n" + "if [ \"$build_mode\" = \"incremental\" ] && "
+              "! [ -f \"build/${ksrc}/Makefile\" ]; then"
+              "\n" + "    echo \"No prepared build tree, doing a full build\""
+              "\n" + "    build_mode=\"full\""
+              "\n" + "fi"
+              "\n" + "# package the prepared tree, run in build/; the image "
+              "profile"
+              "\n" + "# makes only the kernel image package"
+              "\n" + "build_debs() {"
+              "\n" + "    if [ \"$build_profile\" != \"image\" ]; then"
+              "\n" + "        dpkg-buildpackage \"$@\" $dpkg_opts -uc -us "
+              "--jobs=\"$make_jobs\""
+              "\n" + "        return"
+              "\n" + "    fi"
+              "\n" + "    pkg=$(sed -n 's/^Package: *\\(pve-kernel-[0-9][^ ]*"
+              "\\)$/\\1/p' debian/control | head -n 1)"
+              "\n" + "    if [ -z \"$pkg\" ]; then"
+              "\n" + "        echo \"No kernel image package in debian/control\""
+              "\n" + "        return 1"
+              "\n" + "    fi"
+              "\n" + "    DEB_BUILD_OPTIONS=\"${DEB_BUILD_OPTIONS:+"
+              "$DEB_BUILD_OPTIONS }parallel=${make_jobs}\" \\"
+              "\n" + "    fakeroot sh -e -c 'p=\"-p$1\"; "
+              "debian/rules .install_mark; "
+              "dh_installdocs \"$p\" -A debian/copyright debian/SOURCE; "
+              "dh_installchangelogs \"$p\"; dh_installman \"$p\"; "
+              "dh_strip_nondeterminism \"$p\"; dh_compress \"$p\"; "
+              "dh_fixperms \"$p\"; dh_gencontrol \"$p\"; "
+              "dh_md5sums \"$p\"; dh_builddeb \"$p\"' sh \"$pkg\""
+              "\n" + "}"
+              "\n" + "# build/debian (version, changelog) and the module "
+              "sources are"
+              "\n" + "# only prepared by a full build"
+              "\n" + "if [ \"$build_mode\" = \"incremental\" ] && "
+              "[ \"$tree_git_hash\" != \"$kernel_git_hash\" ]; then"
+              "\n" + "    echo \"Build tree is not at ${kernel_git_hash}, "
+              "doing a full build\""
+              "\n" + "    build_mode=\"full\""
+              "\n" + "fi"
+              "\n" + "start=$(date +%s)"
+              "\n" + "if [ \"$build_mode\" = \"full\" ]; then"
+              "\n" + "    # from scratch: stamps and packages of an earlier "
+              "build"
+              "\n" + "    # would make this a no-op or ignore a new patch"
+              "\n" + "    rm -rf build build.tmp *.prepared *.deb *.ddeb "
+              "*.changes *.buildinfo"
+              "\n" + "fi"
+              "\n" + "if [ \"$build_mode\" = \"incremental\" ]; then"
+              "\n" + "    # patch a hardlinked copy of the sources, then"
+              "\n" + "    # copy only files whose content changed so make"
+              "\n" + "    # sees the rest as up to date"
+              "\n" + "    rm -rf build/.stage"
+              "\n" + "    cp -al \"submodules/${ksrc}\" build/.stage || exit 1"
+              "\n" + "    (cd build/.stage && "
+              "for p in ../../patches/kernel/*.patch; "
+              "do patch -p1 -s < \"$p\" || exit 1; done) || exit 1"
+              "\n" + "    ev=$(make -s --no-print-directory "
+              "--eval='rmrr-ev: ; @echo $(EXTRAVERSION)' rmrr-ev)"
+              "\n" + "    sed -i build/.stage/Makefile "
+              "-e \"s/^EXTRAVERSION.*$/EXTRAVERSION=${ev}/\""
+              "\n" + "    rsync -rlpgoD --checksum --exclude=.git "
+              "build/.stage/ \"build/${ksrc}/\" || exit 1"
+              "\n" + "    rm -rf build/.stage"
+              "\n" + "    cd build || exit 1"
+              "\n" + "    rm -f .*_mark"
+              "\n" + "    build_debs -nc || exit 1"
+              "\n" + "    cd .."
+              "\n" + "elif [ \"$build_profile\" = \"full\" ]; then"
+              "\n" + "    make -j\"$make_jobs\" || exit 1"
+              "\n" + "else"
+              "\n" + "    make build.prepared || exit 1"
+              "\n" + "    (cd build && build_debs) || exit 1"
+              "\n" + "fi"
+              "\n" + "end=$(date +%s)"
+              "\n" + "# the toolchain the packages were built with, for the "
+              "artifact cache"
+              "\n" + "dpkg-query -W -f='${Package}=${Version}\\n' "
+              + " ".join(artifactcache.TOOLCHAIN) + " > "
+              "\"${rootdir}/toolchain\""
+              "\n" + "echo \"$end $build_mode $kernel_git_hash "
+              "$((end-start))\" "
+              ">> \"$timefile\""
+              "\n" + "printf 'tree_git_hash=\"%s\"\\ntree_patch=\"%s\"\\n' "
+              "\"$kernel_git_hash\" \"$patch_sum\" > \"$treefile\""
+              "\n" + "echo \"${build_mode} ${build_profile} build took "
+              "$((end-start))s\""
+              "\n" + "cd \"${startdir}\"\n")
+    with open(output_file, "w") as script_file:
+        script_file.write(script)
+    write_bootstrap_conf(output_dir, target_kernel, plan, tree, profile,
+                         fetch_jobs)
+    return
+
+
+def makefile_var(makefile: str, name: str) -> str:
+    """Value of a plain 'NAME=value' assignment in a Makefile, or None."""
+    if not os.path.isfile(makefile):
+        return None
+    with open(makefile, "r") as f:
+        for x in f:
+            if x.startswith(name) and "=" in x:
+                var, _, val = x.partition("=")
+                if var.strip(" :?") == name:
+                    return val.strip()
+    return None
+
+
+def find_kernel_submodule(kdir: str) -> str:
+    """Path of the ubuntu kernel submodule relative to a pve-kernel
+    checkout, e.g. submodules/ubuntu-eoan. Tries the Makefile KERNEL_SRC,
+    then .gitmodules, then any submodule that looks like a kernel tree."""
+    ksrc = makefile_var(f"{kdir}/Makefile", "KERNEL_SRC")
+    if ksrc and os.path.isdir(f"{kdir}/submodules/{ksrc}"):
+        return f"submodules/{ksrc}"
+    paths = []
+    if os.path.isfile(f"{kdir}/.gitmodules"):
+        path = None
+        with open(f"{kdir}/.gitmodules", "r") as f:
+            for x in f:
+                key, _, val = x.strip().partition("=")
+                if key.strip() == "path":
+                    path = val.strip()
+                elif key.strip() == "url" and "ubuntu" in val and \
+                     "kernel" in val and not path is None:
+                    paths.append(path)
+    for path in paths:
+        if os.path.isdir(f"{kdir}/{path}"):
+            return path
+    if os.path.isdir(f"{kdir}/submodules"):
+        for x in sorted(os.listdir(f"{kdir}/submodules")):
+            if os.path.isfile(f"{kdir}/submodules/{x}/Kbuild") and \
+               os.path.isdir(f"{kdir}/submodules/{x}/drivers"):
+                return f"submodules/{x}"
+    return None
+
+
+def diff_lines(lines, relpath: str, action, context: int = 3) -> tuple:
+    """Stream lines through action and return (patch, changed) where patch
+    is a unified diff (a/relpath, b/relpath) of the result and changed the
+    list of 1-based line numbers action modified. action(line) returns
+    None to keep the line or a list of replacement lines, [] to delete.
+    Only the last few context lines are held in memory."""
+    out = []
+    changed = []
+    before = []         # unchanged lines ahead of the next hunk
+    hunk = None         # [old_start, entries] of the open hunk
+    tail = []           # unchanged lines after the last change in hunk
+    offset = 0          # new minus old line count before the open hunk
+
+    def emit(h, trailing):
+        nonlocal offset
+        entries = h[1] + [(" ", x) for x in trailing]
+        old_n = sum(1 for t, _ in entries if t != "+")
+        new_n = sum(1 for t, _ in entries if t != "-")
+        out.append("@@ -{},{} +{},{} @@\n".format(
+            h[0], old_n, h[0] + offset, new_n))
+        for t, x in entries:
+            out.append(t + x)
+            if not x.endswith("\n"):
+                out.append("\n\\ No newline at end of file\n")
+        offset += new_n - old_n
+        return
+
+    lineno = 0
+    for line in lines:
+        lineno += 1
+        new = action(line)
+        if new is None:
+            if hunk is None:
+                before.append(line)
+                if len(before) > context:
+                    before.pop(0)
+                continue
+            tail.append(line)
+            if len(tail) > 2 * context:
+                emit(hunk, tail[:context])
+                before = tail[-context:]
+                hunk = None
+                tail = []
+            continue
+        changed.append(lineno)
+        if hunk is None:
+            hunk = [lineno - len(before), [(" ", x) for x in before]]
+            before = []
+        else:
+            hunk[1].extend((" ", x) for x in tail)
+            tail = []
+        hunk[1].append(("-", line))
+        hunk[1].extend(("+", x) for x in new)
+    if not hunk is None:
+        emit(hunk, tail[:context])
+    if len(changed) == 0:
+        return "", changed
+    head = "--- a/{}\n+++ b/{}\n".format(relpath, relpath)
+    return head + "".join(out), changed
+
+
+def write_atomic(path: str, text: str):
+    """Replace path with text so readers never see a partial file."""
+    tmp = f"{path}.rmrr-new"
+    # text read with errors="surrogateescape" writes back byte for byte
+    with open(tmp, "w", errors="surrogateescape") as f:
+        f.write(text)
+    os.replace(tmp, path)
+    return
+
+
+def set_krel_suffix(makefile: str, suffix: str = "-rmrmrr") -> bool:
+    """Append suffix to the ${KREL}-pve kernel release in the pve-kernel
+    Makefile. Idempotent; returns True if the file changed."""
+    if not os.path.isfile(makefile):
+        return False
+    pattern = re.compile(r"([$][({]KREL[)}]-pve)(?!" + re.escape(suffix) +
+                         r")")
+    with open(makefile, "r") as f:
+        text = f.read()
+    new = pattern.sub(r"\g<1>" + suffix, text)
+    if new == text:
+        return False
+    write_atomic(makefile, new)
+    return True
+
+
+def write_bootstrap_conf(output_dir: str, target_kernel: kernel,
+                         plan: resourceplan = None, tree: buildtree = None,
+                         profile: buildprofile = None,
+                         fetch_jobs: int = None):
+    """Writes bootstrap.conf, the settings sourced by the LXC scripts"""
+    if profile is None:
+        profile = buildprofile()
     if type(target_kernel) is kernel:
         output_file = "{}/bootstrap.conf".format(output_dir)
         script = ("#!/bin/sh -"
                   "\n" + "kernel_git_url=\"" + target_kernel.git_url + "\""
                   "\n" + "kernel_git_hash=\"" + target_kernel.git_hash + "\""
                   "\n")
+        if not plan is None:
+            script = script + "make_jobs=\"{}\"\n".format(plan.jobs)
+        if not tree is None:
+            script = script + "build_mode=\"{}\"\n".format(tree.mode)
+        if not fetch_jobs is None:
+            script = script + "fetch_jobs=\"{}\"\n".format(fetch_jobs)
+        script = script + ("build_profile=\"{}\"\n"
+                           "dpkg_opts=\"{}\"\n").format(
+                               profile.name, profile.dpkg_opts)
         with open(output_file, "w") as script_file:
             script_file.write(script)
-            #pprint.dp("File written: {}".format(output_file))
     return
 
 
-def create_patch(shared_dir: str):
+def write_matrix_fetch(output_dir: str):
+    """Script that checks out one matrix target under $RMRR_ROOT, sharing
+    objects with a reference clone of pve-kernel and its submodules."""
+    output_file = "{}/matrix-fetch.sh".format(output_dir)
+    script = ("#!/bin/sh -"
+              "\n" + "rootdir=\"$RMRR_ROOT\""
+              "\n" + ". \"${rootdir}/bootstrap.conf\""
+              "\n" + "mirror=\"/root/shared/git/mirror/pve-kernel\""
+              "\n" + "if ! [ -d \"${mirror}/.git\" ]; then"
+              "\n" + "    mkdir -p \"$(dirname \"$mirror\")\""
+              "\n" + "    git clone \"$kernel_git_url\" \"$mirror\" || exit 1"
+              "\n" + "else"
+              "\n" + "    git -C \"$mirror\" fetch origin || exit 1"
+              "\n" + "fi"
+              "\n" + "# fetch this target's submodule objects into the mirror"
+              "\n" + "git -C \"$mirror\" checkout -q \"$kernel_git_hash\" "
+              "|| exit 1"
+              "\n" + "git -C \"$mirror\" submodule update --init "
+              "--jobs \"${fetch_jobs:-4}\" || exit 1"
+              "\n" + "mkdir -p \"${rootdir}/git\""
+              "\n" + "if ! [ -d \"${rootdir}/git/pve-kernel/.git\" ]; then"
+              "\n" + "    git clone --reference \"$mirror\" "
+              "\"$kernel_git_url\" \"${rootdir}/git/pve-kernel\" || exit 1"
+              "\n" + "fi"
+              "\n" + "cd \"${rootdir}/git/pve-kernel\" || exit 1"
+              "\n" + "git fetch origin"
+              "\n" + "git checkout -q \"$kernel_git_hash\" || exit 1"
+              "\n" + "git -c submodule.alternateLocation=superproject "
+              "-c submodule.alternateErrorStrategy=info "
+              "submodule update --init --jobs \"${fetch_jobs:-4}\" || exit 1"
+              "\n")
+    with open(output_file, "w") as script_file:
+        script_file.write(script)
+    return output_file
+
+
+def build_matrix(cont: lxc, shared: str, targets: list,
+                 plan: resourceplan = None, profile: buildprofile = None,
+                 artifacts: artifactcache = None,
+                 pcache: patchcache = None, full: bool = False,
+                 rebuild: bool = False, pool: buildpool = None,
+                 history: buildhistory = None) -> list:
+    """Build each matrix target in turn inside cont, or inside a container
+    leased from pool. Every target gets its own tree under
+    <shared>/matrix/<hash>; all share the pve-kernel reference clone and a
+    ccache directory on the shared volume.
+    Returns one result dict per target for kernelmatrix.summary."""
+    if profile is None:
+        profile = buildprofile()
+    write_matrix_fetch(shared)
+    if pool is None:
+        if cont.status != "running":
+            cont.start()
+        for step in ("bootstrap.sh", "build-depends.sh"):
+            with profiler.phase(step.partition(".")[0]):
+                res = cont.exec(f"sh /root/shared/{step}")
+            if res.returncode != 0:
+                pprint.warn("{} failed: {}".format(step,
+                                                   res.stderr.strip()))
+    toolchain = None
+    if not artifacts is None and not cont is None:
+        toolchain = artifactcache.toolchain(cont.id)
+    results = []
+    for t in targets:
+        r = dict(t)
+        del r['kernel']
+        r['seconds'] = 0
+        r['debs'] = []
+        r['stages'] = {}
+        results.append(r)
+        ameta = artifactcache.meta(t['kernel'], profile, toolchain)
+        if not artifacts is None and not rebuild and not toolchain is None:
+            debs = artifacts.lookup(artifactcache.key(ameta))
+            if not debs is None:
+                r['result'] = "cached"
+                r['debs'] = debs
+                record_run(history, r, None, profile, plan, cont)
+                continue
+        troot = f"{shared}/matrix/{t['git_hash'][:12]}"
+        croot = f"/root/shared/matrix/{t['git_hash'][:12]}"
+        os.makedirs(troot, exist_ok=True)
+        tree = buildtree(troot, t['kernel'], "full" if full else None)
+        write_bootstrap_conf(troot, t['kernel'], plan, tree, profile)
+        pprint.p("Matrix: {} {} ({})".format(t['pkg'], t['version'],
+                                             t['reason']))
+        env = {'RMRR_ROOT': croot, 'RMRR_CCACHE': "/root/shared/ccache"}
+        c = cont
+        if not pool is None:
+            with profiler.phase("lease"):
+                c = pool.lease()
+            if c is None:
+                pprint.err("no build container available in the pool")
+                r['result'] = "failed"
+                continue
+            pprint.dp("leased container {}", c.id)
+        if not artifacts is None:
+            # before the build: harvest() only takes builds finished
+            # after this
+            artifacts.expect(troot, ameta)
+        hits = 0 if pcache is None else pcache.hits
+        try:
+            r['result'] = _matrix_target(c, env, troot, pcache, r, tree)
+        finally:
+            if not pool is None:
+                pool.release(c)
+        if not pcache is None:
+            r['patch_hit'] = int(pcache.hits > hits)
+        record_run(history, r, tree.mode, profile, plan, c)
+        if r['result'] != "built":
+            if os.path.isfile(f"{troot}/artifact.json"):
+                os.remove(f"{troot}/artifact.json")
+            continue
+        r['debs'] = glob.glob(f"{troot}/git/pve-kernel/*.deb")
+        if not artifacts is None:
+            key = artifacts.harvest(troot)
+            if not key is None:
+                r['debs'] = artifacts.lookup(key)
+    return results
+
+
+def _matrix_target(cont: lxc, env: dict, troot: str, pcache: patchcache,
+                   r: dict, tree: buildtree) -> str:
+    with cgroupsampler(cont.id, f"{troot}/resources.log"):
+        return _matrix_stages(cont, env, troot, pcache, r, tree)
+
+
+def _matrix_stages(cont: lxc, env: dict, troot: str, pcache: patchcache,
+                   r: dict, tree: buildtree) -> str:
+    start = time.time()
+    with profiler.phase("clone"):
+        res = cont.exec("sh /root/shared/matrix-fetch.sh", env)
+    r['stages']['clone'] = time.time() - start
+    if res.returncode != 0:
+        pprint.err("checkout failed: {}".format(res.stderr.strip()))
+        return "failed"
+    start = time.time()
+    with profiler.phase("patch"):
+        create_patch(troot, cache=pcache)
+    r['stages']['patch'] = time.time() - start
+    mode = tree.mode
+    progress = buildprogress(tree.objects(mode))
+    ccache = {'CCACHE_DIR': env['RMRR_CCACHE']}
+    cont.exec("ccache -z", ccache)
+    start = time.time()
+    with profiler.phase("make"):
+        rc = cont.stream("sh /root/shared/build.sh", env, progress.feed)
+    r['seconds'] = int(time.time() - start)
+    r['stages']['make'] = time.time() - start
+    r['ccache_hit'] = ccache_hit_rate(cont.exec("ccache -s", ccache).stdout)
+    if rc != 0:
+        pprint.err("build failed:\n{}".format("\n".join(progress.tail)))
+        return "failed"
+    tree.record_objects(mode, r['git_hash'], progress.objects)
+    return "built"
+
+
+def ccache_hit_rate(stats: str) -> float:
+    """Hit rate in percent from ccache -s output, None if not shown."""
+    for x in (stats or "").splitlines():
+        x = x.lower()
+        if "hit rate" in x or x.strip().startswith("hits:"):
+            m = re.search(r"(\d+(?:\.\d+)?)\s*%", x)
+            if m:
+                return float(m.group(1))
+    return None
+
+
+def record_run(history: buildhistory, r: dict, mode: str,
+               profile: buildprofile, plan: resourceplan, cont: lxc):
+    """Add a matrix or single build result to history, if enabled."""
+    if history is None:
+        return
+    run = {'pkg': r['pkg'], 'version': r.get('version'),
+           'git_hash': r['git_hash'], 'mode': mode or "none",
+           'profile': profile.name, 'seconds': r.get('seconds') or 0,
+           'result': r['result'],
+           'artifact_hit': int(r['result'] == "cached"),
+           'patch_hit': r.get('patch_hit'), 'ccache_hit': r.get('ccache_hit')}
+    if not cont is None:
+        run['cores'] = cont.cores
+        run['ram_mb'] = cont.ram
+        run['fssize'] = cont.fssize
+        run['storage'] = cont.storage
+    if not plan is None:
+        run['jobs'] = plan.jobs
+    history.record(run, r.get('stages'))
+    return
+
+
+def watch_kernels(cont: lxc, shared: str, watcher: aptwatch,
+                  search: str = None, plan: resourceplan = None,
+                  profile: buildprofile = None,
+                  artifacts: artifactcache = None,
+                  pcache: patchcache = None, full: bool = False,
+                  repo: aptrepo = None, pool: buildpool = None,
+                  history: buildhistory = None):
+    """Run until interrupted: whenever the apt lists settle after a change,
+    queue a patched build of every pve-kernel whose candidate version is
+    new since the last check."""
+    known = aptwatch.candidates(search)
+    pprint.p("Watching {} for new kernels ({} known)".format(
+        watcher.lists, len(known)))
+    pending = []
+    try:
+        while True:
+            watcher.wait()
+            now = aptwatch.candidates(search)
+            hashes = set(t['git_hash'] for t in pending)
+            for name in sorted(now, key=LooseVersion, reverse=True):
+                version = now[name]
+                if version is None or known.get(name) == version:
+                    continue
+                c = kernel(pkg=name)
+                if not c.fetch_candidate_source() or c.git_hash in hashes:
+                    continue
+                hashes.add(c.git_hash)
+                pprint.p("New kernel: {} {}".format(name, version))
+                pending.append({'kernel': c, 'pkg': name, 'version': version,
+                                'git_hash': c.git_hash,
+                                'reason': "new" if known.get(name) is None
+                                else "upgradable"})
+            known = now
+            if len(pending) == 0:
+                continue
+            results = build_matrix(cont, shared, pending, plan, profile,
+                                   artifacts, pcache, full, pool=pool,
+                                   history=history)
+            pprint.p("Watch results:\n{}".format(
+                kernelmatrix.summary(results)))
+            publish(repo, [d for r in results for d in r['debs']])
+            pending = []
+    except KeyboardInterrupt:
+        pprint.p("Watch stopped")
+    return
+
+
+def publish(repo: aptrepo, debs: list):
+    """Publish debs to repo, if publishing is enabled."""
+    if repo is None or not debs:
+        return
+    added = repo.publish(debs)
+    if len(added) > 0:
+        pprint.p("Published {} package(s) to {}".format(len(added),
+                                                         repo.path))
+        pprint.p("apt source: {}".format(repo.sources_line))
+    return
+
+
+def create_patch(shared_dir: str, rules: list = None,
+                 cache: patchcache = None):
     # call using the lxc shared volume
-    search = "return -EPERM;"
-    targetfile = f"{shared_dir}/git/pve-kernel/submodules/ubuntu-eoan/drivers"
-    targetfile = f"{targetfile}/iommu/intel-iommu.c"
-    dopatch = False
-    # need to update/pull the ubuntu-disco submodule files prior to this
-    # run git command inside lxc to make sure ubuntu kernel source is
-    # up to date
-    # todo
-    if os.path.isfile(targetfile):
-        with open(targetfile, 'r') as file:
-            if search in file.read():
-                dopatch = True
-    if dopatch:
-        cmd = f"sed \"/{search}/d\" \"{targetfile}\" > /tmp/intel-iommu_new.c"
-        res = sp_run(cmd)
-        print(res) # debugging
-        patchfile = f"{shared_dir}/git/pve-kernel/patches/kernel"
-        patchfile = f"{patchfile}/9000-fix_rmrr.patch"
-        cmd = f"diff -u \"{targetfile}\" /tmp/intel-iommu_new.c"
-        cmd = f"{cmd} > \"{patchfile}\""
-        res = sp_run(cmd)
-        print(res)
-        cmd = f"sed -i \"s|--- {targetfile}|--- a/drivers/iommu/intel-iommu.c|"
-        cmd = f"{cmd}g\" \"{patchfile}\""
-        res = sp_run(cmd)
-        print(res)
-        cmd = f"sed -i \"s|+++ intel-iommu_new.c|+++ b/drivers/iommu"
-        cmd = f"{cmd}/intel-iommu.c|g\" \"{patchfile}\""
-        res = sp_run(cmd)
-        print(res)
-        cmd = "sed -i \"s/{{KREL}}-pve/{{krel}}-pve-rmrmrr/g\" "
-        cmd = f"{cmd}\"{shared_dir}/git/pve-kernel/Makefile\""
-        res = sp_run(cmd)
-        print(res)
-        os.remove("/tmp/intel-iommu_new.c")
-        print("run:\npct enter <lxcid>\ncd /root/shared/pve-kernel\nmake -j\n")
+    kdir = f"{shared_dir}/git/pve-kernel"
+    patchfile = f"{kdir}/patches/kernel/9000-fix_rmrr.patch"
+    engine = patchengine(kdir, rules)
+    if engine.submodule is None:
+        pprint.err("No ubuntu kernel submodule found in {}".format(kdir))
+        return None
+    pprint.dp("kernel submodule: {}", engine.submodule)
+    key = None
+    patch = None
+    if not cache is None:
+        key = cache.key(engine)
+        patch = cache.get(key)
+        if patch is None:
+            pprint.p("Patch cache miss: {}".format(key))
+        else:
+            pprint.p("Patch cache hit: {}".format(key))
+            notes = cache.notes(key)
+            report = notes['report']
+            problems = notes['problems']
+    if patch is None:
+        patch = engine.run()
+        report = ["{}: {}/{}:{}: {}".format(rule.name, engine.submodule,
+                                            rel, lineno, line.strip())
+                  for rule, rel, lineno, line in engine.report]
+        problems = engine.problems
+        if not key is None:
+            cache.put(key, patch, report, problems)
+    for line in report:
+        pprint.p(line)
+    for problem in problems:
+        pprint.warn(problem)
+    if len(patch) == 0:
+        pprint.p("No rule matched, nothing to patch")
+        return None
+    write_atomic(patchfile, patch)
+    set_krel_suffix(f"{kdir}/Makefile")
+    pprint.p("Wrote {}".format(patchfile))
+    pprint.p("run:\npct enter <lxcid>\nsh /root/shared/build.sh\n")
+    return patchfile
+
+
+def _ere(pattern: str) -> str:
+    """Translate the python regex subset used by patchrules to POSIX ERE
+    for git grep -E. Hits are re-checked with the python pattern."""
+    return pattern.replace(r"\s", "[[:space:]]").replace(r"\d", "[0-9]")
+
+
+def _inline(pattern: str) -> str:
+    """Keep \\s within one line when a patchrule pattern is run over a
+    whole file with re.MULTILINE; otherwise ^\\s* matches from the end of
+    the previous line."""
+    return pattern.replace(r"\s", r"[ \t\r\f\v]")
+
+
+def _scan_file(path: str, rules: list) -> list:
+    """Memory-mapped search of one file, [(rule, lineno, line)]."""
+    ret = []
+    size = os.path.getsize(path)
+    if size == 0:
+        return ret
+    with open(path, "rb") as f, \
+         mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for rule in rules:
+            pat = re.compile(_inline(rule.pattern.pattern).encode(),
+                             re.MULTILINE)
+            lineno = 1
+            last = 0
+            for m in pat.finditer(mm):
+                lineno += mm[last:m.start()].count(b"\n")
+                last = m.start()
+                end = mm.find(b"\n", m.start())
+                start = mm.rfind(b"\n", 0, m.start()) + 1
+                line = mm[start:end if end >= 0 else size]
+                ret.append((rule.name, lineno,
+                            line.decode(errors="replace").strip()))
+    return ret
+
+
+def _git(repo: str, *args) -> subprocess.CompletedProcess:
+    return sp_run(["git", "-C", repo] + list(args))
+
+
+def scan_target(target: str, mirror: str = None) -> dict:
+    """Check one kernel source for the patchengine rules.
+    target is a directory (pve-kernel checkout or kernel tree) or
+    'repo@rev' for a git repository at a revision, searched with git grep
+    without a checkout. For a pve-kernel repository the ubuntu kernel
+    gitlink is resolved and searched in mirror, a clone of the ubuntu
+    kernel mirror. Returns a picklable dict for the report."""
+    ret = {'target': target, 'kind': None, 'source': None,
+           'matches': [], 'applicable': False, 'error': None}
+    rules = patchengine.RULES
+    try:
+        if os.path.isdir(target):
+            ret['kind'] = "tree"
+            src = target
+            sub = find_kernel_submodule(target)
+            if not sub is None:
+                src = f"{target}/{sub}"
+            ret['source'] = src
+            for rule in rules:
+                for g in rule.glob:
+                    for path in sorted(glob.glob(f"{src}/{g}")):
+                        rel = os.path.relpath(path, src)
+                        for name, lineno, line in _scan_file(path, [rule]):
+                            ret['matches'].append([name, rel, lineno, line])
+        else:
+            ret['kind'] = "git"
+            repo, _, rev = target.rpartition("@")
+            if not repo or not os.path.isdir(repo):
+                raise ValueError("not a directory or repo@rev")
+            commit = rev
+            res = _git(repo, "show", f"{rev}:Makefile")
+            ksrc = None
+            if res.returncode == 0:
+                for x in res.stdout.splitlines():
+                    var, sep, val = x.partition("=")
+                    if sep and var.strip(" :?") == "KERNEL_SRC":
+                        ksrc = val.strip()
+                        break
+            if not ksrc is None:
+                # pve-kernel: follow the gitlink into the kernel mirror
+                res = _git(repo, "ls-tree", rev, f"submodules/{ksrc}")
+                if res.returncode != 0 or not res.stdout.strip():
+                    raise ValueError(f"no gitlink for submodules/{ksrc}")
+                commit = res.stdout.split()[2]
+                if mirror is None:
+                    raise ValueError(f"{ksrc} at {commit} needs a kernel "
+                                     "mirror")
+                repo = mirror
+            ret['source'] = f"{repo}@{commit}"
+            for rule in rules:
+                res = _git(repo, "grep", "-n", "-I", "--no-color", "-E",
+                           "-e", _ere(rule.pattern.pattern), commit, "--",
+                           *rule.glob)
+                if res.returncode > 1:
+                    raise ValueError(res.stderr.strip())
+                for x in res.stdout.splitlines():
+                    # <commit>:<path>:<line>:<text>
+                    _, path, lineno, line = x.split(":", 3)
+                    if rule.pattern.search(line):
+                        ret['matches'].append([rule.name, path, int(lineno),
+                                               line.strip()])
+    except (OSError, ValueError, IndexError) as e:
+        ret['error'] = str(e)
+    ret['applicable'] = len(ret['matches']) > 0
+    return ret
+
+
+def scan_targets(targets: list, mirror: str = None,
+                 processes: int = None) -> list:
+    """scan_target for many targets in a process pool."""
+    if len(targets) == 0:
+        return []
+    if processes is None:
+        processes = min(len(targets), multiprocessing.cpu_count())
+    jobs = [(t, mirror) for t in targets]
+    if processes <= 1:
+        return [scan_target(*j) for j in jobs]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.starmap(scan_target, jobs)
+
+
+def write_scan_report(results: list, path: str):
+    """Write scan results as JSON for target selection."""
+    report = {'rules_version': patchengine.VERSION,
+              'applicable': [r['target'] for r in results
+                             if r['applicable']],
+              'results': results}
+    write_atomic(path, json.dumps(report, indent=2) + "\n")
     return
 
 
+def bench_config(count: int = 10000) -> dict:
+    """Parse and serialize throughput of the pct option codec over count
+    containers, each with the pct.conf lines of two networks, a rootfs
+    and two mount points written the way pct writes them. A record that
+    does not serialize back to its exact line is a round trip error."""
+    lines = []
+    for i in range(count):
+        cid = 100 + i
+        net = f"10.{i >> 8 & 0xff}.{i & 0xff}"
+        lines.append(f"net0: name=eth0,bridge=vmbr0,firewall=1,gw={net}.1,"
+                     f"hwaddr=FA:4D:70:0{cid >> 16 & 0xf}:"
+                     f"{cid >> 8 & 0xff:02X}:{cid & 0xff:02X},"
+                     f"ip={net}.{cid % 250 + 2}/24,type=veth")
+        lines.append(f"net1: name=eth1,bridge=vmbr1,gw6=2001:db8::1,"
+                     f"hwaddr=BC:24:11:0{cid >> 16 & 0xf}:"
+                     f"{cid >> 8 & 0xff:02X}:{cid & 0xff:02X},ip=dhcp,"
+                     f"ip6=2001:db8::{cid:x}/64,mtu=1400,rate=12.5,tag=10,"
+                     f"type=veth")
+        lines.append(f"rootfs: local-lvm:vm-{cid}-disk-0,size=8G")
+        lines.append(f"mp0: /srv/share/{cid},mp=/root/shared,ro=0")
+        lines.append(f"mp1: local-lvm:vm-{cid}-disk-1,mp=/var/cache,"
+                     f"backup=0,mountoptions=noatime;nodev,size=8G")
+
+    def parse_all() -> list:
+        return [pvenetwork.parse(x) if x.startswith("net")
+                else pvemountpoint.parse(x) for x in lines]
+
+    start = time.perf_counter()
+    objs = parse_all()
+    parse_s = time.perf_counter() - start
+    # memory is measured on a second pass, tracing skews the timing
+    tracemalloc.start()
+    held = parse_all()
+    mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del held
+    start = time.perf_counter()
+    out = [str(x) for x in objs]
+    dump_s = time.perf_counter() - start
+    bad = 0
+    for x, s, line in zip(objs, out, lines):
+        if x.options != line.partition(": ")[2] or \
+           not type(x).parse(s) == x:
+            bad += 1
+    ret = {}
+    ret['containers'] = count
+    ret['records'] = len(objs)
+    ret['parse_per_s'] = int(len(objs) / parse_s) if parse_s else 0
+    ret['serialize_per_s'] = int(len(objs) / dump_s) if dump_s else 0
+    ret['bytes_per_record'] = int(mem / len(objs)) if objs else 0
+    ret['roundtrip_errors'] = bad
+    return ret
+
+
+def check_rules() -> dict:
+    """Run patchrule cases through diff_lines and, where patch(1) is
+    installed, apply each generated patch to the original text. A case
+    fails if the rewritten text or the patched file is not the expected
+    text."""
+    eperm = r"^\s*return -EPERM;\s*$"
+    cases = (
+        ("delete", patchrule("delete", "f.c", eperm),
+         "a\n\treturn -EPERM;\nb\n", "a\nb\n"),
+        ("replace trailing \\s*$",
+         patchrule("replace", "f.c", r"^(\s*)return -EPERM;\s*$",
+                   "replace", r"\1return 0;"),
+         "a\n\n  return -EPERM;  \nb\nc\n",
+         "a\n\n  return 0;\nb\nc\n"),
+        ("replace last line without newline",
+         patchrule("replace eof", "f.c", r"^(\s*)return -EPERM;\s*$",
+                   "replace", r"\1return 0;"),
+         "a\n\treturn -EPERM;", "a\n\treturn 0;"),
+        ("replace crlf",
+         patchrule("replace crlf", "f.c", r"return -EPERM;\s*$",
+                   "replace", "return 0;"),
+         "a\r\n\treturn -EPERM;\r\nb\r\n", "a\r\n\treturn 0;\r\nb\r\n"),
+    )
+    failed = []
+    for name, rule, text, want in cases:
+        lines = text.splitlines(keepends=True)
+        got = ""
+        for x in lines:
+            new = rule.apply(x)
+            got = got + (x if new is None else "".join(new))
+        patch, changed = diff_lines(iter(lines), "f.c", rule.apply)
+        if got != want or len(changed) == 0:
+            failed.append(name)
+            continue
+        if shutil.which("patch") is None:
+            continue
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(f"{tmp}/f.c", "w", newline="") as f:
+                f.write(text)
+            res = sp_run(["patch", "-s", "-p1", "-d", tmp], input=patch)
+            with open(f"{tmp}/f.c", "r", newline="") as f:
+                if res.returncode != 0 or f.read() != want:
+                    failed.append(name)
+    ret = {}
+    ret['cases'] = len(cases)
+    ret['patch'] = not shutil.which("patch") is None
+    ret['failed'] = failed
+    return ret
+
+
+def refresh_mirror(shared: str) -> bool:
+    """Fetch the pve-kernel git mirror on the host, so the fetch inside
+    a build container finds the objects already there. Does nothing if
+    there is no mirror (yet) or no git on the host."""
+    mirror = f"{shared}/git/mirror/pve-kernel"
+    if not os.path.isdir(f"{mirror}/.git") or shutil.which("git") is None:
+        return False
+    res = sp_run(["git", "-C", mirror, "fetch", "-q", "origin"])
+    if res.returncode != 0:
+        pprint.warn("git mirror fetch failed: {}".format(res.stderr.strip()))
+        return False
+    pprint.dp("git mirror {} refreshed", mirror)
+    return True
+
+
+def setup_graph(args, profile: buildprofile) -> taskgraph:
+    """The setup steps up to a created (or reconciled) build container
+    as a taskgraph. Template download, kernel discovery, the git mirror
+    fetch and the apt cache do not wait on each other; the container is
+    only touched once the artifact cache and history had their say. A
+    cache hit or --history exits without waiting for the download."""
+    graph = taskgraph(args.setup_jobs)
+
+    def select_kernel(k: kernels) -> kernel:
+        l = k.list
+        l.sort(key=LooseVersion, reverse=True)
+        krnl = None
+        if args.kernel:
+            # User specified a kernel search string to use
+            # go through the list of kernels to find the specified string
+            for ll in l:
+                if args.kernel in ll:
+                    krnl = k[ll]
+                    break
+            if not krnl:
+                exitstring = "The specified kernel \"{}\" was not found."
+                sys.exit(exitstring.format(args.kernel))
+        if not krnl:
+            for ll in l:
+                if k[ll].installed:
+                    krnl = k[ll]
+                    break
+        if not krnl:
+            # something went wrong, unable to find an installed kernel
+            sys.exit("Unable to find a kernel to work with")
+        return krnl
+
+    def select_matrix(k: kernels) -> kernelmatrix:
+        if not args.matrix:
+            return None
+        matrix = kernelmatrix(k, search=args.kernel)
+        if len(matrix.targets) == 0:
+            sys.exit("No kernels found for the build matrix")
+        for t in matrix.targets:
+            pprint.p("Matrix target: {} {} ({}, {})".format(
+                t['pkg'], t['version'], t['reason'], t['git_hash'][:12]))
+        return matrix
+
+    def open_repo() -> aptrepo:
+        if args.no_publish:
+            return None
+        return aptrepo(args.repo if args.repo else f"{args.share}/repo")
+
+    def open_history() -> buildhistory:
+        if args.no_history:
+            return None
+        return buildhistory(args.history_db)
+
+    def check_artifacts(krnl, matrix, repo, history) -> tuple:
+        if args.no_artifact_cache:
+            return None, None
+        artifacts = artifactcache(args.artifacts)
+        stored = artifacts.harvest(args.share)
+        if not stored is None:
+            pprint.p("Stored finished build as artifact {}".format(stored))
+            publish(repo, artifacts.lookup(stored))
+        if not matrix is None or args.watch:
+            return artifacts, None
+        toolchain = artifactcache.toolchain(args.id)
+        ameta = artifactcache.meta(krnl, profile, toolchain)
+        akey = artifactcache.key(ameta)
+        if toolchain is None:
+            # the key is corrected from the build's toolchain on harvest
+            pprint.p("Artifact cache: toolchain of container {} unknown, "
+                     "building".format(args.id))
+            return artifacts, ameta
+        debs = artifacts.lookup(akey)
+        if not debs is None and not args.rebuild:
+            pprint.p("Artifact cache hit: {}".format(akey))
+            for deb in debs:
+                pprint.p(deb)
+            publish(repo, debs)
+            record_run(history, {'pkg': krnl.pkg, 'version': krnl.installed,
+                                 'git_hash': krnl.git_hash,
+                                 'result': "cached"}, None, profile, None,
+                       None)
+            sys.exit()
+        pprint.p("Artifact cache miss: {}".format(akey))
+        return artifacts, ameta
+
+    def make_plan() -> resourceplan:
+        plan = resourceplan(storage=args.storage, cores=args.cores,
+                            ram=args.ram, fssize=args.fssize, jobs=args.jobs)
+        pprint.dp("plan:\n{}", plan)
+        if not plan.fits:
+            if args.fssize:
+                sys.exit("A {} GB rootfs is below the minimum of {} GB for "
+                         "a build".format(plan.fssize, plan.DISK_BASE))
+            sys.exit("Storage {} has only {} GB free, a build needs at "
+                     "least {} GB".format(plan.storage, plan.storage_free,
+                                          plan.DISK_BASE +
+                                          plan.DISK_RESERVE))
+        free = plan.storage_free
+        if args.fssize and not free is None and \
+           plan.fssize > free - plan.DISK_RESERVE:
+            sys.exit("A {} GB rootfs does not fit storage {}: {} GB free, "
+                     "{} GB of it kept in reserve".format(
+                         plan.fssize, plan.storage, free, plan.DISK_RESERVE))
+        return plan
+
+    def predict(krnl, plan, history, ameta) -> dict:
+        if history is None:
+            return None
+        mode = buildtree(args.share, krnl, "full" if args.full else None).mode
+        if args.history:
+            pprint.p("Build history:\n{}".format(history.report(
+                krnl.pkg, mode, profile.name, plan.cores, plan.storage)))
+            sys.exit()
+        guess = history.predict(krnl.pkg, mode, profile.name, plan.cores,
+                                plan.storage)
+        if not guess is None:
+            pprint.p("Predicted {} build time: {}m{:02d}s".format(
+                mode, guess['seconds'] // 60, guess['seconds'] % 60))
+        return guess
+
+    def prepare_cache() -> aptcache:
+        if args.no_apt_cache:
+            return None
+        cache = aptcache(args.apt_cache)
+        if not cache.prepare():
+            pprint.warn("apt cache {} is not a directory, not "
+                        "using it".format(cache.volume))
+            return None
+        pprint.dp("apt cache: {!r}", cache)
+        return cache
+
+    def make_container(plan, cache, tmpl, ameta, guess) -> lxc:
+        mounts = pvemountpoint(volume=args.share, mp="/root/shared", ro=0)
+        if not cache is None:
+            mounts = [mounts, cache.mountpoint]
+        cont = lxc(id=args.id, cores=plan.cores, ram=plan.ram / 1024,
+                   storage=plan.storage,
+                   tmpl=tmpl or __TSEARCH, fssize=plan.fssize,
+                   net=pvenetwork(bridge=0, ip='dhcp'), mp=mounts)
+        if not cont.status:
+            cont.set_defaults()
+            pprint.dp("lxc.create: {}", cont.create())
+        elif args.force:
+            cont.set_defaults()
+            changes, resize, recreate = cont.diffconfig()
+            if len(recreate) > 0:
+                # only a new container can change these
+                pprint.p("Recreating container {}: {}".format(
+                    cont.id, ", ".join(recreate)))
+                pprint.dp("lxc.destroy: {}", cont.destroy(test=False))
+                pprint.dp("lxc.create [forced]: {}", cont.create())
+            else:
+                for res in cont.reconcile():
+                    pprint.dp("lxc.reconcile: {}", res)
+                    if res.returncode != 0:
+                        pprint.err(res.stderr.strip())
+                if len(changes) == 0 and resize is None:
+                    pprint.p("Container {} already matches".format(cont.id))
+                elif cont.status == "running" and \
+                     any(x.startswith("mp") for x in changes):
+                    pprint.warn("Mount point changes apply at the next "
+                                "start of container {}".format(cont.id))
+        return cont
+
+    graph.add("kernels", kernels, (), ("k",))
+    graph.add("select kernel", select_kernel, ("k",), ("krnl",))
+    graph.add("matrix targets", select_matrix, ("k",), ("matrix",))
+    graph.add("git mirror", refresh_mirror, ("shared",))
+    graph.add("apt cache", prepare_cache, (), ("cache",))
+    graph.add("plan", make_plan, (), ("plan",))
+    graph.add("repo", open_repo, (), ("repo",))
+    graph.add("history", open_history, (), ("history",))
+    graph.add("artifacts", check_artifacts,
+              ("krnl", "matrix", "repo", "history"), ("artifacts", "ameta"))
+    # after the artifacts task, which may record a run in the history
+    graph.add("predict", predict, ("krnl", "plan", "history", "ameta"),
+              ("guess",))
+    # started at once, the download is dropped if the run exits early
+    graph.add("template", lxc.template, ("tmpl_name",), ("tmpl",),
+              speculative=True)
+    graph.add("lxc", make_container,
+              ("plan", "cache", "tmpl", "ameta", "guess"), ("cont",))
+    graph.values['tmpl_name'] = __TSEARCH
+    graph.values['shared'] = args.share
+    return graph
+
+
 def create_lxc(cont, tmpl, storage='local-lvm'):
     pprint.dp("f: create_lxc")
 
@@ -1788,16 +6125,16 @@ def create_lxc(cont, tmpl, storage='local-lvm'):
     else:
         # shared_dir doesn't exist, create it
         os.makedirs(cont.shared_dir)
-    pprint.dp("cmd: {}".format(cmd))
+    pprint.dp("cmd: {}", cmd)
     cmd = split(cmd)
-    pprint.dp("cmd: {}".format(cmd))
+    pprint.dp("cmd: {}", cmd)
     pprint.p("Created LXC {}".format(cont.id))
     # pdb.set_trace()
     res = sp_run(cmd)
     if res.returncode == 0:
-        pprint.dp("LXC Create result: {}".format(res.stdout))
+        pprint.dp("LXC Create result: {}", res.stdout)
         return True
-    pprint.dp("LXC Create error: {}".format(res.stderr))
+    pprint.dp("LXC Create error: {}", res.stderr)
     return False
 
 
@@ -1812,6 +6149,12 @@ if __name__ == "__main__":
                         help="Show debugging messages",
                         action="store_true")
 
+    parser.add_argument("--log-file",
+                        help="Also append every message as JSON lines to this\
+                        file",
+                        type=str,
+                        default=None)
+
     parser.add_argument("-b",
                         "--bridge",
                         help="Bridge # to connect to",
@@ -1831,15 +6174,38 @@ if __name__ == "__main__":
 
     parser.add_argument("-C",
                         "--cores",
-                        help="Number of cores to use. Default <cores> - 4",
+                        help="Number of cores to use. "
+                        "Default: planned from idle host cpus",
                         type=int,
-                        default=(multiprocessing.cpu_count() - 4))
+                        default=None)
 
     parser.add_argument("-R",
                         "--ram",
-                        help="Amount of ram in GB",
+                        help="Amount of ram in GB. "
+                        "Default: planned from available memory",
+                        type=int,
+                        default=None)
+
+    parser.add_argument("-F",
+                        "--fssize",
+                        help="Container rootfs size in GB. "
+                        "Default: planned from storage free space",
                         type=int,
-                        default=6)
+                        default=None)
+
+    parser.add_argument("--storage",
+                        help="Proxmox storage for the container rootfs, "
+                        "also the storage whose free space is planned. "
+                        "Default: local-lvm",
+                        type=str,
+                        default="local-lvm")
+
+    parser.add_argument("-j",
+                        "--jobs",
+                        help="Parallel make jobs. "
+                        "Default: planned from cores and memory",
+                        type=int,
+                        default=None)
 
     parser.add_argument("-K",
                         "--kernel",
@@ -1868,9 +6234,192 @@ if __name__ == "__main__":
                         type=str,
                         default="{}/shared".format(root_path))
 
+    parser.add_argument("-A",
+                        "--apt-cache",
+                        help="Host directory shared by all build containers "
+                        "as apt archive cache. Default: <script dir>/aptcache",
+                        type=str,
+                        default="{}/aptcache".format(root_path))
+
+    parser.add_argument("-P",
+                        "--build-profile",
+                        help="Packages to build: 'full' builds everything, "
+                        "'image' only the pve-kernel image package",
+                        type=str,
+                        choices=list(buildprofile.PROFILES),
+                        default="full")
+
+    parser.add_argument("--matrix",
+                        help="Build every installed pve-kernel and the "
+                        "candidates of upgradable ones (limited by --kernel)",
+                        action="store_true")
+
+    parser.add_argument("--watch",
+                        help="Keep running and build a patched kernel "
+                        "whenever apt sees a new pve-kernel",
+                        action="store_true")
+
+    parser.add_argument("--watch-interval",
+                        help="Seconds between checks of the apt lists "
+                        "(default: 60)",
+                        type=int,
+                        default=60)
+
+    parser.add_argument("--watch-debounce",
+                        help="Seconds the apt lists must stay unchanged "
+                        "before a build is queued (default: 300)",
+                        type=int,
+                        default=300)
+
+    parser.add_argument("--fetch-jobs",
+                        help="Repositories gitinit.sh fetches at once "
+                        "(default: 4)",
+                        type=int,
+                        default=4)
+
+    parser.add_argument("--setup-jobs",
+                        help="Setup steps (template download, kernel "
+                        "discovery, git mirror fetch, ...) run at once "
+                        "(default: 4)",
+                        type=int,
+                        default=4)
+
+    parser.add_argument("--pool",
+                        help="Keep N bootstrapped build containers running "
+                        "(ids after --id) and lease them for --matrix and "
+                        "--watch builds (default: 0, no pool)",
+                        type=int,
+                        default=0)
+
+    parser.add_argument("--pool-fill",
+                        help="Provision the --pool containers and exit",
+                        action="store_true")
+
+    parser.add_argument("--profile",
+                        help="Time each phase of the run (wall, CPU, "
+                        "subprocesses) and print a summary at exit",
+                        action="store_true")
+
+    parser.add_argument("--profile-out",
+                        help="With --profile, also write folded stacks "
+                        "for flame graph tools to this file",
+                        type=str,
+                        default=None)
+
+    parser.add_argument("--progress",
+                        help="After writing the scripts, follow build.log "
+                        "on the shared volume and report progress and ETA "
+                        "until build.sh finishes",
+                        action="store_true")
+
+    parser.add_argument("--sample",
+                        help="Seconds between samples of the container's "
+                        "cgroup counters during builds, written to "
+                        "resources.log (default: 5, 0 disables)",
+                        type=float,
+                        default=5.0)
+
+    parser.add_argument("--history",
+                        help="Show the predicted duration of the planned "
+                        "build and recent builds of its series, then exit",
+                        action="store_true")
+
+    parser.add_argument("--history-db",
+                        help="Build history database. "
+                        "Default: <script dir>/history.sqlite",
+                        type=str,
+                        default="{}/history.sqlite".format(root_path))
+
+    parser.add_argument("--no-history",
+                        help="Do not record builds in the history database",
+                        action="store_true")
+
+    parser.add_argument("--full",
+                        help="Rebuild from scratch instead of reusing the "
+                        "prepared build tree",
+                        action="store_true")
+
+    parser.add_argument("--no-apt-cache",
+                        help="Do not share an apt archive cache",
+                        action="store_true")
+
+    parser.add_argument("--patch-cache",
+                        help="Directory of generated patches keyed by "
+                        "source blob hash. Default: <script dir>/patchcache",
+                        type=str,
+                        default="{}/patchcache".format(root_path))
+
+    parser.add_argument("--no-patch-cache",
+                        help="Always regenerate the patch",
+                        action="store_true")
+
+    parser.add_argument("--artifacts",
+                        help="Store of built packages. "
+                        "Default: <script dir>/artifacts",
+                        type=str,
+                        default="{}/artifacts".format(root_path))
+
+    parser.add_argument("--repo",
+                        help="Local apt repository built packages are "
+                        "published to. Default: <share>/repo",
+                        type=str,
+                        default=None)
+
+    parser.add_argument("--no-publish",
+                        help="Do not publish built packages to the local "
+                        "apt repository",
+                        action="store_true")
+
+    parser.add_argument("--no-artifact-cache",
+                        help="Do not look up or store built packages",
+                        action="store_true")
+
+    parser.add_argument("--rebuild",
+                        help="Build even if the packages are already in "
+                        "the artifact store",
+                        action="store_true")
+
+    parser.add_argument("--bench-config",
+                        help="Benchmark parsing and writing pct network and "
+                        "mount point options for N synthetic containers "
+                        "(default: 10000) and exit",
+                        type=int,
+                        nargs="?",
+                        const=10000,
+                        default=None)
+
+    parser.add_argument("--check-rules",
+                        help="Check the patch rule engine against built-in "
+                        "cases, applying the generated patches with patch "
+                        "when installed, and exit",
+                        action="store_true")
+
+    parser.add_argument("--scan",
+                        help="Check kernel trees (directories) or git "
+                        "revisions (repo@rev) for the RMRR check, write "
+                        "the report and exit",
+                        type=str,
+                        nargs="+",
+                        default=None)
+
+    parser.add_argument("--scan-mirror",
+                        help="Ubuntu kernel mirror used to resolve "
+                        "pve-kernel submodule commits for --scan",
+                        type=str,
+                        default=None)
+
+    parser.add_argument("--scan-report",
+                        help="Where --scan writes its JSON report",
+                        type=str,
+                        default="{}/scan-report.json".format(root_path))
+
     args = parser.parse_args()
 
-    pprint = prettyprint(args.verbose)
+    pprint = prettyprint(args.verbose, args.log_file)
+    cgroupsampler.INTERVAL = args.sample
+    if args.profile:
+        profiler = phaseprofiler(True)
+        atexit.register(profiler.finish, args.profile_out)
 
     header(pprint)
 
@@ -1887,58 +6436,119 @@ if __name__ == "__main__":
             sys.exit("Invalid Vendor MAC ID specified.")
         # all checks pass, set mac_vendor
         __MAC_VENDOR = mm.rjust(6, '0')
+        lxc.macs = macallocator(__MAC_VENDOR, skip=args.id,
+                                reservations=f"{args.share}/mac-reservations")
 
     pprint.dp(args)
+    if not args.bench_config is None:
+        res = bench_config(args.bench_config)
+        for x in res:
+            pprint.p("{}: {}".format(x, res[x]))
+        sys.exit()
+    if args.check_rules:
+        res = check_rules()
+        for x in res:
+            pprint.p("{}: {}".format(x, res[x]))
+        sys.exit(1 if len(res['failed']) > 0 else 0)
+    if args.scan:
+        with profiler.phase("scan"):
+            results = scan_targets(args.scan, mirror=args.scan_mirror)
+        for r in results:
+            if not r['error'] is None:
+                pprint.err("{}: {}".format(r['target'], r['error']))
+                continue
+            pprint.p("{}: {}".format(r['target'], "applicable"
+                                     if r['applicable'] else "no match"))
+            for name, path, lineno, line in r['matches']:
+                pprint.dp("{}: {}:{}: {}", name, path, lineno, line)
+        write_scan_report(results, args.scan_report)
+        pprint.p("Wrote {}".format(args.scan_report))
+        sys.exit()
     # pprint.dp(args.bridge)
     # pprint.dp(pprint.supports_color())
     #tmpl = get_template()
     #pprint.dp("tmpl: {}".format(tmpl))
     #cont = lxc(lxc_id=args.id, shared_dir=args.share)
-    cont = lxc(id=args.id, net=pvenetwork(bridge=0, ip='dhcp'),
-               mp=pvemountpoint(volume=args.share, mp="/root/shared", ro=0))
+    profile = buildprofile(args.build_profile)
+    pprint.p("Build profile: {}".format(profile))
+    graph = setup_graph(args, profile)
+    with profiler.phase("setup"):
+        values = graph.run()
+    pprint.dp("setup tasks:\n{}", graph.summary)
+    krnl = values['krnl']
+    matrix = values['matrix']
+    repo = values['repo']
+    history = values['history']
+    artifacts = values['artifacts']
+    ameta = values['ameta']
+    plan = values['plan']
+    cache = values['cache']
+    cont = values['cont']
     #if create_lxc(cont, tmpl):
     #    cmd = split('pct start {}'.format(cont.id))
     #    res = sp_run(cmd)
     #    pprint.dp("cmd output: {}".format(res))
-    if not cont.status:
-        cont.set_defaults()
-        pprint.dp("lxc.create: {}".format(cont.create()))
-    elif args.force:
-        if cont.status:
-            cont.loadconfig()
-        else:
-            cont.set_defaults()
-        s = ("lxc.create [forced]:\n{}".format(cont.create(overwrite=True)))
-        pprint.dp(s)
-    pprint.dp("cont:\n{}".format(cont))
-    k = kernels()
-    l = k.list
-    l.sort(key=LooseVersion, reverse=True)
-    krnl = None
-    if args.kernel:
-        # User specified a kernel search string to use
-        # go through the list of kernels to find the specified string
-        for ll in l:
-            if args.kernel in ll:
-                krnl = k[ll]
-                break
-        if not krnl:
-            exitstring = "The specified kernel \"{}\" was not found."
-            sys.exit(exitstring.format(args.kernel))
-    if not krnl:
-        for ll in l:
-            if k[ll].installed:
-                krnl = k[ll]
-                break
-    if not krnl:
-        # something went wrong, unable to find an installed kernel
-        sys.exit("Unable to find a kernel to work with")
+    pprint.dp("cont:\n{}", cont)
     shared = ""
     if type(cont.mp) is list:
         shared = cont.mp[0].volume
     else:
         shared = cont.mp.volume
-    script = write_bootstrap_scripts(shared, krnl)
+    with profiler.phase("buildtree"):
+        tree = buildtree(shared, krnl, "full" if args.full else None)
+        comparison = tree.comparison
+    pprint.dp("build tree: {!r}", tree)
+    if tree.current:
+        pprint.p("Build tree is already at {}".format(krnl.git_hash))
+    pprint.p("Build mode: {}".format(tree.mode))
+    if not comparison is None:
+        pprint.p("Previous builds: {}".format(comparison))
+    with profiler.phase("write_bootstrap_scripts"):
+        script = write_bootstrap_scripts(
+            shared, krnl, plan, cont, cache, tree, profile,
+            ccache=args.watch or not matrix is None,
+            fetch_jobs=args.fetch_jobs)
+    if not cache is None:
+        pprint.p("apt cache {}: {} packages, {} MB".format(
+            cache.volume, cache.packages, cache.size))
+    pool = None
+    if args.pool > 0:
+        pool = buildpool(cont, args.pool)
+        if args.pool_fill:
+            pool.fill()
+            for c in pool.members:
+                pprint.p("pool container {}: {}".format(
+                    c.id, "ready" if buildpool.ready(c) else "not ready"))
+            sys.exit()
+        # top the pool up while the first targets run
+        pool.fill(wait=False)
+    if not matrix is None:
+        pcache = None
+        if not args.no_patch_cache:
+            pcache = patchcache(args.patch_cache)
+        with profiler.phase("matrix"):
+            results = build_matrix(cont, shared, matrix.targets, plan,
+                                   profile, artifacts, pcache, args.full,
+                                   args.rebuild, pool, history)
+        pprint.p("Matrix results:\n{}".format(
+            kernelmatrix.summary(results)))
+        publish(repo, [d for r in results for d in r['debs']])
+        if not pool is None:
+            pool.wait()
+        sys.exit()
+    if args.watch:
+        pcache = None
+        if not args.no_patch_cache:
+            pcache = patchcache(args.patch_cache)
+        watcher = aptwatch(interval=args.watch_interval,
+                           debounce=args.watch_debounce)
+        watch_kernels(cont, shared, watcher, args.kernel, plan, profile,
+                      artifacts, pcache, args.full, repo, pool, history)
+        if not pool is None:
+            pool.wait()
+        sys.exit()
+    if not artifacts is None:
+        artifacts.expect(shared, ameta)
     # notes 2019.11.27
     # Next steps:
     # 1) enter the container and run
@@ -1949,7 +6559,33 @@ if __name__ == "__main__":
     # 2) then run the create_patch method
     # 3) then it should give further instructions if successful
     # end notes 2019.11.27
-    #create_patch(shared)
+    if os.path.isdir(f"{shared}/git/pve-kernel"):
+        pcache = None
+        if not args.no_patch_cache:
+            pcache = patchcache(args.patch_cache)
+        with profiler.phase("patch"):
+            create_patch(shared, cache=pcache)
+    if args.progress:
+        mode = tree.mode
+        progress = buildprogress(tree.objects(mode))
+        pprint.p("Following {}/build.log, expecting {} objects".format(
+            shared, progress.expected or "an unknown number of"))
+        with cgroupsampler(cont.id, f"{shared}/resources.log"):
+            progress.follow(f"{shared}/build.log", f"{shared}/build.done")
+        with open(f"{shared}/build.done", "r") as f:
+            rc = f.read().strip()
+        pprint.p("{} (exit status {})".format(progress.message, rc))
+        if rc == "0":
+            tree.record_objects(mode, krnl.git_hash, progress.objects)
+        seconds = 0
+        for epoch, bmode, git_hash, secs in tree.history:
+            if git_hash == krnl.git_hash:
+                seconds = secs
+        record_run(history, {'pkg': krnl.pkg, 'version': krnl.installed,
+                             'git_hash': krnl.git_hash, 'seconds': seconds,
+                             'result': "built" if rc == "0" else "failed",
+                             'stages': {'make': seconds}},
+                   mode, profile, plan, cont)
     # a file exists in the pve kernel package which specifies the git id
     # the package was built against
     # next step is to figure out which build was used and git checkout
@@ -37,23 +37,96 @@ pkgs="${pkgs} sphinx-common"
 echo "==== BEGIN APT PACKAGE INSTALL ====================================="
 DEBIAN_FRONTEND=noninteractive apt install -y ${pkgs}
 echo "==== GET SOURCES ====================================="
+# clone every repository into a staging directory at once, at most
+# fetch_jobs at a time, then move the clones to their nested places.
+# PROXMOX_GIT and ZFS_IMAGES_URL point the clones at another server.
+proxmox_git="${PROXMOX_GIT:-git://git.proxmox.com/git}"
+zfs_images_url="${ZFS_IMAGES_URL:-https://github.com/zfsonlinux/zfs-images}"
+fetch_jobs="${FETCH_JOBS:-4}"
+fetchdir="${gitdir}/.fetch"
+fetch_started=0
+fetch_pids=""
+elapsed() {
+    awk -v a="$1" -v b="$(date +%s.%N)" 'BEGIN { printf "%.1f", b - a }'
+}
+fetch() {
+    # fetch <name> <url>: clone in the background into ${fetchdir}/<name>
+    while [ $((fetch_started - $(ls "${fetchdir}" | grep -c '\.rc$'))) -ge "${fetch_jobs}" ]; do
+        sleep 0.2
+    done
+    fetch_started=$((fetch_started + 1))
+    (
+        start=$(date +%s.%N)
+        git clone --depth=1 "$2" "${fetchdir}/$1" > "${fetchdir}/$1.log" 2>&1 &
+        pid=$!
+        trap 'kill "${pid}" 2>/dev/null; wait "${pid}"; exit 143' TERM
+        wait "${pid}"
+        rc=$?
+        echo "fetched $1 in $(elapsed "${start}")s" >> "${fetchdir}/times"
+        echo "${rc}" > "${fetchdir}/$1.tmp" && mv "${fetchdir}/$1.tmp" "${fetchdir}/$1.rc"
+    ) &
+    fetch_pids="${fetch_pids} $!"
+}
+stop_fetch() {
+    # stop_fetch: kill the clones still running and wait until they are gone
+    kill ${fetch_pids} 2>/dev/null
+    wait
+}
+wait_fetch() {
+    # wait_fetch <name>: wait for a clone, stop if it failed
+    while ! [ -f "${fetchdir}/$1.rc" ]; do
+        sleep 0.2
+    done
+    if ! [ "$(cat "${fetchdir}/$1.rc")" -eq 0 ]; then
+        cat "${fetchdir}/$1.log"
+        echo "Unable to clone $1"
+        stop_fetch
+        exit 2
+    fi
+}
 cd "${gitdir}"
-git clone --depth=1 git://git.proxmox.com/git/pve-kernel.git
+fetch_start=$(date +%s.%N)
+rm -rf "${fetchdir}"
+mkdir -p "${fetchdir}"
+kdir="pve-kernel"
+if ! [ -d "${kdir}" ]; then
+    fetch pve-kernel "${proxmox_git}/pve-kernel.git"
+    kdir="${fetchdir}/pve-kernel"
+fi
+fetch zfsonlinux "${proxmox_git}/zfsonlinux"
+fetch mirror_zfs "${proxmox_git}/mirror_zfs"
+fetch zfs-images "${zfs_images_url}"
+if ! [ -d pve-kernel ]; then wait_fetch pve-kernel; fi
+# ubuntu kernel submodule of this pve-kernel release, e.g. ubuntu-eoan
+ksrc=$(sed -n 's/^KERNEL_SRC *= *//p' "${kdir}/Makefile" | head -n 1)
+kurl=$(git config -f "${kdir}/.gitmodules" --get "submodule.submodules/${ksrc}.url")
+if [ -z "${ksrc}" ] || [ -z "${kurl}" ]; then
+    echo "Unable to find the kernel submodule"
+    stop_fetch
+    exit 2
+fi
+fetch "${ksrc}" "${kurl}"
+for x in zfsonlinux mirror_zfs zfs-images "${ksrc}"; do
+    wait_fetch "${x}"
+done
+if ! [ -d pve-kernel ]; then mv "${kdir}" pve-kernel; fi
 cd pve-kernel/submodules || exit 2
-rm -rf ubuntu-disco
-git clone --depth=1 git://git.proxmox.com/git/mirror_ubuntu-disco-kernel ubuntu-disco
-rm -rf zfsonlinux
-git clone --depth=1 git://git.proxmox.com/git/zfsonlinux
+rm -rf "${ksrc}" zfsonlinux
+mv "${fetchdir}/${ksrc}" "${ksrc}"
+mv "${fetchdir}/zfsonlinux" zfsonlinux
 cd zfsonlinux || exit 3
 rm -rf upstream
-git clone --depth=1 git://git.proxmox.com/git/mirror_zfs upstream
+mv "${fetchdir}/mirror_zfs" upstream
 cd upstream/scripts || exit 4
 rm -rf zfs-images
-git clone --depth=1 https://github.com/zfsonlinux/zfs-images
+mv "${fetchdir}/zfs-images" zfs-images
+cat "${fetchdir}/times"
+echo "fetched all sources in $(elapsed "${fetch_start}")s"
+rm -rf "${fetchdir}"
 cd "${gitdir}"
 echo "==== CREATING PATCH FILE ============================================"
 search="return -EPERM;"
-targetfile="pve-kernel/submodules/ubuntu-disco/drivers/iommu/intel-iommu.c"
+targetfile="pve-kernel/submodules/${ksrc}/drivers/iommu/intel-iommu.c"
 if (grep "${search}" "${targetfile}"); then
         sed "/${search}/d" "${targetfile}" > intel-iommu_new.c
 fi